@@ -0,0 +1,87 @@
+import datetime
+import json
+import os
+import shutil
+import struct
+import zlib
+
+from util import get_log
+
+log = get_log('critical')
+
+_LENGTH = struct.Struct('>I')
+
+
+class SegmentArchive(object):
+    # append-only log for the archived edits and patches, so they don't bloat the live sqlite file. Records are
+    # zlib compressed json, prefixed by their length, in one segment file per kind and day. Where each record lives
+    # is saved by the DataStore in its archive_index table
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def _segment_name(self, kind):
+        return f"{kind}-{datetime.date.today():%Y%m%d}.seg"
+
+    def append(self, kind, record):
+        return self.append_many(kind, (record,))[0]
+
+    def append_many(self, kind, records):
+        segment = self._segment_name(kind)
+        chunks = []
+        for record in records:
+            data = zlib.compress(json.dumps(record).encode())
+            chunks.append(_LENGTH.pack(len(data)) + data)
+        if not chunks:
+            return []
+        fd = os.open(os.path.join(self.path, segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            # a single write so concurrent appenders can't interleave
+            blob = b''.join(chunks)
+            os.write(fd, blob)
+            offset = os.lseek(fd, 0, os.SEEK_CUR) - len(blob)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        locations = []
+        for chunk in chunks:
+            locations.append((segment, offset + _LENGTH.size, len(chunk) - _LENGTH.size))
+            offset += len(chunk)
+        return locations
+
+    def read(self, segment, offset, length):
+        with open(os.path.join(self.path, segment), 'rb') as segment_file:
+            segment_file.seek(offset)
+            data = segment_file.read(length)
+        if len(data) != length:
+            log.error(f"truncated record in {segment} at {offset}")
+            raise EOFError
+        return json.loads(zlib.decompress(data).decode())
+
+    def iter_segment(self, segment):
+        # every record of a segment, including the ones whose transaction was rolled back after being appended
+        with open(os.path.join(self.path, segment), 'rb') as segment_file:
+            while True:
+                header = segment_file.read(_LENGTH.size)
+                if len(header) < _LENGTH.size:
+                    return
+                length, = _LENGTH.unpack(header)
+                data = segment_file.read(length)
+                if len(data) < length:
+                    log.warning(f"truncated record at the end of {segment}")
+                    return
+                yield json.loads(zlib.decompress(data).decode())
+
+    def segments(self, kind=None):
+        names = sorted(name for name in os.listdir(self.path) if name.endswith('.seg'))
+        if kind:
+            names = [name for name in names if name.startswith(f"{kind}-")]
+        return names
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
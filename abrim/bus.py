@@ -0,0 +1,119 @@
+import os
+import socket
+import threading
+import time
+
+from metrics import get_metrics
+from util import get_log
+
+log = get_log('critical')
+
+# the components tell each other there is work waiting with a UDP datagram to 127.0.0.1. node.py sets
+# ABRIM_BUS_PORT to the port it launches the node on and each listener binds that port plus its offset, the same
+# ports node.py gives them for HTTP. A datagram only wakes the listener up, the work itself is always read from the
+# storage, so a lost one or a missing bus only means waiting for the usual polling
+EDIT_ENQUEUED = "edit_enqueued"
+PATCH_ENQUEUED = "patch_enqueued"
+POST_ENQUEUED = "post_enqueued"
+PATCH_APPLIED = "patch_applied"
+
+INPUT = 1
+OUT = 2
+PATCH = 3
+
+# who is woken up by each event
+LISTENER_OF = {
+    EDIT_ENQUEUED: OUT,
+    PATCH_ENQUEUED: PATCH,
+    POST_ENQUEUED: PATCH,
+    PATCH_APPLIED: INPUT,
+}
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def get_bus_port():
+    # None without a bus, the components poll as before
+    port = os.environ.get('ABRIM_BUS_PORT')
+    return int(port) if port else None
+
+
+def _get_sender():
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            _sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        return _sender
+
+
+def notify(event):
+    # fire and forget, never fails the caller. Call it after the commit, or the listener may look too soon
+    port = get_bus_port()
+    if not port:
+        return
+    try:
+        _get_sender().sendto(event.encode(), ('127.0.0.1', port + LISTENER_OF[event]))
+    except OSError as err:
+        log.debug(f"couldn't notify {event}: {err}")
+
+
+class Listener(object):
+    # the events this process has been sent, counted. Waiters take the count before looking at the storage and then
+    # wait for it to change, so an event that arrives in between isn't missed
+
+    def __init__(self):
+        self.events = 0
+        self._condition = threading.Condition()
+        self._socket = None
+
+    def listen(self, component, port=None):
+        # INPUT, OUT or PATCH. Without a bus port wait() just sleeps
+        port = port or get_bus_port()
+        if not port:
+            return False
+        listener_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            listener_socket.bind(('127.0.0.1', port + component))
+        except OSError as err:
+            log.warning(f"no notifications, polling instead: {err}")
+            listener_socket.close()
+            return False
+        self._socket = listener_socket
+        threading.Thread(target=self._receive, args=(listener_socket,), daemon=True).start()
+        return True
+
+    def _receive(self, listener_socket):
+        while True:
+            try:
+                event, _ = listener_socket.recvfrom(64)
+            except OSError:
+                return
+            if self._socket is not listener_socket:
+                listener_socket.close()  # see close()
+                return
+            get_metrics().increment(f"bus.{event.decode(errors='replace')}")
+            with self._condition:
+                self.events += 1
+                self._condition.notify_all()
+
+    def wait(self, timeout, seen):
+        # until there are more events than seen or timeout seconds. True if it was woken up
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.events == seen:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self):
+        # a blocked recvfrom() doesn't always return when another thread closes the socket, so the receiving thread
+        # gets one last datagram and closes it itself
+        listener_socket, self._socket = self._socket, None
+        if listener_socket:
+            try:
+                _get_sender().sendto(b"", listener_socket.getsockname())
+            except OSError:
+                listener_socket.close()
@@ -4,10 +4,21 @@ from pathlib import Path
 
 from abrim.util import get_log
 from datastore import DataStore
+from memory_storage import MemoryStorage
+from sharded_storage import ShardedStorage
+from metrics import get_metrics, DEFAULT_SLOW_THRESHOLD_MS
+from storage import STORAGE_SQLITE, STORAGE_MEMORY, DEFAULT_BUSY_TIMEOUT_MS, DEFAULT_TRANSACTION_RETRIES, \
+                    DEFAULT_CLAIM_LEASE
 
 log = get_log('critical')
 
 
+def get_shard_count():
+    # ABRIM_SHARDS sqlite files for the items of a node (see sharded_storage), 1 for a single file. out.py and
+    # patch.py run a worker per shard
+    return int(os.environ.get('ABRIM_SHARDS', 1))
+
+
 class Config(object):
     def load_config(self):
         name = "Abrim"
@@ -41,10 +52,78 @@ class Config(object):
                 log.error("can't locate NODE_ID value")
                 raise
 
-    def __init__(self, node_id, port, db_prefix="", drop_db=False):
+    def __init__(self, node_id, port, db_prefix="", drop_db=False, db_profile=None, shard=None):
         if not node_id:
             self.load_config()
         else:
             self.node_id = node_id
-        self.db = DataStore(self.node_id, port, db_prefix, drop_db)
+        if not db_profile:
+            # "safe", "balanced" or "fast", see datastore.DB_PROFILES
+            db_profile = os.environ.get('ABRIM_DB_PROFILE')
+        # "full" or "delta" (saves each shadow as changes to a full one every ABRIM_SHADOW_KEYFRAME_INTERVAL revisions)
+        shadow_storage = os.environ.get('ABRIM_SHADOW_STORAGE', 'full')
+        keyframe_interval = int(os.environ.get('ABRIM_SHADOW_KEYFRAME_INTERVAL', 10))
+        # texts of at least this many characters are saved zlib compressed, 0 to disable
+        compress_threshold = int(os.environ.get('ABRIM_COMPRESS_THRESHOLD', 1024))
+        # "sqlite" or "memory" (nothing is saved to disk and every component has to run in the same process)
+        storage = os.environ.get('ABRIM_STORAGE', STORAGE_SQLITE)
+        # milliseconds a transaction waits for another one's lock (the db profile's by default) and how many times a
+        # unit of work that still found it locked is tried again, see Storage.run_transaction
+        busy_timeout = os.environ.get('ABRIM_BUSY_TIMEOUT_MS')
+        busy_timeout = int(busy_timeout) if busy_timeout else None
+        transaction_retries = int(os.environ.get('ABRIM_TRANSACTION_RETRIES', DEFAULT_TRANSACTION_RETRIES))
+        # storage calls, diffs and requests slower than this many milliseconds are logged, 0 to disable
+        get_metrics().slow_threshold_ms = int(os.environ.get('ABRIM_SLOW_QUERY_MS', DEFAULT_SLOW_THRESHOLD_MS))
+        shards = get_shard_count()
+        self.shard = shard
+        if storage == STORAGE_SQLITE and shards > 1:
+            self.db = ShardedStorage(self.node_id, port, db_prefix, drop_db, shards, profile=db_profile,
+                                     shadow_storage=shadow_storage, keyframe_interval=keyframe_interval,
+                                     compress_threshold=compress_threshold, busy_timeout=busy_timeout,
+                                     transaction_retries=transaction_retries)
+            if shard is not None:
+                # a worker that only takes care of the queues of this shard
+                self.db = self.db.only_shard(shard)
+            self.metrics_prefix = os.path.splitext(self.db.db_path)[0]
+        elif storage == STORAGE_SQLITE:
+            self.db = DataStore(self.node_id, port, db_prefix, drop_db, db_profile,
+                                shadow_storage=shadow_storage, keyframe_interval=keyframe_interval,
+                                compress_threshold=compress_threshold, busy_timeout=busy_timeout,
+                                transaction_retries=transaction_retries)
+            # each component saves its metrics next to the sqlite file, see metrics_path
+            self.metrics_prefix = os.path.splitext(self.db.db_path)[0]
+        elif storage == STORAGE_MEMORY:
+            self.db = MemoryStorage(self.node_id, port, db_prefix, drop_db,
+                                    busy_timeout=busy_timeout or DEFAULT_BUSY_TIMEOUT_MS,
+                                    transaction_retries=transaction_retries)
+            self.metrics_prefix = None
+        else:
+            log.error(f"unknown storage '{storage}', use {STORAGE_SQLITE} or {STORAGE_MEMORY}")
+            raise Exception
+        # GET handlers read through this one so they never queue behind the writers
+        self.db_read = self.db.get_reader()
         self.edit_queue_limit = 50
+        # queued edits sent (out.py) and patches applied (patch.py) per transaction
+        self.edit_batch_size = 10
+        self.patch_batch_size = 10
+        # most edits input.py takes in a bulk sync request
+        self.bulk_sync_limit = 100
+        # patch.py workers claim the posts and patches they apply as worker_id for claim_lease seconds, so several
+        # can run at once. A worker process only lasts a cycle, its pid tells it apart
+        self.worker_id = f"{self.node_id}:{os.getpid()}"
+        self.claim_lease = DEFAULT_CLAIM_LEASE
+        # old shadow revisions are deleted in batches of shadow_gc_batch_size items while patch.py is idle
+        self.shadow_gc_batch_size = 100
+        self.shadow_gc_batches = 10
+        self.legacy_archive_batch_size = 100
+        self.text_gc_batch_size = 500
+        # free pages given back to the file system per idle patch.py cycle
+        self.vacuum_pages = 256
+        # default and maximum number of items in a GET /items page
+        self.items_page_size = 1000
+
+    def metrics_path(self, component):
+        # "input", "out" or "patch". None with the memory storage, where they all run in one process
+        if not self.metrics_prefix:
+            return None
+        return f"{self.metrics_prefix}_metrics_{component}.json"
@@ -1,23 +1,691 @@
+import copy
+import hashlib
 import os
 import random
 import sqlite3
 import sys
+import threading
+import time
 import uuid
+import zlib
+from collections import OrderedDict
 
-from util import get_log
+from archive import SegmentArchive
+from metrics import METRICS, count_rows, instrument
+from storage import Storage, TransactionError, BusyError, ARCHIVE_EDIT, ARCHIVE_PATCH, DEFAULT_TRANSACTION_RETRIES
+from util import get_log, get_crc, create_delta, apply_delta
 
 log = get_log('critical')
 
 
-class DataStore(object):
+# durability/performance trade-offs for the sqlite files. All of them use WAL so readers don't block on the writer
+# and the input, out and patch processes only serialize their writes. cache_size is in KiB when negative.
+# auto_vacuum only applies to new files, see enable_incremental_vacuum for the older ones
+DB_PROFILES = {
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",  # fsync on every commit
+        "cache_size": -8000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,
+        "auto_vacuum": "INCREMENTAL",  # free pages are given back by DataStore.incremental_vacuum
+    },
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",  # a power loss can roll back the latest commits, but the file never corrupts
+        "cache_size": -32000,
+        "mmap_size": 64 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+        "auto_vacuum": "INCREMENTAL",
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",  # the OS decides when to flush. Only for nodes that can resync from their peers
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 2000,
+        "auto_vacuum": "INCREMENTAL",
+    },
+}
+DEFAULT_DB_PROFILE = "safe"
+
+
+def _text_ref_triggers(table, column):
+    # keeps texts.refs in step with the rows of table pointing to a text through column. The count goes up before
+    # it goes down so a row replaced with the same text never sees it at 0
+    return (
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_{column}_insert
+            AFTER INSERT ON {table}
+            WHEN NEW.{column} IS NOT NULL
+            BEGIN
+                UPDATE texts SET refs = refs + 1 WHERE hash = NEW.{column};
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_{column}_update
+            AFTER UPDATE OF {column} ON {table}
+            BEGIN
+                UPDATE texts SET refs = refs + 1 WHERE hash = NEW.{column};
+                UPDATE texts SET refs = refs - 1 WHERE hash = OLD.{column};
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_{column}_delete
+            AFTER DELETE ON {table}
+            WHEN OLD.{column} IS NOT NULL
+            BEGIN
+                UPDATE texts SET refs = refs - 1 WHERE hash = OLD.{column};
+            END""",
+    )
+
+
+# each entry upgrades the schema by one version (PRAGMA user_version). Entries are tuples of statements run in a
+# single transaction, or callables that get the DataStore. Once released never edit an entry, append a new one
+MIGRATIONS = [
+    # 1: base schema
+    (
+        """CREATE TABLE IF NOT EXISTS nodes
+        (id TEXT PRIMARY KEY NOT NULL,
+         base_url TEXT
+         )""",
+        """CREATE TABLE IF NOT EXISTS posts
+        (item TEXT NOT NULL,
+         text TEXT,
+         node TEXT NOT NULL,
+         crc INTEGER NOT NULL,
+         status TEXT NOT NULL,
+         FOREIGN KEY(node) REFERENCES nodes(id)
+         )""",
+        """CREATE TABLE IF NOT EXISTS items
+        (id TEXT PRIMARY KEY NOT NULL,
+         text TEXT,
+         node TEXT NOT NULL,
+         crc INTEGER NOT NULL,
+         FOREIGN KEY(node) REFERENCES nodes(id)
+         )""",
+        """CREATE TABLE IF NOT EXISTS shadows
+        (item TEXT NOT NULL,
+         other_node TEXT NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         shadow TEXT,
+         crc INTEGER NOT NULL,
+         PRIMARY KEY(item, other_node, n_rev, m_rev),
+         FOREIGN KEY(item) REFERENCES items(id),
+         FOREIGN KEY(other_node) REFERENCES nodes(id)
+         )""",
+        """CREATE TABLE IF NOT EXISTS edits
+        (
+         item TEXT NOT NULL,
+         other_node TEXT NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         edits TEXT,
+         hash TEXT,
+         old_shadow TEXT,
+         PRIMARY KEY(item, other_node, n_rev),
+         FOREIGN KEY(item) REFERENCES items(id),
+         FOREIGN KEY(other_node) REFERENCES nodes(id)
+         )""",
+        """CREATE TABLE IF NOT EXISTS edits_archive
+        (
+         item TEXT NOT NULL,
+         other_node TEXT NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         edits TEXT,
+         hash TEXT,
+         old_shadow TEXT,
+         PRIMARY KEY(item, other_node, n_rev),
+         FOREIGN KEY(item) REFERENCES items(id),
+         FOREIGN KEY(other_node) REFERENCES nodes(id)
+         )""",
+        """CREATE TABLE IF NOT EXISTS patches
+        (
+         item TEXT NOT NULL,
+         other_node TEXT NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         patches TEXT,
+         crc INTEGER NOT NULL,
+         PRIMARY KEY(item, other_node, n_rev),
+         FOREIGN KEY(item) REFERENCES items(id),
+         FOREIGN KEY(other_node) REFERENCES nodes(id)
+         )""",
+        """CREATE TABLE IF NOT EXISTS patches_archive
+        (
+         item TEXT NOT NULL,
+         other_node TEXT NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         patches TEXT,
+         crc INTEGER NOT NULL,
+         PRIMARY KEY(item, other_node, n_rev),
+         FOREIGN KEY(item) REFERENCES items(id),
+         FOREIGN KEY(other_node) REFERENCES nodes(id)
+         )""",
+    ),
+    # 2: indexes for the queue lookups
+    (
+        """CREATE INDEX IF NOT EXISTS posts_status
+           ON posts(status)""",
+        """CREATE INDEX IF NOT EXISTS edits_other_node
+           ON edits(other_node, n_rev)""",
+        """CREATE INDEX IF NOT EXISTS patches_other_node
+           ON patches(other_node, m_rev, n_rev)""",
+    ),
+    # 3: archived edits and patches go to segment files, this only says where each one is
+    (
+        """CREATE TABLE IF NOT EXISTS archive_index
+        (
+         kind TEXT NOT NULL,
+         item TEXT NOT NULL,
+         other_node TEXT NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         segment TEXT NOT NULL,
+         offset INTEGER NOT NULL,
+         length INTEGER NOT NULL,
+         PRIMARY KEY(kind, item, other_node, n_rev)
+         )""",
+    ),
+    # 4: shadows can be saved as a delta against a keyframe, the full shadow of the revision base_n_rev - base_m_rev
+    (
+        """ALTER TABLE shadows ADD COLUMN base_n_rev INTEGER""",
+        """ALTER TABLE shadows ADD COLUMN base_m_rev INTEGER""",
+    ),
+    # 5: the same text is usually saved as the item and as a shadow for every node, so items, shadows and queued
+    # edits point to a shared copy by its sha256 instead. Rows saved before keep their text inline
+    (
+        """CREATE TABLE IF NOT EXISTS texts
+        (hash BLOB PRIMARY KEY NOT NULL,
+         text TEXT,
+         refs INTEGER NOT NULL
+         )""",
+        """CREATE INDEX IF NOT EXISTS texts_unreferenced
+           ON texts(hash) WHERE refs <= 0""",
+        """ALTER TABLE items ADD COLUMN text_hash BLOB""",
+        """ALTER TABLE shadows ADD COLUMN shadow_hash BLOB""",
+        """ALTER TABLE edits ADD COLUMN old_shadow_hash BLOB""",
+        *_text_ref_triggers("items", "text_hash"),
+        *_text_ref_triggers("shadows", "shadow_hash"),
+        *_text_ref_triggers("edits", "old_shadow_hash"),
+    ),
+    # 6: the posts queue has its own file, see DataStore._init_posts
+    (
+        lambda store: store._move_posts_out(),
+        """DROP TABLE posts""",
+    ),
+    # 7: patch.py workers claim the patches they apply for a while, see DataStore.claim_patches
+    (
+        """ALTER TABLE patches ADD COLUMN claimed_by TEXT""",
+        """ALTER TABLE patches ADD COLUMN lease_until REAL""",
+        """CREATE INDEX IF NOT EXISTS patches_claimed
+           ON patches(claimed_by) WHERE claimed_by IS NOT NULL""",
+    ),
+    # 8: shadows, edits, patches and archive_index point to the item and the other node by an INTEGER key instead of
+    # repeating their ids, see DataStore._key. The old archive tables are only drained, they keep the ids
+    (
+        """CREATE TABLE item_keys
+        (key INTEGER PRIMARY KEY,
+         id TEXT UNIQUE NOT NULL
+         )""",
+        """CREATE TABLE node_keys
+        (key INTEGER PRIMARY KEY,
+         id TEXT UNIQUE NOT NULL
+         )""",
+        """INSERT INTO item_keys (id)
+           SELECT item FROM shadows
+           UNION SELECT item FROM edits
+           UNION SELECT item FROM patches
+           UNION SELECT item FROM archive_index""",
+        """INSERT INTO node_keys (id)
+           SELECT other_node FROM shadows
+           UNION SELECT other_node FROM edits
+           UNION SELECT other_node FROM patches
+           UNION SELECT other_node FROM archive_index""",
+        """CREATE TABLE shadows_keyed
+        (item_key INTEGER NOT NULL,
+         other_node_key INTEGER NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         shadow TEXT,
+         crc INTEGER NOT NULL,
+         base_n_rev INTEGER,
+         base_m_rev INTEGER,
+         shadow_hash BLOB,
+         PRIMARY KEY(item_key, other_node_key, n_rev, m_rev)
+         )""",
+        """INSERT INTO shadows_keyed
+           (rowid, item_key, other_node_key, n_rev, m_rev, shadow, crc, base_n_rev, base_m_rev, shadow_hash)
+           SELECT shadows.rowid, item_keys.key, node_keys.key, n_rev, m_rev, shadow, crc, base_n_rev, base_m_rev,
+                  shadow_hash
+           FROM shadows
+           JOIN item_keys ON item_keys.id = shadows.item
+           JOIN node_keys ON node_keys.id = shadows.other_node""",
+        """DROP TABLE shadows""",
+        """ALTER TABLE shadows_keyed RENAME TO shadows""",
+        """CREATE TABLE edits_keyed
+        (item_key INTEGER NOT NULL,
+         other_node_key INTEGER NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         edits TEXT,
+         hash TEXT,
+         old_shadow TEXT,
+         old_shadow_hash BLOB,
+         PRIMARY KEY(item_key, other_node_key, n_rev)
+         )""",
+        """INSERT INTO edits_keyed
+           (rowid, item_key, other_node_key, n_rev, m_rev, edits, hash, old_shadow, old_shadow_hash)
+           SELECT edits.rowid, item_keys.key, node_keys.key, n_rev, m_rev, edits, hash, old_shadow, old_shadow_hash
+           FROM edits
+           JOIN item_keys ON item_keys.id = edits.item
+           JOIN node_keys ON node_keys.id = edits.other_node""",
+        """DROP TABLE edits""",
+        """ALTER TABLE edits_keyed RENAME TO edits""",
+        """CREATE INDEX edits_other_node
+           ON edits(other_node_key, n_rev)""",
+        """CREATE TABLE patches_keyed
+        (item_key INTEGER NOT NULL,
+         other_node_key INTEGER NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         patches TEXT,
+         crc INTEGER NOT NULL,
+         claimed_by TEXT,
+         lease_until REAL,
+         PRIMARY KEY(item_key, other_node_key, n_rev)
+         )""",
+        """INSERT INTO patches_keyed
+           (rowid, item_key, other_node_key, n_rev, m_rev, patches, crc, claimed_by, lease_until)
+           SELECT patches.rowid, item_keys.key, node_keys.key, n_rev, m_rev, patches, crc, claimed_by, lease_until
+           FROM patches
+           JOIN item_keys ON item_keys.id = patches.item
+           JOIN node_keys ON node_keys.id = patches.other_node""",
+        """DROP TABLE patches""",
+        """ALTER TABLE patches_keyed RENAME TO patches""",
+        """CREATE INDEX patches_other_node
+           ON patches(other_node_key, m_rev, n_rev)""",
+        """CREATE INDEX patches_claimed
+           ON patches(claimed_by) WHERE claimed_by IS NOT NULL""",
+        # small rows only looked up by their key
+        """CREATE TABLE archive_index_keyed
+        (kind TEXT NOT NULL,
+         item_key INTEGER NOT NULL,
+         other_node_key INTEGER NOT NULL,
+         n_rev INTEGER NOT NULL,
+         m_rev INTEGER NOT NULL,
+         segment TEXT NOT NULL,
+         offset INTEGER NOT NULL,
+         length INTEGER NOT NULL,
+         PRIMARY KEY(kind, item_key, other_node_key, n_rev)
+         ) WITHOUT ROWID""",
+        """INSERT INTO archive_index_keyed
+           (kind, item_key, other_node_key, n_rev, m_rev, segment, offset, length)
+           SELECT kind, item_keys.key, node_keys.key, n_rev, m_rev, segment, offset, length
+           FROM archive_index
+           JOIN item_keys ON item_keys.id = archive_index.item
+           JOIN node_keys ON node_keys.id = archive_index.other_node""",
+        """DROP TABLE archive_index""",
+        """ALTER TABLE archive_index_keyed RENAME TO archive_index""",
+        # the old triggers went away with their tables
+        *_text_ref_triggers("shadows", "shadow_hash"),
+        *_text_ref_triggers("edits", "old_shadow_hash"),
+    ),
+    # 9: queued edits that already went to the other node in the answer to one of its syncs, see
+    # DataStore.mark_edits_piggybacked
+    (
+        """ALTER TABLE edits ADD COLUMN piggybacked INTEGER NOT NULL DEFAULT 0""",
+    ),
+]
+
+# large texts are saved as a BLOB: this marker byte and then the zlib compressed utf-8 text. Plain TEXT values are
+# never compressed, so rows saved before (or under the threshold) are read as they are
+COMPRESSED_MARKER = b'\x01'
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+
+def pack_text(text, threshold):
+    if not text or not threshold or len(text) < threshold:
+        return text
+    packed = COMPRESSED_MARKER + zlib.compress(text.encode())
+    if len(packed) >= len(text):
+        return text
+    return packed
+
+
+def unpack_text(value):
+    if not isinstance(value, bytes):
+        return value
+    if value[:1] != COMPRESSED_MARKER:
+        log.error(f"unknown text encoding {value[:1]}")
+        raise Exception
+    return zlib.decompress(value[1:]).decode()
+
+
+SHADOW_STORAGE_FULL = "full"
+SHADOW_STORAGE_DELTA = "delta"
+
+
+def get_db_profile(profile):
+    if not profile:
+        profile = DEFAULT_DB_PROFILE
+    try:
+        return DB_PROFILES[profile]
+    except KeyError:
+        log.error(f"unknown db profile '{profile}', use one of: {', '.join(DB_PROFILES)}")
+        raise
+
+
+POSTS_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS posts
+    (item TEXT NOT NULL,
+     text TEXT,
+     node TEXT NOT NULL,
+     crc INTEGER NOT NULL,
+     status TEXT NOT NULL,
+     claimed_by TEXT,
+     lease_until REAL
+     )""",
+    """CREATE INDEX IF NOT EXISTS posts_status
+       ON posts(status)""",
+)
+# added to posts files created before them
+POSTS_LEASE_COLUMNS = (("claimed_by", "TEXT"), ("lease_until", "REAL"))
+
+
+def get_posts_pragmas(profile):
+    # the posts file only holds the queue of texts saved from the UI: same journaling and durability as the node,
+    # but a small cache and no mmap
+    return dict(profile, cache_size=-2000, mmap_size=0)
+
+
+DEFAULT_READ_CACHE_SIZE = 1024
+# committed item and node keys a pool remembers, see DataStore._key
+KEY_CACHE_SIZE = 65536
+
+
+class ReadCache(object):
+    # LRU of committed rows for the hot lookups (items, latest revs, known nodes) read through one pool. The
+    # transactions of this process drop the keys they wrote when they commit, and commits of any other connection
+    # (or process) show up as a new PRAGMA data_version, which empties it. A value read before an invalidation
+    # isn't put back: put() only takes values of the current generation
+
+    def __init__(self, max_size=DEFAULT_READ_CACHE_SIZE):
+        self.max_size = max_size
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._data_versions = {}
+
+    def check(self, con):
+        # data_version only changes for commits of other connections, so every connection keeps its own
+        data_version = con.execute("PRAGMA data_version").fetchone()[0]
+        with self._lock:
+            if self._data_versions.get(id(con)) != data_version:
+                self._data_versions[id(con)] = data_version
+                self._clear()
+            return self.generation
+
+    def forget(self, con):
+        with self._lock:
+            self._data_versions.pop(id(con), None)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return False, None
+            self._entries[key] = value
+            return True, value
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._entries.clear()
+        self.generation += 1
+
+
+def _pragma_order(pragma):
+    return {"busy_timeout": 0, "auto_vacuum": 1}.get(pragma[0], 2)
+
+
+def _is_busy(err):
+    # SQLITE_BUSY: another connection held the lock for longer than busy_timeout
+    return "locked" in str(err) or "busy" in str(err)
+
+
+class CountingCursor(sqlite3.Cursor):
+    # counts the rows each statement reads or writes for the metrics
+
+    def execute(self, *args):
+        super().execute(*args)
+        if self.rowcount > 0:
+            count_rows(self.rowcount)
+        return self
+
+    def executemany(self, *args):
+        super().executemany(*args)
+        if self.rowcount > 0:
+            count_rows(self.rowcount)
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            count_rows(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = super().fetchmany(*args)
+        count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        count_rows(len(rows))
+        return rows
+
+
+class ConnectionPool(object):
+    # process-wide pool for one database file. A thread borrows a connection the first time it needs one and keeps
+    # it until release() so every statement of a request or a worker cycle runs on the same connection
+
+    def __init__(self, db_path, pragmas=None, max_idle=8, read_only=False, read_cache_size=DEFAULT_READ_CACHE_SIZE):
+        self.db_path = db_path
+        self.pragmas = pragmas or {}
+        self.read_only = read_only
+        self.read_cache = ReadCache(read_cache_size)
+        # (item_keys or node_keys, id): key. Keys never change once committed
+        self.keys = {}
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+        self.initialized = False
+        self.lock = threading.RLock()
+        self._idle = []
+        self._local = threading.local()
+
+    def _connect(self):
+        if self.read_only:
+            return self._connect_read_only()
+        # connections move between threads, but only one thread at a time holds one
+        con = sqlite3.connect(self.db_path, check_same_thread=False)
+        # con.isolation_level = None
+        con.isolation_level = 'EXCLUSIVE'
+        con.row_factory = sqlite3.Row
+        # busy_timeout goes first so switching the journal mode also waits for the lock, and auto_vacuum before the
+        # journal mode or it doesn't take in a new file
+        for pragma, value in sorted(self.pragmas.items(), key=_pragma_order):
+            con.execute(f"PRAGMA {pragma} = {value}")
+        # INSERT OR REPLACE only fires the delete triggers that keep texts.refs right with this on
+        con.execute("PRAGMA recursive_triggers = ON")
+        return con
+
+    def _connect_read_only(self):
+        # autocommit: every SELECT reads the last committed snapshot (WAL) without waiting for the writer or
+        # holding a lock between statements. The journal mode can only be changed by the writers
+        con = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        con.isolation_level = None
+        con.row_factory = sqlite3.Row
+        for pragma, value in sorted(self.pragmas.items(), key=_pragma_order):
+            if pragma not in ("journal_mode", "synchronous", "auto_vacuum"):
+                con.execute(f"PRAGMA {pragma} = {value}")
+        con.execute("PRAGMA query_only = ON")
+        return con
+
+    def connection(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            with self.lock:
+                if self._idle:
+                    con = self._idle.pop()
+            if con is None:
+                con = self._connect()
+            self._local.con = con
+            self._local.cur = con.cursor(CountingCursor)
+        return con
+
+    def cursor(self):
+        self.connection()
+        return self._local.cur
+
+    def release(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            return
+        self._local.con = None
+        self._local.cur = None
+        if con.in_transaction:
+            log.warning("connection released with an open transaction. Rolling back!!")
+            try:
+                con.rollback()
+            except sqlite3.OperationalError as exc:
+                log.error(f"rollback crashed: {exc}")
+        with self.lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(con)
+                return
+        self._close(con)
+
+    def _close(self, con):
+        self.read_cache.forget(con)
+        con.close()
+
+    def close(self):
+        self.release()
+        with self.lock:
+            while self._idle:
+                self._close(self._idle.pop())
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_db_paths = {}
+
+
+def get_pool(db_path, pragmas=None, read_only=False, read_cache_size=DEFAULT_READ_CACHE_SIZE):
+    with _pools_lock:
+        pool = _pools.get((db_path, read_only))
+        # sqlite connections must not be shared with a forked child, so a new process starts a new pool
+        if pool is None or pool.pid != os.getpid():
+            pool = ConnectionPool(db_path, pragmas, read_only=read_only, read_cache_size=read_cache_size)
+            _pools[(db_path, read_only)] = pool
+        return pool
+
+
+def shard_path(db_path, shard):
+    return f"{os.path.splitext(db_path)[0]}_shard{shard}.sqlite"
+
+
+def posts_path(db_path):
+    return f"{os.path.splitext(db_path)[0]}_posts.sqlite"
+
+
+def get_space_usage(db_path):
+    # what the sqlite file at db_path takes: {"path", "page_size", "pages", "free_pages", "auto_vacuum", "wal_bytes",
+    # "objects"}, objects being {"name", "type", "pages", "bytes", "unused_bytes"} per table and index, the biggest
+    # first. Needs sqlite built with the dbstat virtual table
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    con.row_factory = sqlite3.Row
+    try:
+        usage = {
+            "path": db_path,
+            "page_size": con.execute("PRAGMA page_size").fetchone()[0],
+            "pages": con.execute("PRAGMA page_count").fetchone()[0],
+            "free_pages": con.execute("PRAGMA freelist_count").fetchone()[0],
+            "auto_vacuum": ("none", "full", "incremental")[con.execute("PRAGMA auto_vacuum").fetchone()[0]],
+            "wal_bytes": os.path.getsize(f"{db_path}-wal") if os.path.exists(f"{db_path}-wal") else 0,
+        }
+        try:
+            object_rows = con.execute("""SELECT dbstat.name AS name, COALESCE(sqlite_master.type, 'table') AS type,
+                                         COUNT(*) AS pages, SUM(pgsize) AS bytes, SUM(unused) AS unused_bytes
+                                         FROM dbstat
+                                         LEFT JOIN sqlite_master ON sqlite_master.name = dbstat.name
+                                         GROUP BY dbstat.name
+                                         ORDER BY bytes DESC, dbstat.name""").fetchall()
+        except sqlite3.OperationalError as err:
+            log.error(f"no dbstat in this sqlite {sqlite3.sqlite_version}: {err}")
+            raise
+        usage["objects"] = [dict(object_row) for object_row in object_rows]
+        return usage
+    finally:
+        con.close()
+
+
+def enable_incremental_vacuum(db_path):
+    # auto_vacuum can only be switched on in a file that already has tables by rebuilding it with VACUUM: it needs
+    # twice the file's size on disk and locks out the rest of the node until it's done
+    con = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        if con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("VACUUM")
+        return True
+    finally:
+        con.close()
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            if pool.pid == os.getpid():
+                pool.close()
+        _pools.clear()
+
+
+@instrument("db")
+class DataStore(Storage):
 
     # MAINTENANCE
     def get_db_path(self):
+        try:
+            self.db_path = _db_paths[(self.node_id, self.port, self.db_prefix, self.shard)]
+            return
+        except KeyError:
+            pass
         node_id = self.node_id
         port_int = self.port
         port_temp = str(port_int)
         port = port_temp[:-1]
-        filename = f'abrim_{node_id}_{port}.sqlite'
+        filename = f'{self.db_prefix}abrim_{node_id}_{port}.sqlite'
         try:
             # noinspection PyUnresolvedReferences
             import appdirs
@@ -30,7 +698,10 @@ class DataStore(object):
                 db_path = f".{os.path.basename(sys.modules['__main__'].__file__)}{filename}"
             except AttributeError:
                 db_path = f'{filename}_error.sqlite'
+        if self.shard is not None:
+            db_path = shard_path(db_path, self.shard)
         self.db_path = db_path
+        _db_paths[(self.node_id, self.port, self.db_prefix, self.shard)] = db_path
         # log.debug(self.db_path)
 
     def drop_db(self):
@@ -42,106 +713,107 @@ class DataStore(object):
             drop_tables = drop_tables + """DROP TABLE IF EXISTS """ + table['name'] + """; """
 
         self.cur.executescript(drop_tables)
+        self.cur.execute("PRAGMA user_version = 0")
 
         self.con.commit()
-
-    def _init_db(self, con, drop_db):
-        self.con = con
-        self.cur = self.con.cursor()
-
+        if self.posts_pool:
+            self.posts_pool.cursor().execute("DROP TABLE IF EXISTS posts")
+            self.posts_pool.connection().commit()
+        self.archive.clear()
+        self.pool.read_cache.clear()
+        # the keys start over, the read only pool can't keep the old ones either
+        with _pools_lock:
+            for (db_path, _), pool in _pools.items():
+                if db_path == self.db_path:
+                    pool.keys.clear()
+
+    def get_db_paths(self):
+        paths = [self.db_path]
+        if self.posts_pool:
+            paths.append(posts_path(self.db_path))
+        return paths
+
+    def incremental_vacuum(self, pages):
+        # gives up to pages free pages back to the file system, if the file is in auto_vacuum INCREMENTAL mode. The
+        # write lock is held only while they are moved, so small steps don't hold up the node. Not inside a
+        # transaction. Returns the number of pages freed
+        if self.con.in_transaction:
+            log.error("incremental_vacuum can't run inside a transaction")
+            raise TransactionError("already in a transaction")
+        self.cur.execute("PRAGMA auto_vacuum")
+        if self.cur.fetchone()[0] != 2:
+            return 0
+        self.cur.execute("PRAGMA freelist_count")
+        free_pages = self.cur.fetchone()[0]
+        if not free_pages:
+            return 0
+        try:
+            # executed once the pragma only frees a page, a script runs it to the end
+            self.cur.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        except sqlite3.OperationalError as err:
+            if _is_busy(err):
+                METRICS.increment("db.busy")
+                raise BusyError(f"could not vacuum: {err}") from err
+            raise
+        self.cur.execute("PRAGMA freelist_count")
+        freed = free_pages - self.cur.fetchone()[0]
+        self._log_debug_trans(f"incremental vacuum freed {freed} pages")
+        return freed
+
+    def get_schema_version(self):
+        self.cur.execute("PRAGMA user_version")
+        return self.cur.fetchone()[0]
+
+    def _migrate(self):
+        while True:
+            # the version is read inside the transaction because every component of the node opens the same file
+            self.start_transaction("migrating schema")
+            version = self.get_schema_version()
+            if version >= len(MIGRATIONS):
+                self.end_transaction(suppress_msg=True)
+                if version > len(MIGRATIONS):
+                    log.error(f"{self.db_path} schema version {version} is newer than this code ({len(MIGRATIONS)})")
+                    raise Exception
+                return
+            new_version = version + 1
+            try:
+                for step in MIGRATIONS[new_version - 1]:
+                    if callable(step):
+                        step(self)
+                    else:
+                        self.cur.execute(step)
+                self.cur.execute(f"PRAGMA user_version = {new_version}")
+            except Exception as err:
+                log.error(f"migration to schema version {new_version} failed: {err}")
+                self.rollback_transaction()
+                raise
+            self.end_transaction(suppress_msg=True)
+            log.info(f"{self.db_path} migrated to schema version {new_version}")
+
+    @property
+    def con(self):
+        return self.pool.connection()
+
+    @property
+    def cur(self):
+        return self.pool.cursor()
+
+    def release(self):
+        # give this thread's connection back to the pool
+        self._dirty_keys.clear()
+        self._new_keys.clear()
+        self._transaction_done()
+        self.pool.release()
+        if self.posts_pool:
+            self.posts_pool.release()
+
+    def _init_db(self, drop_db):
         if drop_db:
             self.drop_db()
 
-        self.cur.executescript("""CREATE TABLE IF NOT EXISTS nodes
-           (id TEXT PRIMARY KEY NOT NULL,
-            base_url TEXT
-            );
-
-           CREATE TABLE IF NOT EXISTS posts
-           (item TEXT NOT NULL,
-            text TEXT,
-            node TEXT NOT NULL,
-            crc INTEGER NOT NULL,
-            status TEXT NOT NULL,
-            FOREIGN KEY(node) REFERENCES nodes(id)
-            );
-
-           CREATE TABLE IF NOT EXISTS items
-           (id TEXT PRIMARY KEY NOT NULL,
-            text TEXT,
-            node TEXT NOT NULL,
-            crc INTEGER NOT NULL,
-            FOREIGN KEY(node) REFERENCES nodes(id)
-            );
-
-           CREATE TABLE IF NOT EXISTS shadows
-           (item TEXT NOT NULL,
-            other_node TEXT NOT NULL,
-            n_rev INTEGER NOT NULL,
-            m_rev INTEGER NOT NULL,
-            shadow TEXT,
-            crc INTEGER NOT NULL,
-            PRIMARY KEY(item, other_node, n_rev, m_rev),
-            FOREIGN KEY(item) REFERENCES items(id),
-            FOREIGN KEY(other_node) REFERENCES nodes(id)
-            );
-
-           CREATE TABLE IF NOT EXISTS edits
-           (
-            item TEXT NOT NULL,
-            other_node TEXT NOT NULL,
-            n_rev INTEGER NOT NULL,
-            m_rev INTEGER NOT NULL,
-            edits TEXT,
-            hash TEXT,
-            old_shadow TEXT,
-            PRIMARY KEY(item, other_node, n_rev),
-            FOREIGN KEY(item) REFERENCES items(id),
-            FOREIGN KEY(other_node) REFERENCES nodes(id)
-            );
-
-           CREATE TABLE IF NOT EXISTS edits_archive
-           (
-            item TEXT NOT NULL,
-            other_node TEXT NOT NULL,
-            n_rev INTEGER NOT NULL,
-            m_rev INTEGER NOT NULL,
-            edits TEXT,
-            hash TEXT,
-            old_shadow TEXT,
-            PRIMARY KEY(item, other_node, n_rev),
-            FOREIGN KEY(item) REFERENCES items(id),
-            FOREIGN KEY(other_node) REFERENCES nodes(id)
-            );
-
-           CREATE TABLE IF NOT EXISTS patches
-           (
-            item TEXT NOT NULL,
-            other_node TEXT NOT NULL,
-            n_rev INTEGER NOT NULL,
-            m_rev INTEGER NOT NULL,
-            patches TEXT,
-            crc INTEGER NOT NULL,
-            PRIMARY KEY(item, other_node, n_rev),
-            FOREIGN KEY(item) REFERENCES items(id),
-            FOREIGN KEY(other_node) REFERENCES nodes(id)
-            );
-
-           CREATE TABLE IF NOT EXISTS patches_archive
-           (
-            item TEXT NOT NULL,
-            other_node TEXT NOT NULL,
-            n_rev INTEGER NOT NULL,
-            m_rev INTEGER NOT NULL,
-            patches TEXT,
-            crc INTEGER NOT NULL,
-            PRIMARY KEY(item, other_node, n_rev),
-            FOREIGN KEY(item) REFERENCES items(id),
-            FOREIGN KEY(other_node) REFERENCES nodes(id)
-            );
-            """)
-
-        self.con.commit()
+        if self.posts_pool:
+            self._init_posts()
+        self._migrate()
 
         self.start_transaction()  # init the DB
         try:
@@ -171,6 +843,30 @@ class DataStore(object):
 
     # TRANSACTION
 
+    @property
+    def _transaction_code(self):
+        return getattr(self._local, 'transaction_code', None)
+
+    @_transaction_code.setter
+    def _transaction_code(self, value):
+        self._local.transaction_code = value
+
+    @property
+    def _dirty_keys(self):
+        # read cache keys written by this thread's open transaction
+        dirty_keys = getattr(self._local, 'dirty_keys', None)
+        if dirty_keys is None:
+            dirty_keys = self._local.dirty_keys = set()
+        return dirty_keys
+
+    @property
+    def _new_keys(self):
+        # item and node keys added by this thread's open transaction, see _key
+        new_keys = getattr(self._local, 'new_keys', None)
+        if new_keys is None:
+            new_keys = self._local.new_keys = {}
+        return new_keys
+
     def _get_trans_prefix(self):
         if self.con.in_transaction:
             return f"[trans-{str(self._transaction_code)}] "
@@ -182,22 +878,40 @@ class DataStore(object):
         log.debug(f"{self._get_trans_prefix()} {str(msg)}")
 
     def start_transaction(self, msg=None):
+        if self.read_only:
+            log.error("cannot start a transaction in a read only DataStore")
+            raise TransactionError("read only")
         if self.con.in_transaction:
             log.error("cannot start a transaction within a transaction. Rolling back!!")
             try:
                 self.cur.execute("rollback")
             except sqlite3.OperationalError as exc:
                 log.debug(f"rollback crashed: {exc}")
-            raise Exception
+            self._new_keys.clear()
+            self._transaction_done()
+            raise TransactionError("already in a transaction")
 
-        self.cur.execute("begin")
+        # take the write lock now: with WAL a deferred transaction that has read can't upgrade once another
+        # connection has written in between, it fails with "database is locked" without waiting busy_timeout
+        lock_wait_start = time.perf_counter()
+        try:
+            self.cur.execute("begin immediate")
+        except sqlite3.OperationalError as err:
+            METRICS.record("db.lock_wait", time.perf_counter() - lock_wait_start, detail=msg)
+            if _is_busy(err):
+                METRICS.increment("db.busy")
+                raise BusyError(f"could not start a transaction: {err}") from err
+            raise
+        self._local.transaction_started = time.perf_counter()
+        self._local.transaction_msg = msg
+        METRICS.record("db.lock_wait", self._local.transaction_started - lock_wait_start, detail=msg)
         if self.con.in_transaction:
             self._transaction_code = random.randint(0, 1000000)
             if msg:
                 self._log_debug_trans(f"transaction started: {msg}")
         else:
             log.error("NOT in_transaction")
-            raise Exception
+            raise TransactionError("not in a transaction after begin")
 
     def end_transaction(self, suppress_msg=False):
         if not self.con.in_transaction:
@@ -214,7 +928,17 @@ class DataStore(object):
 
                 if self.con.in_transaction:
                     self._log_debug_trans("transaction NOT ended")
-                    raise Exception
+                    if _is_busy(err):
+                        METRICS.increment("db.busy")
+                        raise BusyError(f"could not end the transaction: {err}") from err
+                    raise TransactionError(f"could not end the transaction: {err}") from err
+            else:
+                self._keep_keys(self._new_keys)
+        self._new_keys.clear()
+        self._transaction_done()
+        if self._dirty_keys:
+            self.pool.read_cache.invalidate(self._dirty_keys)
+            self._dirty_keys.clear()
 
     def check_transaction(self):
         if self.con.in_transaction:
@@ -222,6 +946,23 @@ class DataStore(object):
         else:
             return False
 
+    def savepoint(self):
+        if not self.con.in_transaction:
+            log.error("savepoints need a transaction")
+            raise TransactionError("not in a transaction")
+        self._local.savepoints = getattr(self._local, 'savepoints', 0) + 1
+        name = f"savepoint_{self._local.savepoints}"
+        self.cur.execute(f"SAVEPOINT {name}")
+        # the keys added after it go with the rows
+        return name, set(self._new_keys)
+
+    def rollback_to_savepoint(self, savepoint):
+        name, new_keys = savepoint
+        self._log_debug_trans(f"rolling back to {name}")
+        self.cur.execute(f"ROLLBACK TO {name}")
+        for cache_key in set(self._new_keys) - new_keys:
+            del self._new_keys[cache_key]
+
     def rollback_transaction(self, msg=""):
         if self.con.in_transaction:
             self._log_debug_trans("explicitly rolling back this transaction.")
@@ -234,33 +975,136 @@ class DataStore(object):
         if self.con.in_transaction:
             self._log_debug_trans("still in transaction...")
             log.error("rollback failed!")
-            raise Exception
+            raise TransactionError("rollback failed")
         else:
+            # the cache only had committed values for those keys
+            self._dirty_keys.clear()
+            self._new_keys.clear()
+            self._transaction_done()
             log.debug("transaction rolled back OK")
 
+    def _transaction_done(self):
+        # how long the write lock was held, from start_transaction to its end or rollback
+        started = getattr(self._local, 'transaction_started', None)
+        if started is not None:
+            self._local.transaction_started = None
+            METRICS.record("db.transaction_hold", time.perf_counter() - started, detail=self._local.transaction_msg)
+
     def sql_debug_trace(self, enable: bool):
         callb = None
         if enable:
             callb = log.debug
         self.con.set_trace_callback(callb)
 
-    def __init__(self, node_id, port, db_prefix="", drop_db=False):
+    def __init__(self, node_id, port, db_prefix="", drop_db=False, profile=None,
+                 shadow_storage=SHADOW_STORAGE_FULL, keyframe_interval=10, shadow_cache_size=256,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD, read_cache_size=DEFAULT_READ_CACHE_SIZE,
+                 busy_timeout=None, transaction_retries=DEFAULT_TRANSACTION_RETRIES, shard=None):
         if not node_id or not port:
             raise Exception
         else:
             self.node_id = node_id
             self.db_prefix = db_prefix
             self.port = port
-
-        self._transaction_code = None
+            # one of the files of a sharded_storage.ShardedStorage
+            self.shard = shard
+            self.profile = get_db_profile(profile)
+        if busy_timeout is not None:
+            # milliseconds, instead of the profile's
+            self.profile = dict(self.profile, busy_timeout=busy_timeout)
+        self.transaction_retries = transaction_retries
+        if shadow_storage not in (SHADOW_STORAGE_FULL, SHADOW_STORAGE_DELTA):
+            log.error(f"unknown shadow storage '{shadow_storage}'")
+            raise Exception
+        self.shadow_storage = shadow_storage
+        self.compress_threshold = compress_threshold
+        self.keyframe_interval = keyframe_interval
+        self.shadow_cache_size = shadow_cache_size
+        self._shadow_cache = OrderedDict()
+        self._shadow_cache_lock = threading.Lock()
+
+        self._local = threading.local()
         self.db_path = ""
         self.get_db_path()
         # log.debug("db_path: " + self.db_path)
-        with sqlite3.connect(self.db_path) as con:
-            #con.isolation_level = None
-            con.isolation_level = 'EXCLUSIVE'
-            con.row_factory = sqlite3.Row
-            self._init_db(con, drop_db)
+        self.read_cache_size = read_cache_size
+        self.pool = get_pool(self.db_path, self.profile, read_cache_size=read_cache_size)
+        # the UI posts are queued in their own file, so saving one never waits for a sync transaction. The shards of
+        # a ShardedStorage have none, its catalog takes the posts
+        self.posts_pool = None
+        if shard is None:
+            self.posts_pool = get_pool(posts_path(self.db_path), get_posts_pragmas(self.profile))
+        self.read_only = False
+        self.archive = SegmentArchive(f"{os.path.splitext(self.db_path)[0]}_archive",
+                                      fsync=self.profile["synchronous"] == "FULL")
+        # the schema and the node uuid only need to be checked the first time this process opens the file
+        with self.pool.lock:
+            if drop_db or not self.pool.initialized:
+                self._init_db(drop_db)
+                self.pool.initialized = True
+                self.release()
+
+    def get_reader(self):
+        # the same DataStore on a read only pool, for the lookups that don't need to see an open write transaction
+        reader = copy.copy(self)
+        reader._local = threading.local()
+        reader.pool = get_pool(self.db_path, self.profile, read_only=True, read_cache_size=self.read_cache_size)
+        if self.posts_pool:
+            reader.posts_pool = get_pool(posts_path(self.db_path), get_posts_pragmas(self.profile), read_only=True)
+        reader.read_only = True
+        return reader
+
+    # READ CACHE
+
+    def _cached(self, key, load):
+        # read-through the pool's cache. The keys this transaction wrote are read from the file until it commits
+        if key in self._dirty_keys:
+            return load()
+        read_cache = self.pool.read_cache
+        generation = read_cache.check(self.con)
+        found, value = read_cache.get(key)
+        if found:
+            return value
+        value = load()
+        read_cache.put(key, value, generation)
+        return value
+
+    def _written(self, key):
+        self._dirty_keys.add(key)
+
+    # KEYS
+
+    def _key(self, table, name, create=False):
+        # the INTEGER key of an item id (table item_keys) or a node id (node_keys) the other tables point to. None
+        # if it has none yet, unless create. A new key is only kept by the pool once its transaction commits, a
+        # rollback could give it to another id
+        cache_key = (table, name)
+        key = self.pool.keys.get(cache_key) or self._new_keys.get(cache_key)
+        if key is not None:
+            return key
+        self.cur.execute(f"""SELECT key FROM {table}
+                             WHERE id = ?""", (name,))
+        key_row = self.cur.fetchone()
+        if key_row:
+            self._keep_keys({cache_key: key_row["key"]})
+            return key_row["key"]
+        if not create:
+            return None
+        self.cur.execute(f"""INSERT INTO {table} (id)
+                             VALUES (?)""", (name,))
+        key = self._new_keys[cache_key] = self.cur.lastrowid
+        return key
+
+    def _keep_keys(self, keys):
+        if len(self.pool.keys) + len(keys) > KEY_CACHE_SIZE:
+            self.pool.keys.clear()
+        self.pool.keys.update(keys)
+
+    def _item_key(self, item_id, create=False):
+        return self._key("item_keys", item_id, create)
+
+    def _node_key(self, node_id, create=False):
+        return self._key("node_keys", node_id, create)
 
     # NODES
 
@@ -268,6 +1112,7 @@ class DataStore(object):
         # node_uuid = uuid.uuid4().hex
         insert = (node_uuid,
                   url)
+        self._written(("nodes",))
         self.cur.execute("""INSERT OR IGNORE INTO nodes
                            (id,
                             base_url)
@@ -276,6 +1121,10 @@ class DataStore(object):
         return node_uuid
 
     def get_known_nodes(self):
+        # copies, the callers get to change them
+        return [dict(node) for node in self._cached(("nodes",), self._get_known_nodes)]
+
+    def _get_known_nodes(self):
         self.cur.execute("""SELECT id, base_url
                        FROM nodes
                        WHERE id <> ?
@@ -289,11 +1138,12 @@ class DataStore(object):
     # REV AND SHADOW
 
     def get_latest_rev_shadow(self, other_node_id, item_id):
-        self.cur.execute("""SELECT shadow, n_rev, m_rev
+        self.cur.execute("""SELECT COALESCE(texts.text, shadows.shadow) AS shadow, n_rev, m_rev, crc, base_n_rev, base_m_rev
                 FROM shadows
-                WHERE item = ?
-                AND other_node = ?
-                ORDER BY n_rev DESC LIMIT 1""", (item_id, other_node_id,))
+                LEFT JOIN texts ON texts.hash = shadows.shadow_hash
+                WHERE item_key = ?
+                AND other_node_key = ?
+                ORDER BY n_rev DESC LIMIT 1""", (self._item_key(item_id), self._node_key(other_node_id),))
         shadow = self.cur.fetchone()
 
         if shadow is None:
@@ -304,7 +1154,7 @@ class DataStore(object):
             return n_rev, m_rev, shadow
         else:
             try:
-                return shadow['n_rev'], shadow['m_rev'], shadow['shadow']
+                return shadow['n_rev'], shadow['m_rev'], self._shadow_text(item_id, other_node_id, shadow)
             except (TypeError, IndexError) as err:
                 log.error(err)
                 raise
@@ -312,12 +1162,12 @@ class DataStore(object):
     def find_rev_shadow(self, other_node_id, item_id, n_rev, m_rev, crc):
         self.cur.execute("""SELECT crc
                 FROM shadows
-                WHERE item = ?
-                AND other_node = ?
+                WHERE item_key = ?
+                AND other_node_key = ?
                 AND n_rev = ?
                 AND m_rev = ?
                 AND crc = ?
-                """, (item_id, other_node_id,n_rev, m_rev, crc,))
+                """, (self._item_key(item_id), self._node_key(other_node_id), n_rev, m_rev, crc,))
         crc = self.cur.fetchone()
 
         try:
@@ -332,28 +1182,32 @@ class DataStore(object):
         # if n_rev == 0 and m_rev == 0:
         #    self._log_debug_trans("n_revs 0 - 0, assuming there is no shadow")
         #    return None
-        self.cur.execute("""SELECT rowid, shadow
+        self.cur.execute("""SELECT shadows.rowid AS rowid, COALESCE(texts.text, shadows.shadow) AS shadow, n_rev, m_rev, crc, base_n_rev, base_m_rev
                  FROM shadows
+                 LEFT JOIN texts ON texts.hash = shadows.shadow_hash
                  WHERE
-                 item = ? AND
-                 other_node = ? AND
+                 item_key = ? AND
+                 other_node_key = ? AND
                  n_rev = ? AND
                  m_rev = ?
-                 LIMIT 1""", (item, other_node_id, n_rev, m_rev))
+                 LIMIT 1""", (self._item_key(item), self._node_key(other_node_id), n_rev, m_rev))
         shadow_row = self.cur.fetchone()
         if not shadow_row:
             self._log_debug_trans("no shadow")
             return False, None
         else:
-            return True, shadow_row["shadow"]
+            return True, self._shadow_text(item, other_node_id, shadow_row)
 
     def get_latest_revs(self, item, other_node_id):
+        return self._cached(("revs", item, other_node_id), lambda: self._get_latest_revs(item, other_node_id))
+
+    def _get_latest_revs(self, item, other_node_id):
         self.cur.execute("""SELECT n_rev, m_rev
                  FROM shadows
                  WHERE
-                 item = ? AND
-                 other_node = ?
-                 ORDER BY n_rev DESC LIMIT 1""", (item, other_node_id,))
+                 item_key = ? AND
+                 other_node_key = ?
+                 ORDER BY n_rev DESC LIMIT 1""", (self._item_key(item), self._node_key(other_node_id),))
         revs_row = self.cur.fetchone()
         if not revs_row:
             self._log_debug_trans("no revs, returning None")
@@ -362,128 +1216,455 @@ class DataStore(object):
             return revs_row["n_rev"], revs_row["m_rev"]
 
     def delete_revs_higher_than(self, other_node_id, item_id, n_rev):
+        self._written(("revs", item_id, other_node_id))
+        item_key, other_node_key = self._item_key(item_id), self._node_key(other_node_id)
+        self.cur.execute("""SELECT shadows.rowid AS rowid, COALESCE(texts.text, shadows.shadow) AS shadow, n_rev, m_rev, crc, base_n_rev, base_m_rev
+                        FROM shadows
+                        LEFT JOIN texts ON texts.hash = shadows.shadow_hash
+                        WHERE
+                        item_key = ? AND
+                        other_node_key = ? AND
+                        n_rev <= ? AND
+                        base_n_rev > ?
+                        """, (item_key, other_node_key, n_rev, n_rev))
+        self._materialize_shadows(item_id, other_node_id, self.cur.fetchall())
         self.cur.execute("""DELETE FROM shadows
                         WHERE
-                        item = ? AND
-                        other_node = ? AND
+                        item_key = ? AND
+                        other_node_key = ? AND
                         n_rev > ?
-                        """, (item_id, other_node_id, n_rev))
+                        """, (item_key, other_node_key, n_rev))
         self._log_debug_trans(f"deleted from shadows where item = {item_id} and other_node = {other_node_id} and n_rev > {n_rev}")
 
     def save_new_shadow(self, other_node_id, item_id, new_text, n_rev, m_rev, crc):
         self._log_debug_trans(f"about to save shadow: {item_id} {other_node_id} {n_rev}")
-        insert = (item_id,
-                  other_node_id,
+        self._written(("revs", item_id, other_node_id))
+        item_key, other_node_key = self._item_key(item_id, create=True), self._node_key(other_node_id, create=True)
+        # a replaced keyframe would break the deltas based on it
+        self.cur.execute("""SELECT shadows.rowid AS rowid, COALESCE(texts.text, shadows.shadow) AS shadow, n_rev, m_rev, crc, base_n_rev, base_m_rev
+                           FROM shadows
+                           LEFT JOIN texts ON texts.hash = shadows.shadow_hash
+                           WHERE
+                           item_key = ? AND
+                           other_node_key = ? AND
+                           base_n_rev = ? AND
+                           base_m_rev = ?""", (item_key, other_node_key, n_rev, m_rev))
+        self._materialize_shadows(item_id, other_node_id, self.cur.fetchall())
+
+        shadow = new_text
+        base_n_rev = None
+        base_m_rev = None
+        if self.shadow_storage == SHADOW_STORAGE_DELTA and new_text:
+            keyframe = self._get_keyframe(other_node_key, item_key, n_rev, m_rev)
+            if keyframe:
+                delta = create_delta(unpack_text(keyframe["shadow"]), new_text)
+                if len(delta) < len(new_text):
+                    shadow = delta
+                    base_n_rev = keyframe["n_rev"]
+                    base_m_rev = keyframe["m_rev"]
+
+        if base_n_rev is None:
+            shadow, shadow_hash = self._put_text(shadow)
+        else:
+            # deltas are particular to each node, nothing to share
+            shadow, shadow_hash = pack_text(shadow, self.compress_threshold), None
+        insert = (item_key,
+                  other_node_key,
                   n_rev,
                   m_rev,
-                  new_text,
-                  crc
+                  shadow,
+                  shadow_hash,
+                  crc,
+                  base_n_rev,
+                  base_m_rev
                   )
         self.cur.execute("""INSERT OR REPLACE INTO shadows
-                           (item, other_node, n_rev, m_rev, shadow, crc)
-                           VALUES (?,?,?,?,?,?)""", insert)
-
+                           (item_key, other_node_key, n_rev, m_rev, shadow, shadow_hash, crc, base_n_rev, base_m_rev)
+                           VALUES (?,?,?,?,?,?,?,?,?)""", insert)
+
+    def _get_keyframe(self, other_node_key, item_key, n_rev, m_rev):
+        # latest full shadow older than n_rev - m_rev, unless it already has keyframe_interval deltas
+        self.cur.execute("""SELECT COALESCE(texts.text, shadows.shadow) AS shadow, n_rev, m_rev
+                           FROM shadows
+                           LEFT JOIN texts ON texts.hash = shadows.shadow_hash
+                           WHERE
+                           item_key = ? AND
+                           other_node_key = ? AND
+                           (n_rev, m_rev) < (?, ?) AND
+                           base_n_rev IS NULL
+                           ORDER BY n_rev DESC, m_rev DESC
+                           LIMIT 1""", (item_key, other_node_key, n_rev, m_rev))
+        keyframe = self.cur.fetchone()
+        if not keyframe:
+            return None
+        self.cur.execute("""SELECT COUNT(*)
+                           FROM shadows
+                           WHERE
+                           item_key = ? AND
+                           other_node_key = ? AND
+                           base_n_rev = ? AND
+                           base_m_rev = ?""", (item_key, other_node_key, keyframe["n_rev"], keyframe["m_rev"]))
+        if self.cur.fetchone()[0] + 1 >= self.keyframe_interval:
+            return None
+        return keyframe
+
+    def _shadow_text(self, item_id, other_node_id, shadow_row):
+        if shadow_row["base_n_rev"] is None:
+            return unpack_text(shadow_row["shadow"])
+        # the crc is part of the key so a replaced revision never hits an old entry
+        cache_key = (item_id, other_node_id, shadow_row["n_rev"], shadow_row["m_rev"], shadow_row["crc"])
+        with self._shadow_cache_lock:
+            text = self._shadow_cache.pop(cache_key, None)
+            if text is not None:
+                self._shadow_cache[cache_key] = text
+                return text
+        delta = unpack_text(shadow_row["shadow"])
+        self.cur.execute("""SELECT COALESCE(texts.text, shadows.shadow) AS shadow
+                 FROM shadows
+                 LEFT JOIN texts ON texts.hash = shadows.shadow_hash
+                 WHERE
+                 item_key = ? AND
+                 other_node_key = ? AND
+                 n_rev = ? AND
+                 m_rev = ?""", (self._item_key(item_id), self._node_key(other_node_id),
+                                shadow_row["base_n_rev"], shadow_row["base_m_rev"]))
+        keyframe = self.cur.fetchone()
+        if not keyframe:
+            log.error(f"missing keyframe {shadow_row['base_n_rev']}-{shadow_row['base_m_rev']} for {item_id} {other_node_id}")
+            raise Exception
+        text = apply_delta(unpack_text(keyframe["shadow"]), delta)
+        if get_crc(text) != shadow_row["crc"]:
+            log.error(f"rebuilt shadow {item_id} {other_node_id} {shadow_row['n_rev']} doesn't match its crc")
+            raise Exception
+        with self._shadow_cache_lock:
+            self._shadow_cache[cache_key] = text
+            while len(self._shadow_cache) > self.shadow_cache_size:
+                self._shadow_cache.popitem(last=False)
+        return text
+
+    def _materialize_shadows(self, item_id, other_node_id, shadow_rows):
+        # turns delta rows into keyframes before their keyframe goes away
+        updates = []
+        for shadow_row in shadow_rows:
+            if shadow_row["base_n_rev"] is not None:
+                text = self._shadow_text(item_id, other_node_id, shadow_row)
+                updates.append((*self._put_text(text), shadow_row["rowid"]))
+        if updates:
+            self.cur.executemany("""UPDATE shadows
+                                   SET shadow = ?, shadow_hash = ?, base_n_rev = NULL, base_m_rev = NULL
+                                   WHERE rowid = ?""", updates)
+            self._log_debug_trans(f"{len(updates)} shadows of {item_id} {other_node_id} saved as keyframes")
+
+    def compact_shadows(self, batch_size, after=None):
+        # differential sync only needs the current shadow and the backup one (to recover from a lost return packet),
+        # so delete the older revisions of batch_size (item, other_node) pairs, starting after the pair "after".
+        # Uses its own short transaction, so don't call it inside one. Returns the number of deleted rows and the
+        # pair to continue from, or None when the table has been fully walked. The pairs go in key order
+        if after:
+            self.cur.execute("""SELECT item_key, other_node_key, item_keys.id AS item, node_keys.id AS other_node
+                                FROM shadows
+                                JOIN item_keys ON item_keys.key = shadows.item_key
+                                JOIN node_keys ON node_keys.key = shadows.other_node_key
+                                WHERE (item_key, other_node_key) > (?, ?)
+                                GROUP BY item_key, other_node_key
+                                HAVING COUNT(*) > 2
+                                ORDER BY item_key, other_node_key
+                                LIMIT ?""", (self._item_key(after[0]), self._node_key(after[1]), batch_size))
+        else:
+            self.cur.execute("""SELECT item_key, other_node_key, item_keys.id AS item, node_keys.id AS other_node
+                                FROM shadows
+                                JOIN item_keys ON item_keys.key = shadows.item_key
+                                JOIN node_keys ON node_keys.key = shadows.other_node_key
+                                GROUP BY item_key, other_node_key
+                                HAVING COUNT(*) > 2
+                                ORDER BY item_key, other_node_key
+                                LIMIT ?""", (batch_size,))
+        pairs = [(row["item"], row["other_node"], row["item_key"], row["other_node_key"]) for row in self.cur.fetchall()]
+        if not pairs:
+            return 0, None
+
+        self.start_transaction("compact_shadows")
+        try:
+            for item, other_node, item_key, other_node_key in pairs:
+                self.cur.execute("""SELECT shadows.rowid AS rowid, COALESCE(texts.text, shadows.shadow) AS shadow, n_rev, m_rev, crc, base_n_rev, base_m_rev
+                                    FROM shadows
+                                    LEFT JOIN texts ON texts.hash = shadows.shadow_hash
+                                    WHERE
+                                    item_key = ? AND
+                                    other_node_key = ?
+                                    ORDER BY n_rev DESC, m_rev DESC
+                                    LIMIT 2""", (item_key, other_node_key))
+                kept = self.cur.fetchall()
+                kept_revs = [(row["n_rev"], row["m_rev"]) for row in kept]
+                self._materialize_shadows(item, other_node,
+                                          [row for row in kept if (row["base_n_rev"], row["base_m_rev"]) not in kept_revs])
+            self.cur.executemany("""DELETE FROM shadows
+                                    WHERE
+                                    item_key = ? AND
+                                    other_node_key = ? AND
+                                    rowid NOT IN (SELECT rowid
+                                                  FROM shadows
+                                                  WHERE
+                                                  item_key = ? AND
+                                                  other_node_key = ?
+                                                  ORDER BY n_rev DESC, m_rev DESC
+                                                  LIMIT 2)""",
+                                 [(item_key, other_node_key, item_key, other_node_key)
+                                  for _, _, item_key, other_node_key in pairs])
+            deleted = self.cur.rowcount
+        except Exception:
+            self.rollback_transaction()
+            raise
+        self.end_transaction(suppress_msg=True)
+        self._log_debug_trans(f"compacted shadows of {len(pairs)} items, {deleted} old revisions deleted")
+
+        if len(pairs) < batch_size:
+            return deleted, None
+        return deleted, pairs[-1][:2]
+
+
+    # TEXTS
+
+    def _put_text(self, text):
+        # saves text in the shared texts table if it isn't there yet. Returns the (inline value, hash) pair to save
+        # in the row pointing to it: the triggers of that row count the reference
+        if not text:
+            return text, None
+        text_hash = hashlib.sha256(text.encode()).digest()
+        self.cur.execute("""INSERT INTO texts (hash, text, refs)
+                            VALUES (?,?,0)
+                            ON CONFLICT(hash) DO NOTHING""", (text_hash, pack_text(text, self.compress_threshold)))
+        return None, text_hash
+
+    def delete_unreferenced_texts(self, batch_size):
+        # texts nothing points to anymore. Not done by a trigger because INSERT OR REPLACE drops the count to 0
+        # before adding the new row. Uses its own short transaction, returns the number of deleted texts
+        self.cur.execute("""SELECT hash
+                            FROM texts
+                            WHERE refs <= 0
+                            LIMIT ?""", (batch_size,))
+        hashes = [(row["hash"],) for row in self.cur.fetchall()]
+        if not hashes:
+            return 0
+        self.start_transaction("delete_unreferenced_texts")
+        try:
+            # the count is checked again, the text could have been used again since the select
+            self.cur.executemany("""DELETE FROM texts
+                                    WHERE hash = ? AND refs <= 0""", hashes)
+            deleted = self.cur.rowcount
+        except Exception:
+            self.rollback_transaction()
+            raise
+        self.end_transaction(suppress_msg=True)
+        self._log_debug_trans(f"{deleted} unreferenced texts deleted")
+        return deleted
 
     # POST
 
-    def save_new_post(self, item_id, new_text, new_text_crc):  # TODO: MAYBE REFACTOR THIS TO A SEPARATE SQLITE FILE?
-        status = "PENDING"
-        self._log_debug_trans(f"about to save post: {item_id} {new_text_crc} as {status}")
+    def _init_posts(self):
+        cur = self.posts_pool.cursor()
+        for statement in POSTS_SCHEMA:
+            cur.execute(statement)
+        cur.execute("PRAGMA table_info(posts)")
+        columns = [row["name"] for row in cur.fetchall()]
+        for column, column_type in POSTS_LEASE_COLUMNS:
+            if column not in columns:
+                cur.execute(f"ALTER TABLE posts ADD COLUMN {column} {column_type}")
+        self.posts_pool.connection().commit()
+
+    def _move_posts_out(self):
+        # migration 6: the posts saved in the node's file before it had a posts file. Copied with their rowid, so
+        # doing it again after a failed migration doesn't duplicate them
+        self.cur.execute("""SELECT rowid, item, text, node, crc, status FROM posts""")
+        posts = [tuple(post) for post in self.cur.fetchall()]
+        if posts and self.posts_pool:
+            self._posts_transaction(lambda cur: cur.executemany("""INSERT OR IGNORE INTO posts
+                                                                   (rowid, item, text, node, crc, status)
+                                                                   VALUES (?,?,?,?,?,?)""", posts))
+
+    def _posts_transaction(self, work):
+        # work(cursor) in a short write transaction of the posts file, it never joins the node's transaction
+        con = self.posts_pool.connection()
+        cur = self.posts_pool.cursor()
         try:
-            self.cur.execute("""INSERT INTO posts
+            cur.execute("begin immediate")
+        except sqlite3.OperationalError as err:
+            if _is_busy(err):
+                METRICS.increment("db.busy")
+                raise BusyError(f"could not start a posts transaction: {err}") from err
+            raise
+        try:
+            result = work(cur)
+        except BaseException:
+            con.rollback()
+            raise
+        con.commit()
+        return result
+
+    def save_new_post(self, item_id, new_text, new_text_crc):
+        status = "PENDING"
+        log.debug(f"about to save post: {item_id} {new_text_crc} as {status}")
+
+        def save_post(cur):
+            cur.execute("""INSERT INTO posts
                            (item,
                             text,
                             node,
                             crc,
                             status)
-                           VALUES (?,?,?,?,?)""", (item_id, new_text, self.node_id, new_text_crc, status))
-            self.con.commit()
-            rowid = self.cur.lastrowid
+                           VALUES (?,?,?,?,?)""", (item_id, pack_text(new_text, self.compress_threshold),
+                                                   self.node_id, new_text_crc, status))
+            return cur.lastrowid
+
+        try:
+            rowid = self._posts_transaction(save_post)
         except sqlite3.IntegrityError:
-            self._log_debug_trans(f"save_new_post: IntegrityError for {item_id} with {self.node_id}")
+            log.debug(f"save_new_post: IntegrityError for {item_id} with {self.node_id}")
             rowid = None
-        self._log_debug_trans(f"new post rowid {rowid} for {item_id} saved")
+        log.debug(f"new post rowid {rowid} for {item_id} saved")
         return rowid
 
     def get_post_status(self, queue_rowid):
+        cur = self.posts_pool.cursor()
         try:
-            self.cur.execute("""SELECT status, item
+            cur.execute("""SELECT status, item
                      FROM posts
                      WHERE
                      rowid = ?""", (queue_rowid,))
 
-            status_row = self.cur.fetchone()
+            status_row = cur.fetchone()
             if not status_row:
-                self._log_debug_trans(f"no status found for {queue_rowid}")
+                log.debug(f"no status found for {queue_rowid}")
                 return None, None
             else:
                 return status_row["status"], status_row["item"]
         except (TypeError, IndexError):
-            self._log_debug_trans(f"no status found for {queue_rowid}")
+            log.debug(f"no status found for {queue_rowid}")
             return None, None
 
     def get_post_pending(self):
+        cur = self.posts_pool.cursor()
         try:
             pending_status = "PENDING"
-            self.cur.execute("""SELECT rowid, 
+            cur.execute("""SELECT rowid, 
                         item,
                         text,
                         node,
                         crc
                      FROM posts
                      WHERE
-                     status = ?""", (pending_status,))
+                     status = ?
+                     ORDER BY rowid ASC LIMIT 1""", (pending_status,))
 
-            post_row = self.cur.fetchone()
+            post_row = cur.fetchone()
             if not post_row:
                 return None, None, None, None, None
             else:
-                return post_row["rowid"], post_row["item"], post_row["text"], post_row["node"], post_row["crc"]
+                return post_row["rowid"], post_row["item"], unpack_text(post_row["text"]), post_row["node"], post_row["crc"]
         except (TypeError, IndexError):
-            self._log_debug_trans(f"no posts found with status {pending_status}")
+            log.debug(f"no posts found with status {pending_status}")
             return None, None, None, None, None
 
+    def claim_post(self, worker, lease):
+        # the oldest pending post of an item no other worker has a post of claimed, now claimed by worker for lease
+        # seconds. An expired claim is the one of a worker that crashed or was killed, its post is taken again
+        pending_status = "PENDING"
+
+        def claim(cur):
+            now = time.time()
+            cur.execute("""SELECT rowid, item, text, node, crc
+                           FROM posts
+                           WHERE
+                           status = ? AND
+                           (claimed_by IS NULL OR claimed_by = ? OR lease_until < ?) AND
+                           item NOT IN (SELECT item
+                                        FROM posts
+                                        WHERE
+                                        status = ? AND
+                                        claimed_by != ? AND
+                                        lease_until >= ?)
+                           ORDER BY rowid ASC LIMIT 1""", (pending_status, worker, now, pending_status, worker, now))
+            post_row = cur.fetchone()
+            if not post_row:
+                return None, None, None, None, None
+            cur.execute("""UPDATE posts
+                           SET
+                           claimed_by = ?,
+                           lease_until = ?
+                           WHERE rowid = ?""", (worker, now + lease, post_row["rowid"]))
+            return post_row["rowid"], post_row["item"], unpack_text(post_row["text"]), post_row["node"], post_row["crc"]
+
+        return self._posts_transaction(claim)
+
+    def release_post(self, rowid, worker):
+        # gives back a claimed post that couldn't be applied, so any worker can take it again right away
+        def release(cur):
+            cur.execute("""UPDATE posts
+                           SET
+                           claimed_by = NULL,
+                           lease_until = NULL
+                           WHERE
+                           rowid = ? AND
+                           claimed_by = ?""", (rowid, worker))
+            return cur.rowcount > 0
+
+        return self._posts_transaction(release)
+
     def update_post_pending(self, rowid):
+        # in its own transaction of the posts file, call it once the post has been applied and committed
         pending_status = "PENDING"
         done_status = "DONE"
-        self.cur.execute("""UPDATE posts
+
+        def update_post(cur):
+            cur.execute("""UPDATE posts
                 SET
-                    status = ?
+                    status = ?,
+                    claimed_by = NULL,
+                    lease_until = NULL
                 WHERE
                     status = ? 
                     AND
                     rowid = ?""", (done_status, pending_status, rowid))
-        if self.cur.rowcount > 0:
-            return True
-        else:
-            return False
+            return cur.rowcount > 0
+
+        return self._posts_transaction(update_post)
 
     # ITEM
 
 
     def save_new_item(self, item_id, new_text, text_crc):
         self._log_debug_trans(f"about to save item: {item_id} {text_crc}")
+        self._written(("item", item_id))
+        text, text_hash = self._put_text(new_text)
         self.cur.execute("""INSERT INTO items
                        (id,
                         text,
+                        text_hash,
                         node,
                         crc)
-                       VALUES (?,?,?,?)""", (item_id, new_text, self.node_id, text_crc))
+                       VALUES (?,?,?,?,?)""", (item_id, text, text_hash, self.node_id, text_crc))
         self._log_debug_trans(f"new item {item_id} saved")
 
     def update_item(self, item_id, new_text, text_crc):
         self._log_debug_trans(f"about to save item: {item_id} {text_crc}")
+        self._written(("item", item_id))
+        text, text_hash = self._put_text(new_text)
         self.cur.execute("""INSERT OR REPLACE INTO items
                        (id,
                         text,
+                        text_hash,
                         node,
                         crc)
-                       VALUES (?,?,?,?)""", (item_id, new_text, self.node_id, text_crc))
+                       VALUES (?,?,?,?,?)""", (item_id, text, text_hash, self.node_id, text_crc))
         self._log_debug_trans(f"item {item_id} updated")
 
     def get_item(self, item_id):
-        self.cur.execute("""SELECT text, crc
+        return self._cached(("item", item_id), lambda: self._get_item(item_id))
+
+    def _get_item(self, item_id):
+        self.cur.execute("""SELECT COALESCE(texts.text, items.text) AS text, crc
                   FROM items
+                  LEFT JOIN texts ON texts.hash = items.text_hash
                   WHERE
                   id = ? AND
                   node = ?
@@ -493,88 +1674,157 @@ class DataStore(object):
             self._log_debug_trans(f"no item found for {item_id}")
             return False, None, None
         else:
-            return True, item_row["text"], item_row["crc"]
+            return True, unpack_text(item_row["text"]), item_row["crc"]
 
-    def get_items(self):
-        self.cur.execute("""SELECT id, node, crc
-                            FROM items
-                            ORDER BY id, node""")
-        items = []
-        for item in self.cur.fetchall():
-            items.append({"id": item["id"], "node": item["node"], "crc": item["crc"], })
-        return items
+    def iter_items(self, limit=None, after=None):
+        # keyset paging: up to limit items with an id greater than after, in id order. Runs on its own cursor and
+        # fetches a chunk at a time, so the caller can stream a whole page without holding it in memory
+        cur = self.con.cursor(CountingCursor)
+        try:
+            if after is None:
+                cur.execute("""SELECT id, node, crc
+                               FROM items
+                               ORDER BY id
+                               LIMIT ?""", (-1 if limit is None else limit,))
+            else:
+                cur.execute("""SELECT id, node, crc
+                               FROM items
+                               WHERE id > ?
+                               ORDER BY id
+                               LIMIT ?""", (after, -1 if limit is None else limit))
+            while True:
+                item_rows = cur.fetchmany(100)
+                if not item_rows:
+                    return
+                for item in item_rows:
+                    yield {"id": item["id"], "node": item["node"], "crc": item["crc"], }
+        finally:
+            cur.close()
 
     # EDITS
 
     def enqueue_client_edits(self, other_node_id, item_id, diffs, hash_, n_rev, m_rev, old_shadow):
         insert = (
-            item_id,
-            other_node_id,
+            self._item_key(item_id, create=True),
+            self._node_key(other_node_id, create=True),
             n_rev,
             m_rev,
             diffs,
             hash_,
-            old_shadow,
+            *self._put_text(old_shadow),
         )
         try:
             self.cur.execute("""INSERT INTO edits
-                               (item, other_node, n_rev, m_rev, edits, hash, old_shadow)
-                               VALUES (?,?,?,?,?,?,?)""", insert)
+                               (item_key, other_node_key, n_rev, m_rev, edits, hash, old_shadow, old_shadow_hash)
+                               VALUES (?,?,?,?,?,?,?,?)""", insert)
         except sqlite3.InterfaceError as err:
             self._log_debug_trans(f"ERROR ({str(err)}) AT INSERT VALUES: {item_id}, {other_node_id}, {n_rev}, {m_rev}, {diffs}, {hash_}, {old_shadow}")
             raise
 
         self._log_debug_trans(f"edits {item_id} {other_node_id} {n_rev} saved")
 
-    def get_first_queued_edit(self, other_node_id):
-        self.cur.execute("""SELECT rowid, *
+    def get_queued_edits(self, other_node_id, limit):
+        self.cur.execute("""SELECT edits.rowid AS rowid, item_keys.id AS item, node_keys.id AS other_node, n_rev, m_rev,
+                 edits, edits.hash AS hash, COALESCE(texts.text, edits.old_shadow) AS old_shadow, piggybacked
                  FROM edits
+                 JOIN item_keys ON item_keys.key = edits.item_key
+                 JOIN node_keys ON node_keys.key = edits.other_node_key
+                 LEFT JOIN texts ON texts.hash = edits.old_shadow_hash
                  WHERE
-                 other_node = ?
-                 ORDER BY n_rev ASC LIMIT 1""", (other_node_id,))
-        edit_row = self.cur.fetchone()
-        try:
-            return dict(edit_row)
-        except TypeError:
-            return None
-
-    def archive_edit(self, edit_rowid):
-        self.cur.execute("""INSERT INTO edits_archive
-                           SELECT * FROM edits
-                           WHERE rowid=?""", (edit_rowid,))
-        self._log_debug_trans(f"edit rowid {edit_rowid} archived")
-
-    def delete_edit(self, edit_rowid):
-        self.cur.execute("""DELETE FROM edits
-                           WHERE rowid=?""", (edit_rowid,))
-        self._log_debug_trans(f"edit rowid {edit_rowid} deleted")
+                 other_node_key = ?
+                 ORDER BY n_rev ASC LIMIT ?""", (self._node_key(other_node_id), limit))
+        edits = []
+        for edit_row in self.cur.fetchall():
+            edit = dict(edit_row)
+            edit["old_shadow"] = unpack_text(edit["old_shadow"])
+            edits.append(edit)
+        return edits
+
+    def get_item_queued_edits(self, other_node_id, item_id, limit):
+        item_key = self._item_key(item_id)
+        node_key = self._node_key(other_node_id)
+        if item_key is None or node_key is None:
+            return []
+        self.cur.execute("""SELECT edits.rowid AS rowid, n_rev, m_rev, edits, edits.hash AS hash, piggybacked
+                 FROM edits
+                 WHERE
+                 item_key = ? AND
+                 other_node_key = ?
+                 ORDER BY n_rev ASC LIMIT ?""", (item_key, node_key, limit))
+        edits = []
+        for edit_row in self.cur.fetchall():
+            edits.append(dict(edit_row, item=item_id, other_node=other_node_id))
+        return edits
+
+    def archive_edits(self, edit_rowids):
+        edits = []
+        for edit_rowid in edit_rowids:
+            self.cur.execute("""SELECT item_keys.id AS item, node_keys.id AS other_node, n_rev, m_rev, edits,
+                               edits.hash AS hash, COALESCE(texts.text, edits.old_shadow) AS old_shadow
+                               FROM edits
+                               JOIN item_keys ON item_keys.key = edits.item_key
+                               JOIN node_keys ON node_keys.key = edits.other_node_key
+                               LEFT JOIN texts ON texts.hash = edits.old_shadow_hash
+                               WHERE edits.rowid=?""", (edit_rowid,))
+            edit_row = self.cur.fetchone()
+            if edit_row:
+                edit = dict(edit_row)
+                edit["old_shadow"] = unpack_text(edit["old_shadow"])
+                edits.append(edit)
+        self._archive_rows(ARCHIVE_EDIT, edits)
+        self._log_debug_trans(f"edit rowids {list(edit_rowids)} archived")
+
+    def mark_edits_piggybacked(self, edit_rowids):
+        self.cur.executemany("""UPDATE edits SET piggybacked = 1
+                               WHERE rowid=?""", [(edit_rowid,) for edit_rowid in edit_rowids])
+
+    def delete_edits(self, edit_rowids):
+        self.cur.executemany("""DELETE FROM edits
+                               WHERE rowid=?""", [(edit_rowid,) for edit_rowid in edit_rowids])
+        self._log_debug_trans(f"edit rowids {list(edit_rowids)} deleted")
 
 
     # PATCHES
 
+    def _patch_keys(self, patch_keys):
+        # (item_key, other_node_key, n_rev) of (item, other_node, n_rev) tuples
+        return [(self._item_key(item), self._node_key(other_node), n_rev) for item, other_node, n_rev in patch_keys]
+
     def save_new_patches(self, other_node_id, item_id, patches, n_rev, m_rev, crc):
         self._log_debug_trans(f"about to save patch: {item_id} {other_node_id} {n_rev}")
-        insert = (item_id,
-                  other_node_id,
+        insert = (self._item_key(item_id, create=True),
+                  self._node_key(other_node_id, create=True),
                   n_rev,
                   m_rev,
                   patches,
                   crc
                   )
         self.cur.execute("""INSERT OR REPLACE INTO patches
-                           (item, other_node, n_rev, m_rev, patches, crc)
+                           (item_key, other_node_key, n_rev, m_rev, patches, crc)
                            VALUES (?,?,?,?,?,?)""", insert)
 
     def check_if_patch_done(self, other_node_id, item_id, n_rev, m_rev):
         self.cur.execute("""SELECT n_rev, m_rev
-                 FROM patches_archive
+                 FROM archive_index
                  WHERE
-                 item = ? AND
-                 other_node = ? AND
+                 kind = ? AND
+                 item_key = ? AND
+                 other_node_key = ? AND
                  n_rev = ? AND
                  m_rev = ?
-                 LIMIT 1""", (item_id, other_node_id, n_rev, m_rev))
+                 LIMIT 1""", (ARCHIVE_PATCH, self._item_key(item_id), self._node_key(other_node_id), n_rev, m_rev))
         patch_row = self.cur.fetchone()
+        if not patch_row:
+            # archived before the segment files existed and not moved yet
+            self.cur.execute("""SELECT n_rev, m_rev
+                     FROM patches_archive
+                     WHERE
+                     item = ? AND
+                     other_node = ? AND
+                     n_rev = ? AND
+                     m_rev = ?
+                     LIMIT 1""", (item_id, other_node_id, n_rev, m_rev))
+            patch_row = self.cur.fetchone()
         if not patch_row:
             self._log_debug_trans("server has still not applied the patch")
             return False
@@ -582,11 +1832,25 @@ class DataStore(object):
             self._log_debug_trans("server has correctly applied the patch")
             return True
 
+    def check_if_patch_received(self, other_node_id, item_id, n_rev, m_rev):
+        self.cur.execute("""SELECT n_rev
+                 FROM patches
+                 WHERE
+                 item_key = ? AND
+                 other_node_key = ? AND
+                 n_rev = ? AND
+                 m_rev = ?""", (self._item_key(item_id), self._node_key(other_node_id), n_rev, m_rev))
+        if self.cur.fetchone():
+            return True
+        return self.check_if_patch_done(other_node_id, item_id, n_rev, m_rev)
+
     def get_nodes_from_patches(self):
-        self.cur.execute("""SELECT DISTINCT other_node
+        # oldest pending patch first. The GROUP BY walks patches_other_node, only the node list gets sorted
+        self.cur.execute("""SELECT node_keys.id AS other_node
                             FROM patches
-                            GROUP BY other_node
-                            ORDER BY rowid""")
+                            JOIN node_keys ON node_keys.key = patches.other_node_key
+                            GROUP BY other_node_key
+                            ORDER BY MIN(patches.rowid)""")
         nodes = self.cur.fetchall()
         node_ids = []
         if nodes:
@@ -594,38 +1858,160 @@ class DataStore(object):
                 node_ids.append(node["other_node"])
         return node_ids
 
-    def check_first_patch(self, other_node):
-        self.cur.execute("""SELECT item, other_node, n_rev, m_rev, patches, crc
+    def get_first_patches(self, other_node, limit):
+        self.cur.execute("""SELECT item_keys.id AS item, n_rev, m_rev, patches, crc
                             FROM patches
-                            WHERE other_node = ?
-                            ORDER BY m_rev, n_rev, rowid ASC
-                            LIMIT 1""", (other_node,))
-        patch_row = self.cur.fetchone()
-        if not patch_row:
-            return None
-        else:
+                            JOIN item_keys ON item_keys.key = patches.item_key
+                            WHERE other_node_key = ?
+                            ORDER BY m_rev, n_rev, patches.rowid ASC
+                            LIMIT ?""", (self._node_key(other_node), limit))
+        patches = []
+        for patch_row in self.cur.fetchall():
             item = patch_row["item"]
-            other_node = patch_row["other_node"]
             n_rev = patch_row["n_rev"]
             m_rev = patch_row["m_rev"]
-            patches = patch_row["patches"]
+            patch = patch_row["patches"]
             crc = patch_row["crc"]
-            return item, other_node, n_rev, m_rev, patches, crc
+            patches.append((item, other_node, n_rev, m_rev, patch, crc))
+        return patches
+
+    def claim_patches(self, other_node, worker, limit, lease):
+        # like get_first_patches, but only of items no other worker has patches of claimed, and they stay claimed
+        # by worker for lease seconds. Uses its own short transaction, so don't call it inside one
+        def claim():
+            now = time.time()
+            other_node_key = self._node_key(other_node)
+            self.cur.execute("""SELECT item_key, item_keys.id AS item, n_rev, m_rev, patches, crc
+                                FROM patches
+                                JOIN item_keys ON item_keys.key = patches.item_key
+                                WHERE
+                                other_node_key = ? AND
+                                (claimed_by IS NULL OR claimed_by = ? OR lease_until < ?) AND
+                                item_key NOT IN (SELECT item_key
+                                                 FROM patches
+                                                 WHERE
+                                                 claimed_by != ? AND
+                                                 lease_until >= ?)
+                                ORDER BY m_rev, n_rev, patches.rowid ASC
+                                LIMIT ?""", (other_node_key, worker, now, worker, now, limit))
+            patch_rows = self.cur.fetchall()
+            self.cur.executemany("""UPDATE patches
+                                    SET
+                                    claimed_by = ?,
+                                    lease_until = ?
+                                    WHERE
+                                    item_key = ? AND
+                                    other_node_key = ? AND
+                                    n_rev = ?""", [(worker, now + lease, patch_row["item_key"], other_node_key,
+                                                    patch_row["n_rev"]) for patch_row in patch_rows])
+            return [(patch_row["item"], other_node, patch_row["n_rev"], patch_row["m_rev"], patch_row["patches"],
+                     patch_row["crc"]) for patch_row in patch_rows]
+
+        return self.run_transaction(claim, "claim patches")
+
+    def release_patches(self, patch_keys, worker):
+        # gives back claimed patches that couldn't be applied. Uses its own short transaction
+        def release():
+            self.cur.executemany("""UPDATE patches
+                                    SET
+                                    claimed_by = NULL,
+                                    lease_until = NULL
+                                    WHERE
+                                    item_key = ? AND
+                                    other_node_key = ? AND
+                                    n_rev = ? AND
+                                    claimed_by = ?""", [(*patch_key, worker)
+                                                        for patch_key in self._patch_keys(patch_keys)])
+
+        self.run_transaction(release, "release patches")
+
+    def archive_patches(self, patch_keys):
+        # patch_keys: (item, other_node, n_rev) tuples
+        patches = []
+        for item, other_node, n_rev in patch_keys:
+            self.cur.execute("""SELECT n_rev, m_rev, patches, crc
+                               FROM patches
+                               WHERE
+                               item_key = ? AND
+                               other_node_key = ? AND
+                               n_rev = ?
+                               """, (self._item_key(item), self._node_key(other_node), n_rev))
+            patch_row = self.cur.fetchone()
+            if patch_row:
+                patches.append(dict(patch_row, item=item, other_node=other_node))
+        self._archive_rows(ARCHIVE_PATCH, patches)
+        self._log_debug_trans(f"patches {list(patch_keys)} archived")
+
+    def delete_patches(self, patch_keys):
+        self.cur.executemany("""DELETE FROM patches
+                               WHERE
+                               item_key = ? AND
+                               other_node_key = ? AND
+                               n_rev = ?""", self._patch_keys(patch_keys))
+        self._log_debug_trans(f"patches {list(patch_keys)} deleted")
+
+    # ARCHIVE
+
+    def _archive_rows(self, kind, rows):
+        # the records are appended before the index rows are saved, so a rollback only leaves unreachable records
+        index_rows = []
+        for row, (segment, offset, length) in zip(rows, self.archive.append_many(kind, rows)):
+            index_rows.append((kind, self._item_key(row["item"], create=True),
+                               self._node_key(row["other_node"], create=True), row["n_rev"], row["m_rev"], segment,
+                               offset, length))
+        self.cur.executemany("""INSERT OR REPLACE INTO archive_index
+                               (kind, item_key, other_node_key, n_rev, m_rev, segment, offset, length)
+                               VALUES (?,?,?,?,?,?,?,?)""", index_rows)
+
+    def get_archived(self, kind, item, other_node, n_rev):
+        self.cur.execute("""SELECT segment, offset, length
+                 FROM archive_index
+                 WHERE
+                 kind = ? AND
+                 item_key = ? AND
+                 other_node_key = ? AND
+                 n_rev = ?""", (kind, self._item_key(item), self._node_key(other_node), n_rev))
+        index_row = self.cur.fetchone()
+        if not index_row:
+            return None
+        return self.archive.read(index_row["segment"], index_row["offset"], index_row["length"])
 
-    def archive_patch(self, item, other_node, n_rev):
-        self.cur.execute("""INSERT INTO patches_archive
-                           SELECT * FROM patches
-                           WHERE
-                           item = ? AND
-                           other_node = ? AND
-                           n_rev = ?
-                           """, (item, other_node, n_rev,))
-        self._log_debug_trans(f"edit rowid {item} {other_node} {n_rev} archived")
-
-    def delete_patch(self, item, other_node, n_rev):
-        self.cur.execute("""DELETE FROM patches
-                           WHERE
-                           item = ? AND
-                           other_node = ? AND
-                           n_rev = ?""", (item, other_node, n_rev,))
-        self._log_debug_trans(f"edit rowid {item} {other_node} {n_rev} deleted")
+    def get_archived_revs(self, kind, item):
+        self.cur.execute("""SELECT node_keys.id AS other_node, n_rev, m_rev
+                 FROM archive_index
+                 JOIN node_keys ON node_keys.key = archive_index.other_node_key
+                 WHERE
+                 kind = ? AND
+                 item_key = ?
+                 ORDER BY node_keys.id, n_rev""", (kind, self._item_key(item)))
+        return [(row["other_node"], row["n_rev"], row["m_rev"]) for row in self.cur.fetchall()]
+
+    def move_legacy_archives(self, batch_size):
+        # moves rows archived in edits_archive and patches_archive into the segment files. Uses its own short
+        # transaction, so don't call it inside one. Returns the number of moved rows
+        # nothing writes to those tables anymore, so they can be read before taking the lock
+        batches = []
+        for kind, table in ((ARCHIVE_EDIT, "edits_archive"), (ARCHIVE_PATCH, "patches_archive")):
+            self.cur.execute(f"""SELECT rowid, *
+                                 FROM {table}
+                                 ORDER BY rowid
+                                 LIMIT ?""", (batch_size,))
+            rows = [dict(row) for row in self.cur.fetchall()]
+            if rows:
+                batches.append((kind, table, rows))
+        if not batches:
+            return 0
+
+        moved = 0
+        self.start_transaction("move_legacy_archives")
+        try:
+            for kind, table, rows in batches:
+                self._archive_rows(kind, [{key: value for key, value in row.items() if key != "rowid"} for row in rows])
+                self.cur.executemany(f"DELETE FROM {table} WHERE rowid = ?", [(row["rowid"],) for row in rows])
+                moved += len(rows)
+        except Exception:
+            self.rollback_transaction()
+            raise
+        self.end_transaction(suppress_msg=True)
+        self._log_debug_trans(f"{moved} archived rows moved to segment files")
+        return moved
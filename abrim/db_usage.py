@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import sys
+from abrim.config import Config
+from datastore import get_space_usage, enable_incremental_vacuum
+from abrim.util import get_log
+
+log = get_log('critical')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="bytes taken by each table and index of the sqlite files of a node")
+    parser.add_argument("files", nargs="*", help="sqlite files, instead of the ones of -i and -p")
+    parser.add_argument("-i", "--id", help="Node ID")
+    parser.add_argument("-p", "--port", help="Port of any of the node's components")
+    parser.add_argument("--json", action="store_true", help="print the whole report as json")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="rebuild files created without auto_vacuum so patch.py can shrink them. Stop the node "
+                             "first, it needs twice the space of each file")
+    return parser.parse_args()
+
+
+def _node_files(node_id, port):
+    # ABRIM_SHARDS and the rest of the environment have to be the node's to find all of them
+    return Config(node_id, int(port)).db.get_db_paths()
+
+
+def _print_usage(usage):
+    page_size = usage["page_size"]
+    print(f"{usage['path']}: {usage['pages'] * page_size} bytes, {usage['free_pages'] * page_size} free, "
+          f"auto_vacuum {usage['auto_vacuum']}, wal {usage['wal_bytes']} bytes")
+    for sqlite_object in usage["objects"]:
+        share = 100 * sqlite_object["pages"] / usage["pages"] if usage["pages"] else 0
+        print(f"  {sqlite_object['name']:<40} {sqlite_object['type']:<6} {sqlite_object['bytes']:>12} "
+              f"{share:5.1f}% {sqlite_object['unused_bytes']:>12} unused")
+
+
+def main():
+    args = _parse_args()
+    files = args.files
+    if not files:
+        if not args.id or not args.port:
+            print("use -i and -p to choose a node, or give the sqlite files")
+            return 1
+        files = _node_files(args.id, args.port)
+        if not files:
+            print("this node isn't saved to any file")
+            return 1
+
+    if args.enable_incremental_vacuum:
+        for db_path in files:
+            if enable_incremental_vacuum(db_path):
+                print(f"{db_path}: rebuilt with auto_vacuum incremental")
+
+    usages = [get_space_usage(db_path) for db_path in files]
+    if args.json:
+        print(json.dumps(usages, indent=2))
+    else:
+        for usage in usages:
+            _print_usage(usage)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
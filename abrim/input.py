@@ -1,36 +1,30 @@
 #!/usr/bin/env python
 
+import atexit
+import itertools
+import signal
+import sys
+import threading
 import traceback
 import time
 import werkzeug
 from flask import Flask, g, request
 from abrim.config import Config
-from abrim.util import get_log, fragile_patch_text, resp, check_fields_in_dict, check_crc, get_crc, create_diff_edits, \
-                       create_hash, args_init, requires_auth, ROUTE_FOR
+from abrim.sync import sync_edit, sync_edits, check_item_exists, save_shadow
+from datastore import close_pools
+from storage import BusyError, TransactionError
+from bus import Listener, notify, EDIT_ENQUEUED, PATCH_ENQUEUED, POST_ENQUEUED, INPUT
+from metrics import get_metrics, dump_metrics, load_metrics, timer
+from abrim.util import get_log, resp, resp_stream, check_fields_in_dict, get_crc, create_diff_edits, create_hash, \
+                       args_init, requires_auth, decompress_request, compress_response, ROUTE_FOR
 
 log = get_log('debug')
 
 app = Flask(__name__)
 
-
-def _get_server_shadow(config, item_id, client_node_id, n_rev, m_rev):
-    got_shadow, shadow = config.db.get_shadow(item_id, client_node_id, n_rev, m_rev)
-    if got_shadow:
-        log.debug(f"shadow: {shadow}")
-    return got_shadow, shadow
-
-
-def _patch_server_shadow(edits, shadow):
-    if edits == "" and shadow == "":
-        log.debug("no shadow or patches, nothing to patch...")
-        return "", True
-    else:
-        new_shadow, patch_success = fragile_patch_text(edits, shadow)
-        if not patch_success:
-            log.debug("patching failed")
-            return "", False
-        else:
-            return new_shadow, patch_success
+_config_lock = threading.Lock()
+# patch.py's "patch applied", for the sync requests waiting for their patch
+_listener = Listener()
 
 
 def _check_post_sync_request_ok(r_js):
@@ -44,7 +38,7 @@ def _check_post_sync_request_ok(r_js):
         log.debug("has edits: {:.30}...".format(r_js['edits'].replace('\n', ' ')))
     except KeyError:
         log.debug(f"wrongly formated sync request: {r_js}")
-    return r_js['n_rev'], r_js['m_rev'], r_js['hash'], r_js['edits']
+    return r_js['n_rev'], r_js['m_rev'], r_js['hash'], r_js['edits'], bool(r_js.get('piggybacked'))
 
 
 def _check_shadow_request_ok(r_json):
@@ -85,33 +79,34 @@ def _check_permissions(dummy):  # TODO: implement me
     return True
 
 
-def _check_item_exists(config, item_id):
-    return config.db.get_item(item_id)
-
-
-def _save_shadow(config, client_node_id, item_id, shadow, n_rev, m_rev, crc):
-    config.db.save_new_shadow(client_node_id, item_id, shadow, n_rev, m_rev, crc)
-
-
-def _enqueue_patches(config, client_node_id, item_id, patches, n_rev, m_rev, crc):
-    config.db.save_new_patches(client_node_id, item_id, patches, n_rev, m_rev, crc)
-
-
 def _check_patch_done(config, timeout, client_node_id, item_id, n_rev, m_rev):
-    # wait a bit for the patching of server text
+    # wait a bit for the patching of server text. patch.py notifies each batch it applies, every second it's checked
+    # anyway in case there is no bus or a notification got lost
+    deadline = time.monotonic() + timeout
     while True:
+        seen = _listener.events
         patch_done = config.db.check_if_patch_done(client_node_id, item_id, n_rev, m_rev)
         if patch_done:
             break
         else:
-            if timeout < 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 log.warning("server didn't processed the patch within the allotted time. Possible server overload")
                 return None
-            time.sleep(1)
-            timeout -= 1
+            _listener.wait(min(1, remaining), seen)
 
-    patch_done = {'json': 'response_all_ok_and_new_edits_for_client'} # fixme: delete me
-    return patch_done
+    # the edits this node has queued for the client, the merge of the patch with local changes for example, go back
+    # in the answer so it doesn't wait for our out.py. They stay queued until out.py syncs them anyway, marked so
+    # the client knows that sync isn't a resend after a lost answer. Usually there are none and no transaction
+    edits = config.db.get_item_queued_edits(client_node_id, item_id, config.bulk_sync_limit)
+    if edits:
+        try:
+            config.db.run_transaction(lambda: config.db.mark_edits_piggybacked([edit["rowid"] for edit in edits]),
+                                      "piggyback edits")
+        except TransactionError as err:
+            log.warning(f"not sending our edits of {item_id} back to {client_node_id}: {err}")
+            edits = []
+    return {'edits': [{key: edit[key] for key in ('n_rev', 'm_rev', 'edits', 'hash')} for edit in edits]}
 
 
 def _enqueue_edit(config, other_node_id, item_id, diffs,  n_rev, m_rev, old_shadow):
@@ -129,7 +124,7 @@ def _enqueue_post_text(config, item_id, new_text):
 
 
 def _get_enqueue_post_text_status(config, queue_rowid):
-    return config.db.get_post_status(queue_rowid)
+    return config.db_read.get_post_status(queue_rowid)
 
 
 def _new_item(config, item_id, new_text):
@@ -147,7 +142,8 @@ def _new_item(config, item_id, new_text):
 
         # create and enqueue the edit for the new item
         log.debug(f"creating diffs")
-        diffs = create_diff_edits(new_text, old_shadow)  # TODO: maybe doing a slow blocking diff in a transaction is wrong
+        with timer("diff.create_diff_edits"):
+            diffs = create_diff_edits(new_text, old_shadow)  # TODO: maybe doing a slow blocking diff in a transaction is wrong
         if diffs:
             _enqueue_edit(config, other_node_id, item_id, diffs, n_rev, m_rev, old_shadow)
 
@@ -170,7 +166,8 @@ def _update_item(config, item_id, new_text):
 
         log.debug(f"latest revs for that item in {other_node_id} are {n_rev} - {m_rev}")
         log.debug(f"creating diffs")
-        diffs = create_diff_edits(new_text, old_shadow)  # maybe doing a slow blocking diff in a transaction is wrong
+        with timer("diff.create_diff_edits"):
+            diffs = create_diff_edits(new_text, old_shadow)  # maybe doing a slow blocking diff in a transaction is wrong
         if diffs:
             _enqueue_edit(config, other_node_id, item_id, diffs, n_rev, m_rev, old_shadow)
 
@@ -204,97 +201,155 @@ def _receive_sync_post(item_id, client_node_id):
         r_json = request.get_json()
 
         try:
-            n_rev, m_rev, hash_, edits = _check_post_sync_request_ok(r_json)
+            n_rev, m_rev, hash_, edits, piggybacked = _check_post_sync_request_ok(r_json)
         except TypeError:
             return resp("queue_in/post_sync/405/check_req", "Malformed JSON request")
-
-        config.db.start_transaction("_post_sync")
-
-        log.debug(f"checking revs for {item_id} from node: {client_node_id}")
-        saved_n_rev, saved_m_rev = config.db.get_latest_revs(item_id, client_node_id)
-
-        if not saved_n_rev and not saved_m_rev:
-            item_exists, item_text, item_crc = _check_item_exists(config, item_id)
-            if item_exists:
-                # item already exists locally but the other_node has no local shadow so create a new local shadow and signal ir to the other node
-                _save_shadow(config, client_node_id, item_id, item_text, 1, 1, item_crc)  # save new shadow
-                config.db.end_transaction()
-                return resp("queue_in/post_sync/409/use_this_as_shadow",
-                            "That item exists locally but I have no shadow from you. Use this item and use it for shadow 1-1",
-                            {"text": item_text, "crc": item_crc})
-            else:
-                # it's a new item, so create a new empty shadow
-                saved_n_rev = 0
-                saved_m_rev = 0
-                _save_shadow(config, client_node_id, item_id, "", saved_n_rev, saved_m_rev, 1)
-
-        if n_rev != saved_n_rev:
-            if n_rev < saved_n_rev:
-                log.warning(f"n_rev DOESN'T match: {n_rev} < {saved_n_rev}")
-                if config.db.find_rev_shadow(client_node_id, item_id, n_rev, m_rev, hash_):
-                    # lost return packet
-                    # FIXME: we should delete local edits at this point
-                    # copy backup shadow to shadow (in our code that means deleting shadows with a higher than n_rev)
-                    config.db.delete_revs_higher_than(client_node_id, item_id, n_rev)
-                    config.db.end_transaction()
-                    return resp("queue_in/post_sync/201/lost_return_packet", "Accepted, but that looked like you lost a return packet from me")
-                else:
-                    config.db.rollback_transaction()
-                    raise Exception("implement me! 1")
-            else:
-                log.warning(f"n_rev DOESN'T match: {n_rev} > {saved_n_rev}")
+        if r_json.get('stack'):
+            # the edit above is the first of the stack
+            return _receive_sync_stack(config, item_id, client_node_id, r_json['stack'])
+
+        def sync():
+            # returns the response when the sync can't go on, the transaction ends unless it was rolled back
+            result = sync_edit(config, client_node_id, item_id, n_rev, m_rev, hash_, edits, piggybacked)
+            if not result:
+                return None
+            api_unique_code, message, content, keep = result
+            if not keep:
                 config.db.rollback_transaction()
-                raise Exception("implement me! 2")
-            # return resp("queue_in/post_sync/403/no_match_revs", "Revs don't match")
-        if m_rev != saved_m_rev:
-            log.error(f"m_rev DOESN'T match: {m_rev} != {saved_m_rev}")
-            config.db.rollback_transaction()
-            raise Exception("implement me! 3")
-
-        got_shadow, shadow = _get_server_shadow(config, item_id, client_node_id, n_rev, m_rev)
-
-        if not got_shadow:
-            config.db.rollback_transaction()
-            return resp("queue_in/post_sync/404/not_shadow", "Shadow not found. PUT the full shadow to this URL changing 'sync' with 'shadow'")
-        if not check_crc(shadow, hash_):
-            config.db.rollback_transaction()
-            return resp("queue_in/post_sync/403/check_crc", "CRC of shadow doesn't match")
-
-        new_shadow, patch_success = _patch_server_shadow(edits, shadow)
-
-        if not patch_success:
-            config.db.rollback_transaction()
-            return resp("queue_in/post_sync/500/shadow_patch_unsuccessful", "Failed to patch shadow")
-        else:
-            _enqueue_patches(config, client_node_id, item_id, edits, n_rev, m_rev, hash_) # save patches to patch queue
-            n_rev += 1
-            new_hash = get_crc(new_shadow)
-            _save_shadow(config, client_node_id, item_id, new_shadow, n_rev, m_rev, new_hash) # save new shadow
+            return resp(api_unique_code, message, content)
 
+        response = config.db.run_transaction(sync, "_post_sync")
+        if response:
+            return response
+        notify(PATCH_ENQUEUED)
+
+    except BusyError:
+        return resp("queue_in/post_sync/503/busy", "Too busy right now, try again later")
     except Exception as err:
-        config.db.rollback_transaction()
         log.error(f"ERROR: {err}")
         traceback.print_exc()
         return resp("queue_in/post_sync/500/transaction_exception", "Unknown error. Please report this")
-    else:
-        config.db.end_transaction()
 
     timeout = 5
+    # the patches are archived with the revs they were sent with, not the ones of the new shadow
     patch_done_json = _check_patch_done(config, timeout, client_node_id, item_id, n_rev, m_rev)
     if not patch_done_json:
         return resp("queue_in/post_sync/201/ack", "Sync acknowledged. Still waiting for patch to apply")
     return resp("queue_in/post_sync/201/done", "Sync done", patch_done_json)
 
 
+def _sync_revs(r_edit):
+    # (n_rev, m_rev, hash, edits, piggybacked) of an edit in a bulk sync or a stack, None if it's malformed
+    try:
+        return _check_post_sync_request_ok(r_edit)
+    except (KeyError, TypeError):
+        return None
+
+
+def _wait_for_patches(config, client_node_id, sync_requests, results):
+    # the same wait as a single sync, but for all the edits enqueued by sync_edits. The patches of an item are applied
+    # in order, so it waits for the last one of each item, which answers with the edits to piggyback. The response
+    # of each edit
+    last_enqueued = {item_id: i for i, ((item_id, _), result) in enumerate(zip(sync_requests, results))
+                     if result is None}
+    deadline = time.monotonic() + 5
+    patches_done = {}
+    for item_id, i in last_enqueued.items():
+        n_rev, m_rev = sync_requests[i][1][:2]
+        patches_done[item_id] = _check_patch_done(config, deadline - time.monotonic(), client_node_id, item_id, n_rev,
+                                                  m_rev)
+    response_results = []
+    for i, ((item_id, _), result) in enumerate(zip(sync_requests, results)):
+        if not result:
+            if patches_done[item_id]:
+                patch_done_json = patches_done[item_id] if last_enqueued[item_id] == i else {'edits': []}
+                result = "queue_in/post_sync/201/done", "Sync done", patch_done_json
+            else:
+                result = "queue_in/post_sync/201/ack", "Sync acknowledged. Still waiting for patch to apply", None
+        api_unique_code, message, content = result
+        response_results.append({'api_unique_code': api_unique_code, 'message': message, 'content': content})
+    return response_results
+
+
+def _receive_sync_stack(config, item_id, client_node_id, stack):
+    # the queued edits of an item, oldest first, applied in order against the shadow in one transaction. The
+    # response is the first edit's, the one a node that doesn't know stacks would have synced, with the responses
+    # of all of them in "stack" and the highest n_rev enqueued in "n_rev"
+    if not isinstance(stack, list):
+        return resp("queue_in/post_sync/405/check_req", "Malformed JSON request")
+    if len(stack) > config.bulk_sync_limit:
+        return resp("queue_in/post_sync/413/too_many_edits", f"Send up to {config.bulk_sync_limit} edits at once")
+    sync_requests = [(item_id, _sync_revs(r_edit)) for r_edit in stack]
+    try:
+        results = config.db.run_transaction(lambda: sync_edits(config, client_node_id, sync_requests),
+                                            "_post_sync_stack")
+        if None in results:
+            notify(PATCH_ENQUEUED)
+    except BusyError:
+        return resp("queue_in/post_sync/503/busy", "Too busy right now, try again later")
+    except Exception as err:
+        log.error(f"ERROR: {err}")
+        traceback.print_exc()
+        return resp("queue_in/post_sync/500/transaction_exception", "Unknown error. Please report this")
+
+    response_results = _wait_for_patches(config, client_node_id, sync_requests, results)
+    enqueued_n_revs = [revs[0] for (_, revs), result in zip(sync_requests, results) if result is None]
+    first = response_results[0]
+    content = dict(first['content'] or {}, stack=response_results,
+                   n_rev=max(enqueued_n_revs) if enqueued_n_revs else None)
+    return resp(first['api_unique_code'], first['message'], content)
+
+
+@app.route(f"{ROUTE_FOR['items']}/sync/<string:client_node_id>", methods=['POST'])
+@requires_auth
+def _receive_bulk_sync_post(client_node_id):
+    # several queued edits of client_node_id, for any items, in one transaction: {"edits": [{"item": <id>, "n_rev":
+    # 0, "m_rev": 0, "edits": "...", "hash": "1"}, ...]}. The response has a result per edit, what POST
+    # /items/<item>/sync/<node> would have answered it
+    log.debug("_post_bulk_sync")
+    config = g.config
+    try:
+        if not _check_permissions("to do"):  # TODO: implement me
+            return resp("queue_in/post_bulk_sync/403/check_permissions", "you have no permissions for that")
+
+        r_json = request.get_json()
+        if not check_fields_in_dict(r_json, ('edits',)) or not isinstance(r_json['edits'], list):
+            return resp("queue_in/post_bulk_sync/405/check_req", "Malformed JSON request")
+        if len(r_json['edits']) > config.bulk_sync_limit:
+            return resp("queue_in/post_bulk_sync/413/too_many_edits",
+                        f"Send up to {config.bulk_sync_limit} edits at once")
+        sync_requests = []
+        for r_edit in r_json['edits']:
+            try:
+                sync_requests.append((r_edit['item'], _sync_revs(r_edit)))
+            except (KeyError, TypeError):
+                sync_requests.append((None, None))
+
+        results = config.db.run_transaction(lambda: sync_edits(config, client_node_id, sync_requests),
+                                            "_post_bulk_sync")
+        if None in results:
+            notify(PATCH_ENQUEUED)
+
+    except BusyError:
+        return resp("queue_in/post_bulk_sync/503/busy", "Too busy right now, try again later")
+    except Exception as err:
+        log.error(f"ERROR: {err}")
+        traceback.print_exc()
+        return resp("queue_in/post_bulk_sync/500/transaction_exception", "Unknown error. Please report this")
+
+    response_results = _wait_for_patches(config, client_node_id, sync_requests, results)
+    return resp("queue_in/post_bulk_sync/200/ok", "Bulk sync done", {"results": response_results})
+
+
 @app.route(f"{ROUTE_FOR['items']}/<string:item_id>/shadow/<string:client_node_id>", methods=['PUT'])
 @requires_auth
 def _receive_shadow_put(client_node_id, item_id):
     log.debug("_put_shadow")
     config = g.config
-    config.item_edit = {"item_node_id": client_node_id, "item_id": item_id}
+    item_edit = {"item_node_id": client_node_id, "item_id": item_id}
 
     try:
-        if not _check_permissions(config.item_edit):
+        if not _check_permissions(item_edit):
             return resp("queue_in/put_shadow/403/check_permissions", "you have no permissions for that")
 
         r_json = request.get_json()
@@ -304,24 +359,26 @@ def _receive_shadow_put(client_node_id, item_id):
             return resp("queue_in/put_shadow/405/check_req", "Malformed JSON request")
 
         log.debug("request with the shadow seems ok, trying to save it")
-        config.db.start_transaction("_put_shadow")
 
-        item_exists, item, _ = _check_item_exists(config, item_id)
-        if not item_exists:
-            # _save_item(item_id, shadow)
-            _update_item(config, item_id, shadow)
+        def put_shadow():
+            item_exists, item, _ = check_item_exists(config, item_id)
+            if not item_exists:
+                # _save_item(item_id, shadow)
+                _update_item(config, item_id, shadow)
 
-        else:
-            _save_shadow(config, client_node_id, item_id, shadow, r_json['n_rev'], r_json['m_rev'], get_crc(shadow))
+            else:
+                save_shadow(config, client_node_id, item_id, shadow, r_json['n_rev'], r_json['m_rev'], get_crc(shadow))
 
+        config.db.run_transaction(put_shadow, "_put_shadow")
+
+    except BusyError:
+        return resp("queue_in/put_shadow/503/busy", "Too busy right now, try again later")
     except Exception as err:
-        config.db.rollback_transaction()
         log.error(err)
         traceback.print_exc()
         return resp("queue_in/put_shadow/500/transaction_exception", "Unknown error. Please report this")
     else:
         log.info("_put_shadow about to finish OK")
-        config.db.end_transaction()
         return resp("queue_in/put_shadow/201/ack", "Sync acknowledged")
 
 
@@ -334,7 +391,7 @@ def _receive_item_get(item_id):
         if not _check_permissions("to do"):  # TODO: implement me
             return resp("queue_in/get_text/403/check_permissions", "you have no permissions for that")
 
-        item_ok, item_text, item_crc = config.db.get_item(item_id)
+        item_ok, item_text, item_crc = config.db_read.get_item(item_id)
 
         if not item_ok:
             return resp("queue_in/get_text/404/not_item", "Item not found")
@@ -367,24 +424,30 @@ def _receive_item_put(item_id):
             return resp("queue_in/put_text/405/check_req", "Malformed JSON request")
 
         log.debug("request with the text seems ok, trying to save it")
-        config.db.start_transaction("_put_text")
-        item_exists, item, _ = _check_item_exists(config, item_id)
 
-        if item_exists:
-            # _update_item(config, item_id, new_text)
-            config.db.end_transaction()
-            return resp("queue_in/put_text/200/item_exists", "ITEM EXISTS")
-        else:
-            _new_item(config, item_id, new_text)
+        def put_text():
+            item_exists, item, _ = check_item_exists(config, item_id)
 
+            if item_exists:
+                # _update_item(config, item_id, new_text)
+                return resp("queue_in/put_text/200/item_exists", "ITEM EXISTS")
+            else:
+                _new_item(config, item_id, new_text)
+            return None
+
+        response = config.db.run_transaction(put_text, "_put_text")
+        if response:
+            return response
+        notify(EDIT_ENQUEUED)
+
+    except BusyError:
+        return resp("queue_in/put_text/503/busy", "Too busy right now, try again later")
     except Exception as err:
-        config.db.rollback_transaction()
         log.error(err)
         traceback.print_exc()
         return resp("queue_in/put_text/500/transaction_exception", "Unknown error. Please report this")
     else:
         log.info("_put_text about to finish OK")
-        config.db.end_transaction()
     return resp("queue_in/put_text/200/ok", "PUT OK")
 
 
@@ -416,6 +479,7 @@ def _receive_item_post(item_id):
 
         new_post_id, new_text_crc = _enqueue_post_text(config, item_id, new_text)
         if new_post_id:
+            notify(POST_ENQUEUED)
             location = f"{ROUTE_FOR['items']}/queue/post/{new_post_id}"
             return resp("queue_in/post_text/202/accepted", "POST OK", {"location": location}, location)
         else:
@@ -462,8 +526,17 @@ def _receive_items_get():
         if not _check_permissions("to do"):  # TODO: implement me
             return resp("queue_in/get_items/403/check_permissions", "you have no permissions for that")
 
-        items = config.db.get_items()
-        if not items:
+        limit = request.args.get('limit', config.items_page_size, type=int)
+        after = request.args.get('after')
+        if limit < 1:
+            return resp("queue_in/get_items/405/check_req", "limit must be a positive number")
+        limit = min(limit, config.items_page_size)
+
+        # one more than the page to know if there is a next one
+        items = config.db_read.iter_items(limit + 1, after)
+        first_item = next(items, None)
+        if not first_item:
+            items.close()
             return resp("queue_in/get_items/404/not_items", "No items")
 
     except Exception as err:
@@ -472,7 +545,7 @@ def _receive_items_get():
         return resp("queue_in/get_items/500/transaction_exception", "Unknown error. Please report this")
     else:
         log.info("get_text about to finish OK")
-        return resp("queue_in/get_items/200/ok", "get_text OK", items)
+        return resp_stream("queue_in/get_items/200/ok", "get_text OK", itertools.chain((first_item,), items), limit, "id")
 
 
 @app.route(ROUTE_FOR['nodes'], methods=['GET'])
@@ -484,7 +557,7 @@ def _receive_nodes_get():
         if not _check_permissions("to do"):  # TODO: implement me
             return resp("queue_in/get_nodes/403/check_permissions", "you have no permissions for that")
 
-        nodes = config.db.get_known_nodes()
+        nodes = config.db_read.get_known_nodes()
         if not nodes:
             return resp("queue_in/get_nodes/404/not_items", "No nodes")
 
@@ -497,6 +570,27 @@ def _receive_nodes_get():
         return resp("queue_in/get_nodes/200/ok", "get_nodes OK", nodes)
 
 
+@app.route(ROUTE_FOR['stats'], methods=['GET'])
+@requires_auth
+def _receive_stats_get():
+    log.debug("_get_stats")
+    config = g.config
+    try:
+        # what this process measured so far and what the out.py and patch.py cycles saved, None if they haven't
+        # saved anything readable yet
+        stats = {"input": get_metrics().snapshot()}
+        for component in ("out", "patch"):
+            metrics_path = config.metrics_path(component)
+            stats[component] = load_metrics(metrics_path) if metrics_path else None
+            if not isinstance(stats[component], dict):
+                stats[component] = None
+    except Exception as err:
+        log.error(f"ERROR: {err}")
+        traceback.print_exc()
+        return resp("queue_in/get_stats/500/stats_exception", "Unknown error. Please report this")
+    return resp("queue_in/get_stats/200/ok", "get_stats OK", stats)
+
+
 @app.route(ROUTE_FOR['nodes'], methods=['POST'])
 @requires_auth
 def _receive_node_post():
@@ -516,17 +610,16 @@ def _receive_node_post():
             return resp("queue_in/post_node/405/check_req", "Malformed JSON request")
 
         log.debug("request with the new node seems ok, trying to save it")
-        config.db.start_transaction("_post_node")
-
-        node_uuid = config.db.add_known_node(new_node_id, new_node_base_url)
+        node_uuid = config.db.run_transaction(lambda: config.db.add_known_node(new_node_id, new_node_base_url),
+                                              "_post_node")
+    except BusyError:
+        return resp("queue_in/post_node/503/busy", "Too busy right now, try again later")
     except Exception as err:
-        config.db.rollback_transaction()
         log.error(f"ERROR: {err}")
         traceback.print_exc()
         return resp("queue_in/post_node/500/transaction_exception", "Unknown error. Please report this")
     else:
         log.info("_post_node about to finish OK")
-        config.db.end_transaction()
 
     return resp("queue_in/post_node/201/done", f"{node_uuid}")
 
@@ -538,8 +631,28 @@ def __end():
     pass
 
 
+def _dump_metrics():
+    config = app.config.get('ABRIM_CONFIG')
+    dump_metrics(config.metrics_path("input") if config else None)
+
+
+def _get_config():
+    # one Config (and so one DataStore and its connection pool) for the whole process instead of one per request
+    config = app.config.get('ABRIM_CONFIG')
+    if not config:
+        with _config_lock:
+            config = app.config.get('ABRIM_CONFIG')
+            if not config:
+                config = Config(app.config['NODE_ID'], app.config['PORT'])
+                app.config['ABRIM_CONFIG'] = config
+    return config
+
+
 @app.before_request
 def before_request():
+    error_response = decompress_request()
+    if error_response:
+        return error_response
     if request.full_path and request.method:
         log.debug("-------------------------------------------------------------------------------")
         log.debug(f"{request.method} REQUEST: {request.full_path}")
@@ -549,12 +662,20 @@ def before_request():
         log.error("request doesn't have a full_path and/or method")
         return resp("queue_in/before_request/500/unknown", "Unknown error. Please report this")
     # db.prepare_db_path(app.config['DB_PATH'])
-    config = Config(app.config['NODE_ID'], app.config['PORT'])
-    g.config = config
+    g.config = _get_config()
+
+
+@app.after_request
+def after_request(response):
+    return compress_response(response)
 
 
 @app.teardown_request
 def teardown_request(exception):
+    config = g.pop('config', None)
+    if config:
+        config.db.release()
+        config.db_read.release()
     __end()
 
 
@@ -570,8 +691,14 @@ if __name__ == "__main__":  # pragma: no cover
             app.config['NODE_ID'] = node_id
         if 'PORT' not in app.config:
             app.config['PORT'] = client_port
+        _get_config()  # set up the schema and the connection pool before serving
+        _listener.listen(INPUT)
+        atexit.register(_dump_metrics)
+        # node.py stops it with terminate(), exit normally so the metrics get dumped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         # app.run(host='0.0.0.0', port=client_port, use_reloader=False)
         # app.run(host='0.0.0.0', port=client_port)
         # for pycharm debugging
         app.run(host='0.0.0.0', port=client_port, debug=False, use_debugger=False, use_reloader=False)
+        close_pools()
         __end()
@@ -0,0 +1,480 @@
+import heapq
+import threading
+import time
+import uuid
+
+from metrics import METRICS, instrument
+from storage import Storage, BusyError, TransactionError, ARCHIVE_EDIT, ARCHIVE_PATCH, DEFAULT_BUSY_TIMEOUT_MS, \
+                    DEFAULT_TRANSACTION_RETRIES
+from util import get_log
+
+log = get_log('critical')
+
+_MISSING = object()
+
+
+class _MemoryData(object):
+    # what the sqlite file is for DataStore: shared by every MemoryStorage of the same node in this process
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # the posts are DataStore's separate posts file: they don't wait for the transactions or go in their undo
+        self.posts_lock = threading.Lock()
+        self.local = threading.local()
+        self.clear()
+
+    def clear(self):
+        self.nodes = {}  # id: base_url
+        self.items = {}  # id: (text, crc)
+        self.shadows = {}  # (item, other_node): {(n_rev, m_rev): (text, crc)}
+        self.edits = {}  # rowid: edit dict
+        self.edit_keys = {}  # (item, other_node, n_rev): rowid
+        self.patches = {}  # (item, other_node, n_rev): patch dict
+        self.posts = {}  # rowid: post dict
+        self.pending_posts = {}  # rowid: True, oldest first
+        self.last_post_rowid = 0
+        self.archive = {}  # (kind, item, other_node, n_rev): archived dict
+        self.last_rowid = 0
+
+
+_datas = {}
+_datas_lock = threading.Lock()
+
+
+def _claimed_by_other(row, worker, now):
+    # a post or patch another worker claimed and whose lease hasn't expired
+    return row.get("claimed_by") not in (None, worker) and row["lease_until"] >= now
+
+
+@instrument("db")
+class MemoryStorage(Storage):
+    # a node kept in dicts, without any disk I/O: for benchmarks, simulations and tests. Nothing survives the
+    # process and other processes (out.py, patch.py) can't see it, so all the components have to run in the same one.
+    # A transaction holds the lock until it ends and a rollback undoes its writes one by one
+
+    def __init__(self, node_id, port, db_prefix="", drop_db=False, busy_timeout=DEFAULT_BUSY_TIMEOUT_MS,
+                 transaction_retries=DEFAULT_TRANSACTION_RETRIES):
+        if not node_id or not port:
+            raise Exception
+        self.node_id = node_id
+        self.port = port
+        self.db_prefix = db_prefix
+        self.busy_timeout = busy_timeout
+        self.transaction_retries = transaction_retries
+        # the input, out and patch ports of a node share the data, like they share the sqlite file
+        data_key = (node_id, str(port)[:-1], db_prefix)
+        with _datas_lock:
+            self._data = _datas.get(data_key)
+            if self._data is None:
+                self._data = _datas[data_key] = _MemoryData()
+                drop_db = True
+        if drop_db:
+            self.drop_db()
+
+    def drop_db(self):
+        with self._data.lock, self._data.posts_lock:
+            self._data.clear()
+            self._data.nodes[uuid.uuid4().hex] = None
+
+    # TRANSACTION
+
+    @property
+    def _undo(self):
+        return getattr(self._data.local, 'undo', None)
+
+    def start_transaction(self, msg=None):
+        if self._undo is not None:
+            log.error("cannot start a transaction within a transaction. Rolling back!!")
+            self._rollback()
+            raise TransactionError("already in a transaction")
+        lock_wait_start = time.perf_counter()
+        if not self._data.lock.acquire(timeout=self.busy_timeout / 1000):
+            METRICS.record("db.lock_wait", time.perf_counter() - lock_wait_start, detail=msg)
+            METRICS.increment("db.busy")
+            raise BusyError(f"could not start a transaction in {self.busy_timeout} ms")
+        self._data.local.started = time.perf_counter()
+        self._data.local.msg = msg
+        METRICS.record("db.lock_wait", self._data.local.started - lock_wait_start, detail=msg)
+        self._data.local.undo = []
+        if msg:
+            log.debug(f"transaction started: {msg}")
+
+    def end_transaction(self, suppress_msg=False):
+        if self._undo is None:
+            log.debug("explicit end requested, but transaction already ended")
+            return
+        if not suppress_msg:
+            log.debug("transaction ending")
+        self._unlock()
+
+    def check_transaction(self):
+        return self._undo is not None
+
+    def rollback_transaction(self, msg=""):
+        if self._undo is None:
+            log.warning("tried to rollback a transaction but there was none!!")
+            return
+        log.debug("explicitly rolling back this transaction.")
+        self._rollback()
+        log.debug("transaction rolled back OK")
+
+    def savepoint(self):
+        if self._undo is None:
+            log.error("savepoints need a transaction")
+            raise TransactionError("not in a transaction")
+        return len(self._undo)
+
+    def rollback_to_savepoint(self, savepoint):
+        undo = self._undo
+        for table, key, value in reversed(undo[savepoint:]):
+            if value is _MISSING:
+                table.pop(key, None)
+            else:
+                table[key] = value
+        del undo[savepoint:]
+
+    def _rollback(self):
+        for table, key, value in reversed(self._undo):
+            if value is _MISSING:
+                table.pop(key, None)
+            else:
+                table[key] = value
+        self._unlock()
+
+    def _unlock(self):
+        self._data.local.undo = None
+        self._data.lock.release()
+        METRICS.record("db.transaction_hold", time.perf_counter() - self._data.local.started,
+                       detail=self._data.local.msg)
+
+    def release(self):
+        if self._undo is not None:
+            log.warning("released with an open transaction. Rolling back!!")
+            self._rollback()
+
+    def get_reader(self):
+        return self
+
+    def get_db_paths(self):
+        return []
+
+    def incremental_vacuum(self, pages):
+        return 0
+
+    def _set(self, table, key, value):
+        with self._data.lock:
+            if self._undo is not None:
+                self._undo.append((table, key, table.get(key, _MISSING)))
+            table[key] = value
+
+    def _delete(self, table, key):
+        with self._data.lock:
+            if key not in table:
+                return
+            if self._undo is not None:
+                self._undo.append((table, key, table[key]))
+            del table[key]
+
+    def _next_rowid(self):
+        with self._data.lock:
+            self._data.last_rowid += 1
+            return self._data.last_rowid
+
+    # NODES
+
+    def add_known_node(self, node_uuid, url):
+        with self._data.lock:
+            if node_uuid not in self._data.nodes:
+                self._set(self._data.nodes, node_uuid, url)
+        return node_uuid
+
+    def get_known_nodes(self):
+        with self._data.lock:
+            return [{"id": node_id, "base_url": base_url, } for node_id, base_url in sorted(self._data.nodes.items())
+                    if node_id != self.node_id and base_url is not None]
+
+    # REV AND SHADOW
+
+    def _revs(self, item_id, other_node_id):
+        return self._data.shadows.get((item_id, other_node_id), {})
+
+    def get_latest_rev_shadow(self, other_node_id, item_id):
+        with self._data.lock:
+            revs = self._revs(item_id, other_node_id)
+            if not revs:
+                return 0, 0, ""
+            n_rev, m_rev = max(revs)
+            return n_rev, m_rev, revs[(n_rev, m_rev)][0]
+
+    def find_rev_shadow(self, other_node_id, item_id, n_rev, m_rev, crc):
+        with self._data.lock:
+            shadow = self._revs(item_id, other_node_id).get((n_rev, m_rev))
+        return bool(shadow and crc and shadow[1] == crc)
+
+    def get_shadow(self, item, other_node_id, n_rev, m_rev):
+        with self._data.lock:
+            shadow = self._revs(item, other_node_id).get((n_rev, m_rev))
+        if not shadow:
+            return False, None
+        return True, shadow[0]
+
+    def get_latest_revs(self, item, other_node_id):
+        with self._data.lock:
+            revs = self._revs(item, other_node_id)
+            if not revs:
+                return None, None
+            return max(revs)
+
+    def delete_revs_higher_than(self, other_node_id, item_id, n_rev):
+        with self._data.lock:
+            revs = self._revs(item_id, other_node_id)
+            for rev in [rev for rev in revs if rev[0] > n_rev]:
+                self._delete(revs, rev)
+
+    def save_new_shadow(self, other_node_id, item_id, new_text, n_rev, m_rev, crc):
+        with self._data.lock:
+            pair = (item_id, other_node_id)
+            if pair not in self._data.shadows:
+                self._set(self._data.shadows, pair, {})
+            self._set(self._data.shadows[pair], (n_rev, m_rev), (new_text, crc))
+
+    def compact_shadows(self, batch_size, after=None):
+        with self._data.lock:
+            pairs = heapq.nsmallest(batch_size, (pair for pair, revs in self._data.shadows.items()
+                                                 if len(revs) > 2 and (not after or pair > tuple(after))))
+        if not pairs:
+            return 0, None
+
+        deleted = 0
+        self.start_transaction("compact_shadows")
+        for pair in pairs:
+            revs = self._data.shadows[pair]
+            for rev in sorted(revs, reverse=True)[2:]:
+                self._delete(revs, rev)
+                deleted += 1
+        self.end_transaction(suppress_msg=True)
+
+        if len(pairs) < batch_size:
+            return deleted, None
+        return deleted, pairs[-1]
+
+    def delete_unreferenced_texts(self, batch_size):
+        # equal texts already are the same python string
+        return 0
+
+    # POST
+    # outside of the transactions, see _MemoryData.posts_lock
+
+    def save_new_post(self, item_id, new_text, new_text_crc):
+        with self._data.posts_lock:
+            self._data.last_post_rowid += 1
+            rowid = self._data.last_post_rowid
+            self._data.posts[rowid] = {"item": item_id, "text": new_text, "node": self.node_id, "crc": new_text_crc,
+                                       "status": "PENDING"}
+            self._data.pending_posts[rowid] = True
+        return rowid
+
+    def get_post_status(self, queue_rowid):
+        with self._data.posts_lock:
+            post = self._data.posts.get(queue_rowid)
+        if not post:
+            return None, None
+        return post["status"], post["item"]
+
+    def get_post_pending(self):
+        with self._data.posts_lock:
+            for rowid in self._data.pending_posts:
+                post = self._data.posts[rowid]
+                return rowid, post["item"], post["text"], post["node"], post["crc"]
+        return None, None, None, None, None
+
+    def claim_post(self, worker, lease):
+        now = time.time()
+        with self._data.posts_lock:
+            posts = [(rowid, self._data.posts[rowid]) for rowid in self._data.pending_posts]
+            taken = {post["item"] for _, post in posts if _claimed_by_other(post, worker, now)}
+            for rowid, post in posts:
+                if post["item"] not in taken:
+                    self._data.posts[rowid] = dict(post, claimed_by=worker, lease_until=now + lease)
+                    return rowid, post["item"], post["text"], post["node"], post["crc"]
+        return None, None, None, None, None
+
+    def release_post(self, rowid, worker):
+        with self._data.posts_lock:
+            post = self._data.posts.get(rowid)
+            if rowid not in self._data.pending_posts or post.get("claimed_by") != worker:
+                return False
+            self._data.posts[rowid] = dict(post, claimed_by=None, lease_until=None)
+        return True
+
+    def update_post_pending(self, rowid):
+        with self._data.posts_lock:
+            if rowid not in self._data.pending_posts:
+                return False
+            self._data.posts[rowid] = dict(self._data.posts[rowid], status="DONE", claimed_by=None, lease_until=None)
+            del self._data.pending_posts[rowid]
+        return True
+
+    # ITEM
+
+    def save_new_item(self, item_id, new_text, text_crc):
+        with self._data.lock:
+            if item_id in self._data.items:
+                log.error(f"item {item_id} already exists")
+                raise Exception
+            self._set(self._data.items, item_id, (new_text, text_crc))
+
+    def update_item(self, item_id, new_text, text_crc):
+        self._set(self._data.items, item_id, (new_text, text_crc))
+
+    def get_item(self, item_id):
+        with self._data.lock:
+            item = self._data.items.get(item_id)
+        if not item:
+            return False, None, None
+        return True, item[0], item[1]
+
+    def iter_items(self, limit=None, after=None):
+        with self._data.lock:
+            item_ids = (item_id for item_id in self._data.items if after is None or item_id > after)
+            item_ids = sorted(item_ids) if limit is None else heapq.nsmallest(limit, item_ids)
+            items = [{"id": item_id, "node": self.node_id, "crc": self._data.items[item_id][1], }
+                     for item_id in item_ids]
+        yield from items
+
+    # EDITS
+
+    def enqueue_client_edits(self, other_node_id, item_id, diffs, hash_, n_rev, m_rev, old_shadow):
+        with self._data.lock:
+            edit_key = (item_id, other_node_id, n_rev)
+            if edit_key in self._data.edit_keys:
+                log.error(f"edits {item_id} {other_node_id} {n_rev} already queued")
+                raise Exception
+            rowid = self._next_rowid()
+            self._set(self._data.edits, rowid, {"item": item_id, "other_node": other_node_id, "n_rev": n_rev,
+                                                "m_rev": m_rev, "edits": diffs, "hash": hash_,
+                                                "old_shadow": old_shadow, "piggybacked": 0})
+            self._set(self._data.edit_keys, edit_key, rowid)
+
+    def get_queued_edits(self, other_node_id, limit):
+        with self._data.lock:
+            edits = [dict(edit, rowid=rowid) for rowid, edit in self._data.edits.items()
+                     if edit["other_node"] == other_node_id]
+        return sorted(edits, key=lambda edit: edit["n_rev"])[:limit]
+
+    def get_item_queued_edits(self, other_node_id, item_id, limit):
+        with self._data.lock:
+            edits = [dict(edit, rowid=rowid) for rowid, edit in self._data.edits.items()
+                     if edit["other_node"] == other_node_id and edit["item"] == item_id]
+        return sorted(edits, key=lambda edit: edit["n_rev"])[:limit]
+
+    def archive_edits(self, edit_rowids):
+        with self._data.lock:
+            for edit_rowid in edit_rowids:
+                edit = self._data.edits.get(edit_rowid)
+                if edit:
+                    archived = dict(edit)
+                    del archived["piggybacked"]
+                    self._set(self._data.archive, (ARCHIVE_EDIT, edit["item"], edit["other_node"], edit["n_rev"]),
+                              archived)
+
+    def mark_edits_piggybacked(self, edit_rowids):
+        with self._data.lock:
+            for edit_rowid in edit_rowids:
+                edit = self._data.edits.get(edit_rowid)
+                if edit:
+                    self._set(self._data.edits, edit_rowid, dict(edit, piggybacked=1))
+
+    def delete_edits(self, edit_rowids):
+        with self._data.lock:
+            for edit_rowid in edit_rowids:
+                edit = self._data.edits.get(edit_rowid)
+                if edit:
+                    self._delete(self._data.edit_keys, (edit["item"], edit["other_node"], edit["n_rev"]))
+                    self._delete(self._data.edits, edit_rowid)
+
+    # PATCHES
+
+    def save_new_patches(self, other_node_id, item_id, patches, n_rev, m_rev, crc):
+        with self._data.lock:
+            self._set(self._data.patches, (item_id, other_node_id, n_rev),
+                      {"rowid": self._next_rowid(), "m_rev": m_rev, "patches": patches, "crc": crc})
+
+    def check_if_patch_done(self, other_node_id, item_id, n_rev, m_rev):
+        with self._data.lock:
+            patch = self._data.archive.get((ARCHIVE_PATCH, item_id, other_node_id, n_rev))
+        return bool(patch and patch["m_rev"] == m_rev)
+
+    def check_if_patch_received(self, other_node_id, item_id, n_rev, m_rev):
+        with self._data.lock:
+            patch = self._data.patches.get((item_id, other_node_id, n_rev))
+        return bool(patch and patch["m_rev"] == m_rev) or self.check_if_patch_done(other_node_id, item_id, n_rev,
+                                                                                    m_rev)
+
+    def get_nodes_from_patches(self):
+        first_rowids = {}
+        with self._data.lock:
+            for (_, other_node, _), patch in self._data.patches.items():
+                first_rowids[other_node] = min(patch["rowid"], first_rowids.get(other_node, patch["rowid"]))
+        return sorted(first_rowids, key=first_rowids.get)
+
+    def get_first_patches(self, other_node, limit):
+        with self._data.lock:
+            patches = [(patch["m_rev"], n_rev, patch["rowid"], item, patch["patches"], patch["crc"])
+                       for (item, patch_node, n_rev), patch in self._data.patches.items() if patch_node == other_node]
+        return [(item, other_node, n_rev, m_rev, patch, crc)
+                for m_rev, n_rev, _, item, patch, crc in heapq.nsmallest(limit, patches)]
+
+    def claim_patches(self, other_node, worker, limit, lease):
+        now = time.time()
+        with self._data.lock:
+            taken = {item for (item, _, _), patch in self._data.patches.items()
+                     if _claimed_by_other(patch, worker, now)}
+            patches = [(patch["m_rev"], n_rev, patch["rowid"], item, patch["patches"], patch["crc"])
+                       for (item, patch_node, n_rev), patch in self._data.patches.items()
+                       if patch_node == other_node and item not in taken]
+            claimed = []
+            for m_rev, n_rev, _, item, patch, crc in heapq.nsmallest(limit, patches):
+                key = (item, other_node, n_rev)
+                self._set(self._data.patches, key, dict(self._data.patches[key], claimed_by=worker,
+                                                        lease_until=now + lease))
+                claimed.append((item, other_node, n_rev, m_rev, patch, crc))
+        return claimed
+
+    def release_patches(self, patch_keys, worker):
+        with self._data.lock:
+            for patch_key in patch_keys:
+                patch = self._data.patches.get(tuple(patch_key))
+                if patch and patch.get("claimed_by") == worker:
+                    self._set(self._data.patches, tuple(patch_key), dict(patch, claimed_by=None, lease_until=None))
+
+    def archive_patches(self, patch_keys):
+        with self._data.lock:
+            for item, other_node, n_rev in patch_keys:
+                patch = self._data.patches.get((item, other_node, n_rev))
+                if patch:
+                    self._set(self._data.archive, (ARCHIVE_PATCH, item, other_node, n_rev),
+                              {"item": item, "other_node": other_node, "n_rev": n_rev, "m_rev": patch["m_rev"],
+                               "patches": patch["patches"], "crc": patch["crc"]})
+
+    def delete_patches(self, patch_keys):
+        for patch_key in patch_keys:
+            self._delete(self._data.patches, tuple(patch_key))
+
+    # ARCHIVE
+
+    def get_archived(self, kind, item, other_node, n_rev):
+        with self._data.lock:
+            archived = self._data.archive.get((kind, item, other_node, n_rev))
+        if archived is None:
+            return None
+        return dict(archived)
+
+    def get_archived_revs(self, kind, item):
+        with self._data.lock:
+            return sorted((other_node, n_rev, archived["m_rev"])
+                          for (archived_kind, archived_item, other_node, n_rev), archived in self._data.archive.items()
+                          if archived_kind == kind and archived_item == item)
+
+    def move_legacy_archives(self, batch_size):
+        return 0
@@ -0,0 +1,248 @@
+import bisect
+import inspect
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from util import get_log
+
+log = get_log('critical')
+
+# upper bounds of the latency histogram buckets, in milliseconds. The last bucket takes everything slower
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+DEFAULT_SLOW_THRESHOLD_MS = 200
+SLOW_LOG_SIZE = 50
+
+_local = threading.local()
+
+
+def count_rows(rows):
+    # rows read or written by this thread, see timed()
+    _local.rows = getattr(_local, 'rows', 0) + rows
+
+
+def _rows():
+    return getattr(_local, 'rows', 0)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms, rows):
+        self.count += 1
+        self.total += elapsed_ms
+        self.max = max(self.max, elapsed_ms)
+        self.rows += rows
+        self.buckets[bisect.bisect_left(BUCKETS_MS, elapsed_ms)] += 1
+
+    def merge(self, other):
+        self.count += other["count"]
+        self.total += other["total_ms"]
+        self.max = max(self.max, other["max_ms"])
+        self.rows += other["rows"]
+        for i, bucket_count in enumerate(other["buckets"]):
+            self.buckets[i] += bucket_count
+
+    def percentile(self, fraction):
+        # upper bound of the bucket the percentile falls in, the max for the last one
+        seen = 0
+        for i, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= self.count * fraction:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total, 3),
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max, 3),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "rows": self.rows,
+            "buckets": list(self.buckets),
+        }
+
+
+class Metrics(object):
+    # process-wide latency histograms and row counts by operation name ("db.get_item", "db.lock_wait",
+    # "http.send_sync", "diff.create_diff_edits"...), counters of events ("db.busy"...) and the latest operations
+    # slower than slow_threshold_ms
+
+    def __init__(self, slow_threshold_ms=DEFAULT_SLOW_THRESHOLD_MS):
+        self.slow_threshold_ms = slow_threshold_ms
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self._histograms = {}
+        self._counters = {}
+        self._slow = deque(maxlen=SLOW_LOG_SIZE)
+
+    def record(self, name, elapsed, rows=0, detail=None):
+        elapsed_ms = elapsed * 1000
+        with self.lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(elapsed_ms, rows)
+            slow = self.slow_threshold_ms and elapsed_ms >= self.slow_threshold_ms
+            if slow:
+                self._slow.append({"name": name, "ms": round(elapsed_ms, 3), "rows": rows, "detail": detail,
+                                   "at": time.time()})
+        if slow:
+            log.warning(f"slow {name}: {elapsed_ms:.1f} ms, {rows} rows {detail or ''}")
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "started": self.started,
+                "slow_threshold_ms": self.slow_threshold_ms,
+                "operations": {name: histogram.to_dict() for name, histogram in sorted(self._histograms.items())},
+                "counters": dict(sorted(self._counters.items())),
+                "slow": list(self._slow),
+            }
+
+    def merge(self, snapshot):
+        # adds up the snapshot of another process, a worker cycle for example
+        with self.lock:
+            self.started = min(self.started, snapshot["started"])
+            for name, other in snapshot["operations"].items():
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    histogram = self._histograms[name] = Histogram()
+                histogram.merge(other)
+            for name, count in snapshot.get("counters", {}).items():
+                self._counters[name] = self._counters.get(name, 0) + count
+            self._slow.extend(snapshot["slow"])
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self._histograms.clear()
+            self._counters.clear()
+            self._slow.clear()
+
+
+METRICS = Metrics()
+
+
+def get_metrics():
+    return METRICS
+
+
+def _detail(args):
+    details = []
+    for arg in args:
+        detail = repr(arg)
+        details.append(detail if len(detail) <= 60 else f"{detail[:60]}...")
+    return f"({', '.join(details)})"
+
+
+def timed(name):
+    # records how long each call takes and how many rows it reads or writes. A generator is timed until it is
+    # exhausted or closed
+    def decorator(func):
+        # the arguments of a slow call go to the slow log, without self for a method
+        skip = 1 if "." in func.__qualname__ else 0
+
+        def record(start, rows_before, args):
+            elapsed = time.perf_counter() - start
+            detail = _detail(args[skip:]) if elapsed * 1000 >= METRICS.slow_threshold_ms else None
+            METRICS.record(name, elapsed, _rows() - rows_before, detail)
+
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                rows_before = _rows()
+                try:
+                    yield from func(*args, **kwargs)
+                finally:
+                    record(start, rows_before, args)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                rows_before = _rows()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    record(start, rows_before, args)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timer(name, detail=None):
+    # the same as timed() for a block of code
+    start = time.perf_counter()
+    rows_before = _rows()
+    try:
+        yield
+    finally:
+        METRICS.record(name, time.perf_counter() - start, _rows() - rows_before, detail)
+
+
+def instrument(prefix):
+    # class decorator: times every public method, including the inherited ones, as "<prefix>.<method>". Not the
+    # context managers, what matters there is the block
+    def decorator(cls):
+        for name, func in inspect.getmembers(cls, inspect.isfunction):
+            if not name.startswith('_') and not inspect.isgeneratorfunction(getattr(func, '__wrapped__', None)):
+                setattr(cls, name, timed(f"{prefix}.{name}")(func))
+        return cls
+    return decorator
+
+
+def dump_metrics(path=None):
+    # logs a line per operation and, if path is given, writes the whole snapshot there as json
+    snapshot = METRICS.snapshot()
+    for name, histogram in snapshot["operations"].items():
+        log.info(f"{name}: {histogram['count']} calls, mean {histogram['mean_ms']} ms, p95 {histogram['p95_ms']} ms, "
+                 f"max {histogram['max_ms']} ms, {histogram['rows']} rows")
+    for name, count in snapshot["counters"].items():
+        log.info(f"{name}: {count}")
+    if path:
+        with open(path, 'w') as metrics_file:
+            json.dump(snapshot, metrics_file, indent=2)
+    return snapshot
+
+
+def load_metrics(path):
+    # a snapshot saved by dump_metrics or save_metrics, None if there is none yet
+    try:
+        with open(path) as metrics_file:
+            return json.load(metrics_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_metrics(path):
+    # adds what this process recorded to the snapshot in path and starts over. The out.py and patch.py cycles run in
+    # a new process each, this is how their numbers outlive them
+    total = Metrics(METRICS.slow_threshold_ms)
+    saved = load_metrics(path)
+    if saved:
+        total.merge(saved)
+    total.merge(METRICS.snapshot())
+    METRICS.reset()
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as metrics_file:
+        json.dump(total.snapshot(), metrics_file)
+    os.replace(temp_path, path)
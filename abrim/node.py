@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os
 import subprocess
 import threading
 import time
@@ -17,6 +18,8 @@ def main():
     if not node_id or not client_port:
         pass
     else:
+        # the components wake each other up through the ports after client_port, see bus.py
+        os.environ['ABRIM_BUS_PORT'] = str(client_port)
         proc_ui, thread_ui = launch_subprocess('ui.py', "UI___", node_id, client_port)
         proc_queue_in, thread_queue_in = launch_subprocess('input.py', "INPUT", node_id, client_port + 1)
         proc_queue_out, thread_queue_out = launch_subprocess('out.py', "OUT__", node_id, client_port + 2)
@@ -6,12 +6,17 @@ import time
 import requests
 import json
 from abrim.util import get_log, args_init, response_parse, post_request, put_request, get_crc, ROUTE_FOR
-from abrim.config import Config
+from abrim.config import Config, get_shard_count
+from abrim.sync import sync_edits
+from metrics import save_metrics, timed
+from storage import BusyError
+from bus import Listener, notify, PATCH_ENQUEUED, OUT
 
 
 log = get_log('critical')
 
 
+@timed("http.send_sync")
 def send_sync(edit, other_node_url, use_put=False):
     try:
         if use_put:
@@ -39,6 +44,32 @@ def send_sync(edit, other_node_url, use_put=False):
         raise
 
 
+@timed("http.send_bulk_sync")
+def send_bulk_sync(edits, bulk_sync_url):
+    # a (response_http, api_unique_code, response_dict) per edit, None if the other node can't take them at once
+    # (it predates POST /items/sync/<node>, is busy or failed), so they're sent one by one
+    try:
+        p_response = post_request(bulk_sync_url, {"edits": edits})
+        api_unique_code, response_http, response_dict = response_parse(p_response)
+        results = response_dict['content']['results']
+    except (requests.exceptions.RequestException, json.decoder.JSONDecodeError, KeyError, TypeError) as err:
+        log.debug(f"no bulk sync: {err}")
+        return None
+    if api_unique_code != "queue_in/post_bulk_sync/200/ok" or len(results) != len(edits):
+        log.debug(f"no bulk sync: {api_unique_code}")
+        return None
+    return [_answer(result) for result in results]
+
+
+def _answer(result):
+    # (response_http, api_unique_code, response_dict) of an edit in a bulk sync or a stack
+    return int(result['api_unique_code'].split('/')[2]), result['api_unique_code'], result
+
+
+def prepare_bulk_sync_url(config_, other_node_url):
+    return f"{other_node_url}{ROUTE_FOR['items']}/sync/{config_.node_id}"
+
+
 def prepare_sync_url(config_, item_id, other_node_url, shadow=False):
     sync_or_shadow = 'sync'
     if shadow:
@@ -51,8 +82,252 @@ def prepare_shadow_url(config_, item_id, other_node_url):
     return prepare_sync_url(config_, item_id, other_node_url, shadow=True)
 
 
-def process_out_queue(lock, node_id, port):
-    config = Config(node_id, port)
+# the nodes that didn't take a bulk sync this cycle
+_no_bulk_sync = set()
+
+
+# what to do with an edit after trying to send it
+EDIT_DONE = "done"  # the other node has it: archive it and delete it from the queue
+EDIT_DROPPED = "dropped"  # the other node sent its own text to use as shadow: just delete it
+EDIT_RETRY = "retry"  # leave it queued and stop sending this batch
+
+
+def _sync_payload(edit):
+    payload = {key: edit[key] for key in ("n_rev", "m_rev", "edits", "hash")}
+    if edit.get("piggybacked"):
+        # the other node may have it already, see sync.sync_edit
+        payload["piggybacked"] = True
+    return payload
+
+
+def _receive_edits(config, other_node_id, item, response_dict):
+    # the edits the other node had queued for us for this item, in its answer to our sync, synced here as if it had
+    # sent them. In the caller's transaction. Only when they follow our latest shadow, if not they wait to come from
+    # the other node's out.py as usual. Returns how many were enqueued
+    content = response_dict.get('content')
+    r_edits = content.get('edits') if isinstance(content, dict) else None
+    if not r_edits or not isinstance(r_edits, list):
+        return 0
+    try:
+        sync_requests = [(item, (r_edit['n_rev'], r_edit['m_rev'], r_edit['hash'], r_edit['edits'], False))
+                         for r_edit in r_edits]
+    except (KeyError, TypeError):
+        log.warning(f"malformed edits from {other_node_id} for {item}")
+        return 0
+    n_rev, _ = config.db.get_latest_revs(item, other_node_id)
+    if sync_requests[0][1][0] != n_rev:
+        log.debug(f"the edits from {other_node_id} for {item} don't follow our shadow {n_rev}")
+        return 0
+    results = sync_edits(config, other_node_id, sync_requests)
+    log.debug(f"{results.count(None)} of {len(results)} edits from {other_node_id} for {item} received")
+    return results.count(None)
+
+
+def _send_edit(config, other_node_id, other_node_url, edit, send=None):
+    # returns the EDIT_* outcome and how many seconds to wait before sending more to this node. send() returns the
+    # other node's (response_http, api_unique_code, response_dict) for the edit when it goes in a bulk sync or a
+    # stack, if not the edit is sent on its own. Nothing is saved here, what the answer asks to save is left in the
+    # edit for _save_batch
+    item = edit["item"]
+    old_shadow = edit.get("old_shadow", "")
+    n_rev = edit["n_rev"]
+    m_rev = edit["m_rev"]
+    payload = _sync_payload(edit)
+
+    log.debug(f"other_node_url: {other_node_url}")
+    sync_url = prepare_sync_url(config, item, other_node_url)
+
+    try:
+        if send:
+            response_http, api_unique_code, response_dict = send()
+        else:
+            log.debug(f"about to send {payload} to {sync_url}")
+            response_http, api_unique_code, response_dict = send_sync(payload, sync_url)
+
+        try:
+            response_http = int(response_http)
+        except TypeError:
+            response_http = 0
+
+        if response_http == 201:
+            if (
+                    api_unique_code == "queue_in/post_sync/201/done" or
+                    api_unique_code == "queue_in/post_sync/201/ack" or
+                    api_unique_code == "queue_in/post_sync/201/lost_return_packet" or
+                    api_unique_code == "queue_in/post_sync/201/already_synced"):
+                log.debug("POST successful, archiving this item to queue_2_sent")
+                if api_unique_code == "queue_in/post_sync/201/ack":
+                    log.info("EVENT: remote node seems overloaded") #  TODO: save events
+                if api_unique_code == "queue_in/post_sync/201/done":
+                    edit["answer"] = response_dict
+                log.debug("-----------------------------------------------------------------")
+                return EDIT_DONE, 0
+            else:
+                raise Exception("implement me! 8")
+        elif response_http == 404:  # the other node doesn't find a shadow, send it
+            if api_unique_code == "queue_in/post_sync/404/not_shadow":
+                log.info("queue_in/post_sync/404/not_shadow")
+                shadow_json = {'n_rev': n_rev,
+                               'm_rev': m_rev,
+                               'shadow': old_shadow}
+
+                log.debug("trying to send the shadow again")
+                shadow_url = prepare_shadow_url(config, item, other_node_url)
+                shad_http, shad_api_unique_code, response_dict = send_sync(shadow_json, shadow_url, use_put=True)
+                if shad_http == 201 and shad_api_unique_code == "queue_in/put_shadow/201/ack":
+                    log.info("EVENT: remote needed the shadow") #  TODO: save events
+                elif shad_http == 201 and shad_api_unique_code == "queue_in/put_shadow/201/lost_return_packet":
+                    log.info("EVENT: it seems that previously we have lost a return packet from that remote node")
+                else:
+                    raise Exception("implement me! 2")
+                return EDIT_RETRY, 0
+            else:
+                raise Exception("implement me! 3")
+        elif response_http == 409:
+            if api_unique_code == "queue_in/post_sync/409/previous_edit_failed":
+                return EDIT_RETRY, 0  # bulk sync only, the other node didn't try it
+            elif api_unique_code == "queue_in/post_sync/409/use_this_as_shadow":
+                try:
+                    log.debug("use_this_as_shadow: deleting this edit")
+                    resp_crc = response_dict['content']['crc']
+                    resp_text = response_dict['content']['text']
+                except KeyError:
+                    raise Exception("implement me! 7")
+                edit["use_this_as_shadow"] = (resp_text, resp_crc)
+                return EDIT_DROPPED, 0  # <- FIXME CHANGE ME to create an entry for patch to recreate edit
+            elif api_unique_code == "queue_in/post_sync/403/no_match_revs":
+                log.debug("queue_in/post_sync/403/no_match_revs")
+                raise Exception("implement me! 4")
+            elif api_unique_code == "queue_in/post_sync/403/check_crc":
+                raise Exception("implement me! 5")
+            else:
+                raise Exception("implement me! 6")
+        elif response_http == 500:
+            log.debug("other node is responding with HTTP Error 500... sleep 5 secs")
+            return EDIT_RETRY, 5  # TODO make this adaptative and break the for loop for the nodes whose wait time is not finished yet
+        elif response_http == 503:
+            log.debug("other node is busy... sleep 1 sec")
+            return EDIT_RETRY, 1
+        else:
+            # raise for the rest of the codes
+            log.error(f"Undefined HTTP response: {response_http} {api_unique_code}")
+            raise Exception("Undefined HTTP response")  # fail for the rest of HTTP codes
+    except requests.exceptions.ConnectionError:
+        log.debug("other node seems offline... sleep 5 secs")
+        return EDIT_RETRY, 5  # TODO make this adaptative and break the for loop for the nodes whose wait time is not finished yet
+    except (requests.exceptions.HTTPError,
+            requests.exceptions.ReadTimeout,
+            json.decoder.JSONDecodeError,
+            KeyError,
+            Exception, ) as err:
+        log.debug(err)
+        traceback.print_exc()
+        log.debug("Exception... sleep 15 secs")
+        return EDIT_RETRY, 15
+
+
+def _send_bulk(config, other_node_url, edits):
+    # the other node's answer for each edit, None to send them one by one. A node that didn't take a bulk sync
+    # isn't asked again until the next cycle, the next worker process
+    if len(edits) < 2 or other_node_url in _no_bulk_sync:
+        return None
+    payload = [dict(_sync_payload(edit), item=edit["item"]) for edit in edits]
+    results = send_bulk_sync(payload, prepare_bulk_sync_url(config, other_node_url))
+    if results is None:
+        _no_bulk_sync.add(other_node_url)
+    return results
+
+
+def _send_stack(config, other_node_id, other_node_url, stack):
+    # the queued edits of an item, oldest first, in one message. The other node applies them in order and answers
+    # each one, unless it doesn't know stacks and only syncs the first. Returns the (edit, outcome, wait) of the
+    # edits answered
+    if len(stack) == 1:
+        return [(stack[0],) + _send_edit(config, other_node_id, other_node_url, stack[0])]
+    stack_answers = []
+
+    def send():
+        payload = dict(_sync_payload(stack[0]), stack=[_sync_payload(edit) for edit in stack])
+        sync_url = prepare_sync_url(config, stack[0]["item"], other_node_url)
+        log.debug(f"about to send {len(stack)} edits to {sync_url}")
+        answer = send_sync(payload, sync_url)
+        content = answer[2].get('content')
+        answers = content.get('stack') if isinstance(content, dict) else None
+        if isinstance(answers, list) and len(answers) == len(stack):
+            stack_answers.extend(_answer(result) for result in answers)
+        return answer
+
+    outcomes = [(stack[0],) + _send_edit(config, other_node_id, other_node_url, stack[0], send)]
+    for edit, answer in zip(stack[1:], stack_answers[1:]):
+        outcomes.append((edit,) + _send_edit(config, other_node_id, other_node_url, edit, lambda answer=answer: answer))
+    return outcomes
+
+
+def _stacks(edits):
+    # the edits of each item, in the order of their first edit
+    stacks = {}
+    for edit in edits:
+        stacks.setdefault(edit["item"], []).append(edit)
+    return list(stacks.values())
+
+
+def _send_batch(config, other_node_id, other_node_url, limit):
+    # sends up to limit queued edits, all in a request if the other node takes bulk syncs, if not a request per item
+    # with its stack of edits, an item at a time up to the first item with an edit not delivered (in bulk the other
+    # node stops at the first edit of an item that fails). No transaction is open meanwhile, the node's other
+    # components keep writing while the other node answers. Returns the (edit, outcome, wait) of each edit sent
+    edits = get_queued_edits(config, other_node_id, limit)
+    bulk_answers = _send_bulk(config, other_node_url, edits)
+    if bulk_answers:
+        outcomes = [(edit,) + _send_edit(config, other_node_id, other_node_url, edit, lambda answer=answer: answer)
+                    for edit, answer in zip(edits, bulk_answers)]
+    else:
+        outcomes = []
+        for stack in _stacks(edits):
+            stack_outcomes = _send_stack(config, other_node_id, other_node_url, stack)
+            outcomes.extend(stack_outcomes)
+            if any(outcome == EDIT_RETRY for _, outcome, _ in stack_outcomes):
+                break
+    return outcomes
+
+
+def _save_batch(config, other_node_id, outcomes):
+    # in the caller's transaction, only storage work so it can run again if the storage is busy: archives and
+    # deletes the delivered edits, deletes the dropped ones and saves what the other node sent back. Returns if any
+    # was delivered and how many edits of the other node came back in the answers
+    done_rowids = []
+    dropped_rowids = []
+    received = 0
+    for edit, outcome, _ in outcomes:
+        if outcome == EDIT_DONE:
+            done_rowids.append(edit["rowid"])
+            if "answer" in edit:
+                received += _receive_edits(config, other_node_id, edit["item"], edit["answer"])
+        elif outcome == EDIT_DROPPED:
+            dropped_rowids.append(edit["rowid"])
+            resp_text, resp_crc = edit["use_this_as_shadow"]
+            config.db.save_new_shadow(other_node_id, edit["item"], resp_text, 1, 1, resp_crc)
+
+    if done_rowids:
+        config.db.archive_edits(done_rowids)
+    if done_rowids or dropped_rowids:
+        config.db.delete_edits(done_rowids + dropped_rowids)
+    return bool(done_rowids), received
+
+
+def process_out_queue(lock, node_id, port, shard=None):
+    config = Config(node_id, port, shard=shard)
+    try:
+        _process_out_queue(lock, config)
+    finally:
+        # this process only lasts a cycle
+        metrics_path = config.metrics_path("out")
+        if metrics_path:
+            with lock:
+                save_metrics(metrics_path)
+
+
+def _process_out_queue(lock, config):
     # config.db.sql_debug_trace(True)
 
     # lock.acquire()
@@ -66,152 +341,64 @@ def process_out_queue(lock, node_id, port):
         if other_node_url:
             queue_limit = config.edit_queue_limit
             while queue_limit > 0:
-                config.db.start_transaction()
-                # config.db.sql_debug_trace(True)
-                edit = get_first_queued_edit(config, other_node_id)
-
-                if not edit:
+                limit = min(config.edit_batch_size, queue_limit)
+                outcomes = _send_batch(config, other_node_id, other_node_url, limit)
+                if not outcomes:
                     break
-                rowid = edit.pop("rowid")
-                item = edit.pop("item")
-                old_shadow = edit.pop("old_shadow", "")
-
-                n_rev = edit["n_rev"]
-                m_rev = edit["m_rev"]
-
-                edit.pop("other_node", None)
-                edit.pop("item", None)
-
-                log.debug(f"other_node_url: {other_node_url}")
-                sync_url = prepare_sync_url(config, item, other_node_url)
-
                 try:
-                    log.debug(f"about to send {edit} to {sync_url}")
-                    response_http, api_unique_code, response_dict = send_sync(edit, sync_url)
-
-                    try:
-                        response_http = int(response_http)
-                    except TypeError:
-                        response_http = 0
-
-                    if response_http == 201:
-                        if (
-                                api_unique_code == "queue_in/post_sync/201/done" or
-                                api_unique_code == "queue_in/post_sync/201/ack" or
-                                api_unique_code == "queue_in/post_sync/201/lost_return_packet"):
-                            log.debug("POST successful, archiving this item to queue_2_sent")
-                            config.db.archive_edit(rowid)
-                            config.db.delete_edit(rowid)
-                            config.db.end_transaction()
-                            if api_unique_code == "queue_in/post_sync/201/ack":
-                                log.info("EVENT: remote node seems overloaded") #  TODO: save events
-                            log.debug("-----------------------------------------------------------------")
-                        else:
-                            raise Exception("implement me! 8")
-                    elif response_http == 404:  # the other node doesn't find a shadow, send it
-                        if api_unique_code == "queue_in/post_sync/404/not_shadow":
-                            log.info("queue_in/post_sync/404/not_shadow")
-                            config.db.rollback_transaction()
-                            shadow_json = {'n_rev': n_rev,
-                                           'm_rev': m_rev,
-                                           'shadow': old_shadow}
-
-                            log.debug("trying to send the shadow again")
-                            shadow_url = prepare_shadow_url(config, item, other_node_url)
-                            shad_http, shad_api_unique_code, response_dict = send_sync(shadow_json, shadow_url, use_put=True)
-                            if shad_http == 201 and shad_api_unique_code == "queue_in/put_shadow/201/ack":
-                                log.info("EVENT: remote needed the shadow") #  TODO: save events
-                            elif shad_http == 201 and shad_api_unique_code == "queue_in/put_shadow/201/lost_return_packet":
-                                log.info("EVENT: it seems that previously we have lost a return packet from that remote node")
-                            else:
-                                config.db.rollback_transaction()
-                                raise Exception("implement me! 2")
-                        else:
-                            config.db.rollback_transaction()
-                            raise Exception("implement me! 3")
-                    elif response_http == 409:
-                        if api_unique_code == "queue_in/post_sync/409/use_this_as_shadow":
-                            try:
-                                log.debug("use_this_as_shadow: deleting this edit")
-                                resp_crc = response_dict['content']['crc']
-                                resp_text = response_dict['content']['text']
-
-                                config.db.save_new_shadow(other_node_id, item, resp_text, 1, 1, resp_crc)
-                                config.db.delete_edit(rowid)  # <- FIXME CHANGE ME to create an entry for patch to recreate edit
-                                config.db.end_transaction()
-                            except KeyError:
-                                raise Exception("implement me! 7")
-                        elif api_unique_code == "queue_in/post_sync/403/no_match_revs":
-                            log.debug("queue_in/post_sync/403/no_match_revs")
-                            config.db.rollback_transaction()
-                            raise Exception("implement me! 4")
-                        elif api_unique_code == "queue_in/post_sync/403/check_crc":
-                            raise Exception("implement me! 5")
-                        else:
-                            raise Exception("implement me! 6")
-                    elif response_http == 500:
-                        log.debug("other node is responding with HTTP Error 500... sleep 5 secs")
-                        config.db.rollback_transaction()
-                        time.sleep(5)  # TODO make this adaptative and break the for loop for the nodes whose wait time is not finished yet
-                    else:
-                        # raise for the rest of the codes
-                        log.error(f"Undefined HTTP response: {response_http} {api_unique_code}")
-                        config.db.rollback_transaction()
-                        raise Exception("Undefined HTTP response")  # fail for the rest of HTTP codes
-                except requests.exceptions.ConnectionError:
-                    log.debug("other node seems offline... sleep 5 secs")
-                    config.db.rollback_transaction()
-                    time.sleep(5) # TODO make this adaptative and break the for loop for the nodes whose wait time is not finished yet
-                except (requests.exceptions.HTTPError,
-                        requests.exceptions.ReadTimeout,
-                        json.decoder.JSONDecodeError,
-                        KeyError,
-                        Exception, ) as err:
-                    config.db.rollback_transaction()
-                    log.debug(err)
-                    traceback.print_exc()
-                    log.debug("Exception... sleep 15 secs")
-                    time.sleep(15)
-                finally:
-                    queue_limit -= 1
-            config.db.end_transaction(True)
-
-    if config.db.check_transaction():
-        config.db.end_transaction(True)
+                    delivered, received = config.db.run_transaction(
+                        lambda: _save_batch(config, other_node_id, outcomes), "edits batch")
+                except BusyError as err:
+                    # they stay queued and are sent again next cycle
+                    log.warning(f"not saving what {other_node_id} got this cycle: {err}")
+                    break
+                queue_limit -= len(outcomes)
+                wait = max(edit_wait for _, _, edit_wait in outcomes)
+                if delivered:
+                    result = True
+                if received:
+                    notify(PATCH_ENQUEUED)
+                if wait:
+                    time.sleep(wait)
+
     if result:
         lock.acquire()
         log.info("one entry from queue 1 was correctly processed")
         lock.release()
-    else:
-        lock.acquire()
-        #log.info("Nothing done! waiting 0.5 additional seconds")
-        lock.release()
-        time.sleep(0.5)  # TODO: make this adaptative
 
 
 def get_first_queued_edit(config, other_node_id):
     return config.db.get_first_queued_edit(other_node_id)
 
 
+def get_queued_edits(config, other_node_id, limit):
+    return config.db.get_queued_edits(other_node_id, limit)
+
+
 if __name__ == '__main__':
     log.info(f"{__file__} started")
     node_id_, client_port = args_init()
     if not node_id_ or not client_port:
         pass
     else:
+        shards = get_shard_count()
+        # input.py and patch.py say when they enqueue edits, so they don't wait for the next cycle
+        listener = Listener()
+        listener.listen(OUT)
         while True:
+            seen = listener.events
             lock = multiprocessing.Lock()
-            p = multiprocessing.Process(target=process_out_queue, args=(lock, node_id_, client_port ))
-            p_name = p.name
-            # log.debug(p_name + " starting up")
-            p.start()
-            # Wait for x seconds or until process finishes
-            p.join(30)
-            if p.is_alive():
-                log.debug(f"{p_name} timeouts")
-                p.terminate()
-                p.join()
-            else:
-                # log.debug(p_name + " finished ok")
-                pass
-            time.sleep(3)  # TODO: make this adaptative
+            # a worker per shard, they write to different files so they don't wait for each other
+            processes = [multiprocessing.Process(target=process_out_queue, args=(lock, node_id_, client_port, shard))
+                         for shard in (range(shards) if shards > 1 else (None,))]
+            for p in processes:
+                p.start()
+            # Wait for x seconds or until the processes finish
+            deadline = time.time() + 30
+            for p in processes:
+                p.join(max(0, deadline - time.time()))
+                if p.is_alive():
+                    log.debug(f"{p.name} timeouts")
+                    p.terminate()
+                    p.join()
+            listener.wait(3, seen)
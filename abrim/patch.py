@@ -2,46 +2,85 @@
 
 import multiprocessing
 import time
-from abrim.config import Config
+from abrim.config import Config, get_shard_count
+from metrics import save_metrics, timed, timer
+from storage import BusyError
+from bus import Listener, notify, EDIT_ENQUEUED, PATCH_APPLIED, PATCH
 from abrim.util import get_log, args_init, fuzzy_patch_text, get_crc, create_diff_edits, create_hash
 
 log = get_log('critical')
 
 
-def _check_first_patch(config, other_node):
-    return config.db.check_first_patch(other_node)
+def _claim_patches(config, other_node):
+    return config.db.claim_patches(other_node, config.worker_id, config.patch_batch_size, config.claim_lease)
 
 
 def _get_item(config, item_id):
     return config.db.get_item(item_id)
 
 
-def _patch_server_text(config, item, other_node, n_rev, patches, text, item_crc):
+@timed("diff.patch_server_text")
+def _patch_server_text(config, item, patches, text):
+    # the caller holds the transaction, so the server text can't change between reading and saving it
     patched_text, success = fuzzy_patch_text(patches, text)
     if not success:
         log.info("patching failed. just archive the patch")
-        config.db.start_transaction()
-        config.db.archive_patch(item, other_node, n_rev)
-        config.db.delete_patch(item, other_node, n_rev)
-        config.db.end_transaction()
         return False
 
-    config.db.start_transaction()
-    _, _, item_crc_again = _get_item(config, item)
-    # if the server text has not changed, save the new text
-    if item_crc == item_crc_again:
-        # config.db.save_item(item, patched_text)
-        _update_item(config, item, patched_text)
-        config.db.archive_patch(item, other_node, n_rev)
-        config.db.delete_patch(item, other_node, n_rev)
-        config.db.end_transaction()
-        log.info("patching ended ok")
-    else:
-        log.debug("server text changed meanwhile, cancelling this patch")
-        config.db.rollback_transaction()
+    # config.db.save_item(item, patched_text)
+    _update_item(config, item, patched_text)
+    log.info("patching ended ok")
     return True
 
 
+def _apply_patches(config, patches):
+    # returns the (item, other_node, n_rev) of the patches that are done, applied or not, and can be archived
+    done_patches = []
+    for patch_found_item, other_node, n_rev, m_rev, patches_text, crc in patches:
+        item_found, text, item_crc = _get_item(config, patch_found_item)
+        if not item_found:
+            if n_rev == 0 and m_rev == 0:  # if revs == 0 is a new so we can create an empty one
+                log.debug(f"creating new empty item for patch {patch_found_item}")
+                text = ""
+                item_crc = 1
+                config.db.save_new_item(patch_found_item, text, item_crc)
+            else:
+                log.error(f"no item {patch_found_item} for patch {n_rev}-{m_rev}, implement me! 4")
+                break
+
+        if crc == item_crc:
+            # original text from client is the same as current text from server, just apply the patch and finish
+            log.debug("CRCs match, client text and server text are the same")
+        else:
+            log.debug(f"CRCs don't match, different texts: {crc} - {item_crc}")
+
+        sucessful_patch = _patch_server_text(config, patch_found_item, patches_text, text)
+
+        if sucessful_patch:
+            log.debug("patch ok")
+        else:
+            log.error("patch failed")
+        done_patches.append((patch_found_item, other_node, n_rev))
+    return done_patches
+
+
+def _apply_post(config, item_id, new_text):
+    item_exists, item, _ = _check_item_exists(config, item_id)
+
+    if item_exists:
+        _update_item(config, item_id, new_text)
+    else:
+        _new_item(config, item_id, new_text)
+
+
+def _apply_patch_batch(config, patches):
+    done_patches = _apply_patches(config, patches)
+    if done_patches:
+        config.db.archive_patches(done_patches)
+        config.db.delete_patches(done_patches)
+    return done_patches
+
+
 def _check_item_exists(config, item_id):
     return config.db.get_item(item_id)
 
@@ -64,7 +103,8 @@ def _update_item(config, item_id, new_text):
 
         log.debug(f"latest revs for that item in {other_node_id} are {n_rev} - {m_rev}")
         log.debug(f"creating diffs")
-        diffs = create_diff_edits(new_text, old_shadow)  # maybe doing a slow blocking diff in a transaction is wrong
+        with timer("diff.create_diff_edits"):
+            diffs = create_diff_edits(new_text, old_shadow)  # maybe doing a slow blocking diff in a transaction is wrong
         if diffs:
             _enqueue_edit(config, other_node_id, item_id, diffs, n_rev, m_rev, old_shadow)
 
@@ -91,7 +131,8 @@ def _new_item(config, item_id, new_text):
 
         # create and enqueue the edit for the new item
         log.debug(f"creating diffs")
-        diffs = create_diff_edits(new_text, old_shadow)  # TODO: maybe doing a slow blocking diff in a transaction is wrong
+        with timer("diff.create_diff_edits"):
+            diffs = create_diff_edits(new_text, old_shadow)  # TODO: maybe doing a slow blocking diff in a transaction is wrong
         if diffs:
             _enqueue_edit(config, other_node_id, item_id, diffs, n_rev, m_rev, old_shadow)
 
@@ -103,80 +144,105 @@ def _new_item(config, item_id, new_text):
             log.warning("no diffs. Nothing done!")
 
 
-def process_out_patches(lock, node_id, port):
-    config = Config(node_id, port)
+def _compact_shadows(config):
+    after = None
+    deleted = 0
+    for _ in range(config.shadow_gc_batches):
+        batch_deleted, after = config.db.compact_shadows(config.shadow_gc_batch_size, after)
+        deleted += batch_deleted
+        if not after:
+            break
+    if deleted:
+        log.debug(f"{deleted} old shadows deleted")
+
+
+def _move_legacy_archives(config):
+    config.db.move_legacy_archives(config.legacy_archive_batch_size)
+
+
+def _delete_unreferenced_texts(config):
+    config.db.delete_unreferenced_texts(config.text_gc_batch_size)
+
+
+def _incremental_vacuum(config):
+    # after the clean ups above, a step at a time so the node never waits long for it
+    try:
+        freed = config.db.incremental_vacuum(config.vacuum_pages)
+    except BusyError as err:
+        log.debug(f"no vacuum this time: {err}")
+        return
+    if freed:
+        log.debug(f"{freed} free pages given back")
+
+
+def process_out_patches(lock, node_id, port, shard=None):
+    config = Config(node_id, port, shard=shard)
+    try:
+        _process_out_patches(lock, config)
+    finally:
+        # this process only lasts a cycle
+        metrics_path = config.metrics_path("patch")
+        if metrics_path:
+            with lock:
+                save_metrics(metrics_path)
+
+
+def _process_out_patches(lock, config):
     # config.db.sql_debug_trace(True)
 
     there_was_posts = False
     try:
-        rowid, item_id, new_text, _, _ = config.db.get_post_pending()
+        # any worker takes a post, but the posts of an item are applied one at a time in the order they came
+        rowid, item_id, new_text, _, _ = config.db.claim_post(config.worker_id, config.claim_lease)
         if rowid:
-            config.db.start_transaction("posts queue")
             there_was_posts = True
-            rowid, item_id, new_text, _, _ = config.db.get_post_pending()
-            item_exists, item, _ = _check_item_exists(config, item_id)
-
-            if item_exists:
-                _update_item(config, item_id, new_text)
-            else:
-                _new_item(config, item_id, new_text)
+            try:
+                config.db.run_transaction(lambda: _apply_post(config, item_id, new_text), "posts queue")
+            except Exception:
+                config.db.release_post(rowid, config.worker_id)
+                raise
+            # the posts queue is another file: marked once the item is committed, a crash in between applies the
+            # post again, which leaves the same text
             config.db.update_post_pending(rowid)
-
+            notify(EDIT_ENQUEUED)
     except Exception as err:
-        config.db.rollback_transaction()
         log.error(err)
-    else:
-        if there_was_posts:
-            config.db.end_transaction()
 
     there_was_nodes = False
-    # to avoid one node hoarding the queue, process one patch a time for each node
+    # to avoid one node hoarding the queue, process one batch of patches a time for each node
     for other_node_id in config.db.get_nodes_from_patches():
-        there_was_nodes = True
         log.debug(other_node_id)
+        # config.db.sql_debug_trace(True)
         try:
-            # config.db.sql_debug_trace(True)
-            patch_found_item, other_node, n_rev, m_rev, patches, crc = _check_first_patch(config, other_node_id)
-            if not patch_found_item:
-                log.debug("no patch found for this item for this node")
-                time.sleep(2)
-                raise Exception("implement me! 3")
-
-            config.db.start_transaction()
-            item_found, text, item_crc = _get_item(config, patch_found_item)
-            if not item_found:
-                if n_rev == 0 and m_rev == 0:  # if revs == 0 is a new so we can create an empty one
-                    log.debug(f"creating new empty item for patch {patch_found_item}")
-                    text = ""
-                    item_crc = 1
-                    config.db.save_new_item(patch_found_item, text, item_crc)
-                else:
-                    log.debug("no patch found for this item for this node")
-                    time.sleep(2)
-                    raise Exception("implement me! 4")
-            config.db.end_transaction()
-
-            if crc == item_crc:
-                # original text from client is the same as current text from server, just apply the patch and finish
-                log.debug("CRCs match, client text and server text are the same")
-            else:
-                log.debug(f"CRCs don't match, different texts: {crc} - {item_crc}")
-
-            sucessful_patch = _patch_server_text(config, patch_found_item, other_node, n_rev, patches, text, item_crc)
-
-            if sucessful_patch:
-                log.debug("patch ok")
-            else:
-                log.error("patch failed")
-
-        except TypeError:
-            # log.debug("no patches")
-            pass
+            # the items another worker is patching are left to it
+            patches = _claim_patches(config, other_node_id)
+            if not patches:
+                continue
+            there_was_nodes = True
+            patch_keys = [patch[:3] for patch in patches]
+            try:
+                done_patches = config.db.run_transaction(lambda: _apply_patch_batch(config, patches), "patches batch")
+            except Exception:
+                config.db.release_patches(patch_keys, config.worker_id)
+                raise
+            # the ones left for later, after a patch that couldn't be applied yet
+            left_patches = [patch_key for patch_key in patch_keys if patch_key not in done_patches]
+            if left_patches:
+                config.db.release_patches(left_patches, config.worker_id)
+            if done_patches:
+                # the sync requests waiting for them can answer, and the patched items have edits for the other nodes
+                notify(PATCH_APPLIED)
+                notify(EDIT_ENQUEUED)
+        except Exception as err:
+            log.error(err)
     if there_was_nodes or there_was_posts:
         log.debug("processed some patches or posts")
     else:
-        # log.debug("no processing done, sleeping for a bit")
-        time.sleep(0.5)  # TODO: make this adaptative
+        # log.debug("no processing done, cleaning up")
+        _compact_shadows(config)
+        _move_legacy_archives(config)
+        _delete_unreferenced_texts(config)
+        _incremental_vacuum(config)
 
 
 if __name__ == '__main__':
@@ -185,19 +251,24 @@ if __name__ == '__main__':
     if not node_id_ or not client_port:
         pass
     else:
+        shards = get_shard_count()
+        # input.py says when it enqueues patches or posts, so they don't wait for the next cycle
+        listener = Listener()
+        listener.listen(PATCH)
         while True:
+            seen = listener.events
             lock = multiprocessing.Lock()
-            p = multiprocessing.Process(target=process_out_patches, args=(lock, node_id_, client_port))
-            p_name = p.name
-            # log.debug(p_name + " starting up")
-            p.start()
-            # Wait for x seconds or until process finishes
-            p.join(30)
-            if p.is_alive():
-                log.debug(p_name + " timeouts")
-                p.terminate()
-                p.join()
-            else:
-                # log.debug(p_name + " finished ok")
-                pass
-            time.sleep(1)  # TODO: make this adaptative
+            # a worker per shard, they write to different files so they don't wait for each other
+            processes = [multiprocessing.Process(target=process_out_patches, args=(lock, node_id_, client_port, shard))
+                         for shard in (range(shards) if shards > 1 else (None,))]
+            for p in processes:
+                p.start()
+            # Wait for x seconds or until the processes finish
+            deadline = time.time() + 30
+            for p in processes:
+                p.join(max(0, deadline - time.time()))
+                if p.is_alive():
+                    log.debug(f"{p.name} timeouts")
+                    p.terminate()
+                    p.join()
+            listener.wait(1, seen)
@@ -0,0 +1,361 @@
+import copy
+import heapq
+import itertools
+import os
+import threading
+import zlib
+
+from datastore import DataStore, shard_path
+from storage import Storage, TransactionError
+from util import get_log
+
+log = get_log('critical')
+
+
+def shard_of(item_id, shards):
+    # stable between processes and runs, unlike hash()
+    return zlib.crc32(item_id.encode()) % shards
+
+
+class ShardedStorage(Storage):
+    # the items of a node spread over shards DataStore files by shard_of(item), each with its own items, shadows,
+    # edits, patches and archive, so writers of different items don't wait for the same sqlite lock. The nodes stay
+    # in the node's usual file, the catalog, and the posts queue in the catalog's posts file. A transaction starts on
+    # a shard (or the catalog) the first time it's used and ends on all of them: each item lives in one file, but a
+    # transaction that touches several files isn't atomic across them. The rowids of the edits say their shard.
+    # The shard count can't change once the node has items
+
+    def __init__(self, node_id, port, db_prefix="", drop_db=False, shards=2, **datastore_args):
+        if shards < 2:
+            log.error("a sharded storage needs at least 2 shards")
+            raise Exception
+        self.catalog = DataStore(node_id, port, db_prefix, drop_db, **datastore_args)
+        self.shards = [DataStore(node_id, port, db_prefix, drop_db, shard=shard, **datastore_args)
+                       for shard in range(shards)]
+        self.node_id = node_id
+        self.db_path = self.catalog.db_path
+        self.transaction_retries = self.catalog.transaction_retries
+        # what the queue and maintenance methods walk, all the shards unless only_shard() says otherwise
+        self.scanned = list(range(shards))
+        self._local = threading.local()
+        self._check_layout()
+
+    def _check_layout(self):
+        if self.catalog.get_items(1):
+            log.error(f"{self.catalog.db_path} already has items saved without shards")
+            raise Exception
+        extra_shard = shard_path(self.catalog.db_path, len(self.shards))
+        if os.path.exists(extra_shard):
+            log.error(f"{extra_shard} exists, this node had more than {len(self.shards)} shards")
+            raise Exception
+
+    def only_shard(self, shard):
+        # the same storage, but the queues, the item list and the maintenance only see one shard. For the out.py
+        # and patch.py workers, one per shard
+        sharded = copy.copy(self)
+        sharded._local = threading.local()
+        sharded.scanned = [shard]
+        return sharded
+
+    def get_reader(self):
+        reader = copy.copy(self)
+        reader._local = threading.local()
+        reader.catalog = self.catalog.get_reader()
+        reader.shards = [shard.get_reader() for shard in self.shards]
+        return reader
+
+    def _shard(self, item_id):
+        return self._use(self.shards[shard_of(item_id, len(self.shards))])
+
+    def _catalog(self):
+        return self._use(self.catalog)
+
+    def _scanned(self):
+        return [(shard, self._use(self.shards[shard])) for shard in self.scanned]
+
+    def _encode_rowid(self, rowid, shard):
+        return rowid * len(self.shards) + shard
+
+    def _decode_rowids(self, rowids):
+        # {DataStore: [its rowids]}
+        by_shard = {}
+        for rowid in rowids:
+            store = self._use(self.shards[rowid % len(self.shards)])
+            by_shard.setdefault(store, []).append(rowid // len(self.shards))
+        return by_shard
+
+    def _by_item(self, keys):
+        # {DataStore: [keys]} for keys that start with the item
+        by_shard = {}
+        for key in keys:
+            by_shard.setdefault(self._shard(key[0]), []).append(key)
+        return by_shard
+
+    # TRANSACTION
+
+    @property
+    def _started(self):
+        # the DataStores this thread's transaction has started on, None without a transaction
+        return getattr(self._local, 'started', None)
+
+    def _use(self, store):
+        started = self._started
+        if started is not None and store not in started:
+            store.start_transaction(self._local.msg)
+            started.append(store)
+        return store
+
+    def start_transaction(self, msg=None):
+        if self._started is not None:
+            log.error("cannot start a transaction within a transaction. Rolling back!!")
+            self.rollback_transaction()
+            raise TransactionError("already in a transaction")
+        self._local.msg = msg
+        self._local.started = []
+
+    def end_transaction(self, suppress_msg=False):
+        started = self._started
+        if started is None:
+            log.debug("explicit end requested, but transaction already ended")
+            return
+        try:
+            while started:
+                started[0].end_transaction(suppress_msg)
+                started.pop(0)
+        finally:
+            if started:
+                log.error(f"{len(started)} shards not committed. Rolling them back!!")
+                self.rollback_transaction()
+        self._local.started = None
+
+    def check_transaction(self):
+        return self._started is not None
+
+    def rollback_transaction(self, msg=""):
+        started = self._started
+        if started is None:
+            log.warning("tried to rollback a transaction but there was none!!")
+            return
+        self._local.started = None
+        for store in started:
+            if store.check_transaction():
+                store.rollback_transaction(msg)
+
+    def savepoint(self):
+        started = self._started
+        if started is None:
+            log.error("savepoints need a transaction")
+            raise TransactionError("not in a transaction")
+        return [(store, store.savepoint()) for store in started]
+
+    def rollback_to_savepoint(self, savepoint):
+        for store, store_savepoint in savepoint:
+            store.rollback_to_savepoint(store_savepoint)
+        # the files the transaction started on afterwards have nothing from before it, they start again if used
+        saved = [store for store, _ in savepoint]
+        started = self._started
+        for store in [store for store in started if store not in saved]:
+            store.rollback_transaction()
+            started.remove(store)
+
+    def release(self):
+        if self._started is not None:
+            log.warning("released with an open transaction. Rolling back!!")
+            self.rollback_transaction()
+        self.catalog.release()
+        for shard in self.shards:
+            shard.release()
+
+    def drop_db(self):
+        self.catalog.drop_db()
+        for shard in self.shards:
+            shard.drop_db()
+
+    def get_db_paths(self):
+        return self.catalog.get_db_paths() + [shard.db_path for shard in self.shards]
+
+    def incremental_vacuum(self, pages):
+        # the catalog goes with the first shard
+        stores = [self.shards[shard] for shard in self.scanned]
+        if 0 in self.scanned:
+            stores.append(self.catalog)
+        return sum(store.incremental_vacuum(pages) for store in stores)
+
+    # NODES
+
+    def add_known_node(self, node_uuid, url):
+        return self._catalog().add_known_node(node_uuid, url)
+
+    def get_known_nodes(self):
+        # read without starting the transaction on the catalog: every item write looks them up, and it would take
+        # the catalog's lock on every shard's writer
+        return self.catalog.get_known_nodes()
+
+    # REV AND SHADOW
+
+    def get_latest_rev_shadow(self, other_node_id, item_id):
+        return self._shard(item_id).get_latest_rev_shadow(other_node_id, item_id)
+
+    def find_rev_shadow(self, other_node_id, item_id, n_rev, m_rev, crc):
+        return self._shard(item_id).find_rev_shadow(other_node_id, item_id, n_rev, m_rev, crc)
+
+    def get_shadow(self, item, other_node_id, n_rev, m_rev):
+        return self._shard(item).get_shadow(item, other_node_id, n_rev, m_rev)
+
+    def get_latest_revs(self, item, other_node_id):
+        return self._shard(item).get_latest_revs(item, other_node_id)
+
+    def delete_revs_higher_than(self, other_node_id, item_id, n_rev):
+        return self._shard(item_id).delete_revs_higher_than(other_node_id, item_id, n_rev)
+
+    def save_new_shadow(self, other_node_id, item_id, new_text, n_rev, m_rev, crc):
+        return self._shard(item_id).save_new_shadow(other_node_id, item_id, new_text, n_rev, m_rev, crc)
+
+    def compact_shadows(self, batch_size, after=None):
+        # after is (shard, the shard's own after)
+        position, shard_after = after or (0, None)
+        deleted = 0
+        for position in range(position, len(self.scanned)):
+            shard_deleted, shard_after = self.shards[self.scanned[position]].compact_shadows(batch_size, shard_after)
+            deleted += shard_deleted
+            if shard_after:
+                return deleted, (position, shard_after)
+        return deleted, None
+
+    def delete_unreferenced_texts(self, batch_size):
+        return sum(store.delete_unreferenced_texts(batch_size) for _, store in self._scanned())
+
+    # POST
+    # outside of the transactions, they don't need the catalog's lock
+
+    def save_new_post(self, item_id, new_text, new_text_crc):
+        return self.catalog.save_new_post(item_id, new_text, new_text_crc)
+
+    def get_post_status(self, queue_rowid):
+        return self.catalog.get_post_status(queue_rowid)
+
+    def get_post_pending(self):
+        return self.catalog.get_post_pending()
+
+    def claim_post(self, worker, lease):
+        return self.catalog.claim_post(worker, lease)
+
+    def release_post(self, rowid, worker):
+        return self.catalog.release_post(rowid, worker)
+
+    def update_post_pending(self, rowid):
+        return self.catalog.update_post_pending(rowid)
+
+    # ITEM
+
+    def save_new_item(self, item_id, new_text, text_crc):
+        return self._shard(item_id).save_new_item(item_id, new_text, text_crc)
+
+    def update_item(self, item_id, new_text, text_crc):
+        return self._shard(item_id).update_item(item_id, new_text, text_crc)
+
+    def get_item(self, item_id):
+        return self._shard(item_id).get_item(item_id)
+
+    def iter_items(self, limit=None, after=None):
+        shard_items = [store.iter_items(limit, after) for _, store in self._scanned()]
+        try:
+            yield from itertools.islice(heapq.merge(*shard_items, key=lambda item: item["id"]), limit)
+        finally:
+            # their cursors
+            for items in shard_items:
+                items.close()
+
+    # EDITS
+
+    def enqueue_client_edits(self, other_node_id, item_id, diffs, hash_, n_rev, m_rev, old_shadow):
+        return self._shard(item_id).enqueue_client_edits(other_node_id, item_id, diffs, hash_, n_rev, m_rev,
+                                                         old_shadow)
+
+    def get_queued_edits(self, other_node_id, limit):
+        shard_edits = []
+        for shard, store in self._scanned():
+            edits = store.get_queued_edits(other_node_id, limit)
+            for edit in edits:
+                edit["rowid"] = self._encode_rowid(edit["rowid"], shard)
+            shard_edits.append(edits)
+        return list(itertools.islice(heapq.merge(*shard_edits, key=lambda edit: edit["n_rev"]), limit))
+
+    def get_item_queued_edits(self, other_node_id, item_id, limit):
+        shard = shard_of(item_id, len(self.shards))
+        edits = self._use(self.shards[shard]).get_item_queued_edits(other_node_id, item_id, limit)
+        for edit in edits:
+            edit["rowid"] = self._encode_rowid(edit["rowid"], shard)
+        return edits
+
+    def archive_edits(self, edit_rowids):
+        for store, rowids in self._decode_rowids(edit_rowids).items():
+            store.archive_edits(rowids)
+
+    def mark_edits_piggybacked(self, edit_rowids):
+        for store, rowids in self._decode_rowids(edit_rowids).items():
+            store.mark_edits_piggybacked(rowids)
+
+    def delete_edits(self, edit_rowids):
+        for store, rowids in self._decode_rowids(edit_rowids).items():
+            store.delete_edits(rowids)
+
+    # PATCHES
+
+    def save_new_patches(self, other_node_id, item_id, patches, n_rev, m_rev, crc):
+        return self._shard(item_id).save_new_patches(other_node_id, item_id, patches, n_rev, m_rev, crc)
+
+    def check_if_patch_done(self, other_node_id, item_id, n_rev, m_rev):
+        return self._shard(item_id).check_if_patch_done(other_node_id, item_id, n_rev, m_rev)
+
+    def check_if_patch_received(self, other_node_id, item_id, n_rev, m_rev):
+        return self._shard(item_id).check_if_patch_received(other_node_id, item_id, n_rev, m_rev)
+
+    def get_nodes_from_patches(self):
+        # in shard order, a shard's oldest first
+        node_ids = []
+        for _, store in self._scanned():
+            for node_id in store.get_nodes_from_patches():
+                if node_id not in node_ids:
+                    node_ids.append(node_id)
+        return node_ids
+
+    def get_first_patches(self, other_node, limit):
+        shard_patches = [store.get_first_patches(other_node, limit) for _, store in self._scanned()]
+        patches = heapq.merge(*shard_patches, key=lambda patch: (patch[3], patch[2]))
+        return list(itertools.islice(patches, limit))
+
+    def claim_patches(self, other_node, worker, limit, lease):
+        # a shard after the other until limit, each in its own transaction. The order only matters within an item
+        patches = []
+        for shard in self.scanned:
+            if len(patches) >= limit:
+                break
+            patches.extend(self.shards[shard].claim_patches(other_node, worker, limit - len(patches), lease))
+        return patches
+
+    def release_patches(self, patch_keys, worker):
+        by_shard = {}
+        for patch_key in patch_keys:
+            by_shard.setdefault(shard_of(patch_key[0], len(self.shards)), []).append(patch_key)
+        for shard, keys in by_shard.items():
+            self.shards[shard].release_patches(keys, worker)
+
+    def archive_patches(self, patch_keys):
+        for store, keys in self._by_item(patch_keys).items():
+            store.archive_patches(keys)
+
+    def delete_patches(self, patch_keys):
+        for store, keys in self._by_item(patch_keys).items():
+            store.delete_patches(keys)
+
+    # ARCHIVE
+
+    def get_archived(self, kind, item, other_node, n_rev):
+        return self._shard(item).get_archived(kind, item, other_node, n_rev)
+
+    def get_archived_revs(self, kind, item):
+        return self._shard(item).get_archived_revs(kind, item)
+
+    def move_legacy_archives(self, batch_size):
+        return sum(store.move_legacy_archives(batch_size) for _, store in self._scanned())
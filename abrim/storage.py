@@ -0,0 +1,304 @@
+import random
+import time
+from contextlib import contextmanager
+
+from metrics import METRICS
+from util import get_log
+
+log = get_log('critical')
+
+ARCHIVE_EDIT = "edit"
+ARCHIVE_PATCH = "patch"
+
+STORAGE_SQLITE = "sqlite"
+STORAGE_MEMORY = "memory"
+
+# how long a transaction waits for the lock of another one before giving up with BusyError
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+# run_transaction tries a unit of work this many more times when it meets a BusyError, waiting a random time up to
+# RETRY_DELAY seconds doubled for each attempt (and never over MAX_RETRY_DELAY)
+DEFAULT_TRANSACTION_RETRIES = 5
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 2
+# seconds a claimed post or patch stays with its worker. Longer than a patch.py cycle can last, so only the claims of
+# a worker that crashed or was killed expire
+DEFAULT_CLAIM_LEASE = 60
+
+
+class TransactionError(Exception):
+    # a transaction could not be started, ended or rolled back
+    pass
+
+
+class BusyError(TransactionError):
+    # another transaction kept the lock for longer than the busy timeout. Nothing was written, the whole unit of work
+    # can be tried again
+    pass
+
+
+class Storage(object):
+    # what input.py, out.py and patch.py need from a node's storage. datastore.DataStore keeps everything in sqlite
+    # files, memory_storage.MemoryStorage in the process memory. Unless a method says otherwise, a write only lasts
+    # if the transaction it runs in is ended with end_transaction
+
+    # TRANSACTION
+
+    def start_transaction(self, msg=None):
+        raise NotImplementedError
+
+    def end_transaction(self, suppress_msg=False):
+        raise NotImplementedError
+
+    def rollback_transaction(self, msg=""):
+        raise NotImplementedError
+
+    def check_transaction(self):
+        raise NotImplementedError
+
+    def savepoint(self):
+        # marks the open transaction, rollback_to_savepoint(what this returns) undoes what came after but keeps the
+        # transaction and what came before. For a bulk request whose parts can fail on their own
+        raise NotImplementedError
+
+    def rollback_to_savepoint(self, savepoint):
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self, msg=None):
+        # ends the transaction when the block finishes, unless the block rolled it back itself, and rolls it back
+        # if the block raises
+        self.start_transaction(msg)
+        try:
+            yield self
+        except BaseException:
+            if self.check_transaction():
+                self.rollback_transaction(msg)
+            raise
+        else:
+            if self.check_transaction():
+                self.end_transaction()
+
+    def run_transaction(self, work, msg=None):
+        # work() in a transaction, see transaction(), and what it returns. If the storage stays busy the whole of
+        # work() runs again after a jittered exponential backoff, so it must not have side effects it can't repeat
+        attempt = 0
+        while True:
+            try:
+                with self.transaction(msg):
+                    return work()
+            except BusyError as err:
+                if attempt >= self.transaction_retries:
+                    METRICS.increment("db.busy_gave_up")
+                    log.error(f"still busy after {attempt} retries, giving up {msg or ''}")
+                    raise
+                delay = random.uniform(0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** attempt))
+                attempt += 1
+                METRICS.increment("db.busy_retries")
+                log.warning(f"{err}, retry {attempt} of {msg or 'transaction'} in {delay:.3f} s")
+                time.sleep(delay)
+
+    def release(self):
+        # done with this thread's work for now (end of a request or a worker cycle), an open transaction is rolled back
+        raise NotImplementedError
+
+    def get_reader(self):
+        # a Storage for lookups that don't need to see an open write transaction
+        raise NotImplementedError
+
+    def drop_db(self):
+        raise NotImplementedError
+
+    def get_db_paths(self):
+        # the files the node is saved in, none if it isn't
+        raise NotImplementedError
+
+    def incremental_vacuum(self, pages):
+        # gives up to pages free pages of each file back to the file system. Not inside a transaction, returns the
+        # number of pages freed
+        raise NotImplementedError
+
+    # NODES
+
+    def add_known_node(self, node_uuid, url):
+        raise NotImplementedError
+
+    def get_known_nodes(self):
+        # [{"id": ..., "base_url": ...}] of the other nodes, by id
+        raise NotImplementedError
+
+    # REV AND SHADOW
+
+    def get_latest_rev_shadow(self, other_node_id, item_id):
+        # (n_rev, m_rev, text) of the latest shadow, (0, 0, "") if there is none
+        raise NotImplementedError
+
+    def find_rev_shadow(self, other_node_id, item_id, n_rev, m_rev, crc):
+        raise NotImplementedError
+
+    def get_shadow(self, item, other_node_id, n_rev, m_rev):
+        # (True, text) or (False, None)
+        raise NotImplementedError
+
+    def get_latest_revs(self, item, other_node_id):
+        # (n_rev, m_rev) or (None, None)
+        raise NotImplementedError
+
+    def delete_revs_higher_than(self, other_node_id, item_id, n_rev):
+        raise NotImplementedError
+
+    def save_new_shadow(self, other_node_id, item_id, new_text, n_rev, m_rev, crc):
+        raise NotImplementedError
+
+    def compact_shadows(self, batch_size, after=None):
+        # deletes all but the 2 latest shadows of batch_size (item, other_node) pairs after the pair "after", in its
+        # own transaction. Returns the number of deleted shadows and the pair to go on from, None when done
+        raise NotImplementedError
+
+    def delete_unreferenced_texts(self, batch_size):
+        # in its own transaction, returns the number of deleted texts
+        raise NotImplementedError
+
+    # POST
+    # the posts queue doesn't take part in the transactions, its writes are saved right away
+
+    def save_new_post(self, item_id, new_text, new_text_crc):
+        # returns its rowid
+        raise NotImplementedError
+
+    def get_post_status(self, queue_rowid):
+        # (status, item) or (None, None)
+        raise NotImplementedError
+
+    def get_post_pending(self):
+        # (rowid, item, text, node, crc) of the oldest pending post, or 5 Nones
+        raise NotImplementedError
+
+    def claim_post(self, worker, lease):
+        # like get_post_pending, but skips the items another worker holds a post of, and claims the post for worker
+        # until lease seconds from now
+        raise NotImplementedError
+
+    def release_post(self, rowid, worker):
+        raise NotImplementedError
+
+    def update_post_pending(self, rowid):
+        # marks the post done, and no longer claimed
+        raise NotImplementedError
+
+    # ITEM
+
+    def save_new_item(self, item_id, new_text, text_crc):
+        raise NotImplementedError
+
+    def update_item(self, item_id, new_text, text_crc):
+        raise NotImplementedError
+
+    def get_item(self, item_id):
+        # (True, text, crc) or (False, None, None)
+        raise NotImplementedError
+
+    def get_items(self, limit=None, after=None):
+        return list(self.iter_items(limit, after))
+
+    def iter_items(self, limit=None, after=None):
+        # a generator of {"id", "node", "crc"} dicts of up to limit items with an id greater than after, by id.
+        # close() it if it isn't consumed
+        raise NotImplementedError
+
+    # EDITS
+
+    def enqueue_client_edits(self, other_node_id, item_id, diffs, hash_, n_rev, m_rev, old_shadow):
+        raise NotImplementedError
+
+    def get_first_queued_edit(self, other_node_id):
+        edits = self.get_queued_edits(other_node_id, 1)
+        if not edits:
+            return None
+        return edits[0]
+
+    def get_queued_edits(self, other_node_id, limit):
+        # dicts with rowid, item, other_node, n_rev, m_rev, edits, hash and old_shadow, by n_rev
+        raise NotImplementedError
+
+    def archive_edit(self, edit_rowid):
+        self.archive_edits((edit_rowid,))
+
+    def get_item_queued_edits(self, other_node_id, item_id, limit):
+        # the edits of an item for other_node_id, lowest n_rev first. They go back in the answer to its syncs
+        raise NotImplementedError
+
+    def mark_edits_piggybacked(self, edit_rowids):
+        # they went back in the answer to a sync, so out.py says so when it sends them. Until then they're only
+        # "piggybacked" in get_queued_edits
+        raise NotImplementedError
+
+    def archive_edits(self, edit_rowids):
+        raise NotImplementedError
+
+    def delete_edit(self, edit_rowid):
+        self.delete_edits((edit_rowid,))
+
+    def delete_edits(self, edit_rowids):
+        raise NotImplementedError
+
+    # PATCHES
+
+    def save_new_patches(self, other_node_id, item_id, patches, n_rev, m_rev, crc):
+        raise NotImplementedError
+
+    def check_if_patch_done(self, other_node_id, item_id, n_rev, m_rev):
+        raise NotImplementedError
+
+    def check_if_patch_received(self, other_node_id, item_id, n_rev, m_rev):
+        # queued or done
+        raise NotImplementedError
+
+    def get_nodes_from_patches(self):
+        # nodes with pending patches, the one with the oldest patch first
+        raise NotImplementedError
+
+    def check_first_patch(self, other_node):
+        patches = self.get_first_patches(other_node, 1)
+        if not patches:
+            return None
+        return patches[0]
+
+    def get_first_patches(self, other_node, limit):
+        # (item, other_node, n_rev, m_rev, patches, crc) tuples in the order they have to be applied
+        raise NotImplementedError
+
+    def claim_patches(self, other_node, worker, limit, lease):
+        # like get_first_patches, but skips the items another worker holds patches of, and claims the patches for
+        # worker until lease seconds from now. In its own transaction
+        raise NotImplementedError
+
+    def release_patches(self, patch_keys, worker):
+        # in its own transaction
+        raise NotImplementedError
+
+    def archive_patch(self, item, other_node, n_rev):
+        self.archive_patches(((item, other_node, n_rev),))
+
+    def archive_patches(self, patch_keys):
+        # patch_keys: (item, other_node, n_rev) tuples
+        raise NotImplementedError
+
+    def delete_patch(self, item, other_node, n_rev):
+        self.delete_patches(((item, other_node, n_rev),))
+
+    def delete_patches(self, patch_keys):
+        raise NotImplementedError
+
+    # ARCHIVE
+
+    def get_archived(self, kind, item, other_node, n_rev):
+        # the archived edit or patch as a dict, or None
+        raise NotImplementedError
+
+    def get_archived_revs(self, kind, item):
+        # [(other_node, n_rev, m_rev)]
+        raise NotImplementedError
+
+    def move_legacy_archives(self, batch_size):
+        # in its own transaction, returns the number of moved rows
+        raise NotImplementedError
@@ -0,0 +1,141 @@
+import traceback
+
+from metrics import timed
+from storage import TransactionError
+from abrim.util import get_log, fragile_patch_text, check_crc, get_crc
+
+log = get_log('critical')
+
+# what input.py does with the edits another node syncs, and out.py with the ones that come back in the answers
+
+
+def check_item_exists(config, item_id):
+    return config.db.get_item(item_id)
+
+
+def save_shadow(config, client_node_id, item_id, shadow, n_rev, m_rev, crc):
+    config.db.save_new_shadow(client_node_id, item_id, shadow, n_rev, m_rev, crc)
+
+
+def _get_server_shadow(config, item_id, client_node_id, n_rev, m_rev):
+    got_shadow, shadow = config.db.get_shadow(item_id, client_node_id, n_rev, m_rev)
+    if got_shadow:
+        log.debug(f"shadow: {shadow}")
+    return got_shadow, shadow
+
+
+@timed("diff.patch_server_shadow")
+def _patch_server_shadow(edits, shadow):
+    if edits == "" and shadow == "":
+        log.debug("no shadow or patches, nothing to patch...")
+        return "", True
+    else:
+        new_shadow, patch_success = fragile_patch_text(edits, shadow)
+        if not patch_success:
+            log.debug("patching failed")
+            return "", False
+        else:
+            return new_shadow, patch_success
+
+
+def _enqueue_patches(config, client_node_id, item_id, patches, n_rev, m_rev, crc):
+    config.db.save_new_patches(client_node_id, item_id, patches, n_rev, m_rev, crc)
+
+
+def sync_edit(config, client_node_id, item_id, n_rev, m_rev, hash_, edits, piggybacked=False):
+    # the sync of an edit of client_node_id, inside the caller's transaction. None once the patches are enqueued,
+    # else (api_unique_code, message, content, keep): what the sync wrote has to be undone unless keep. piggybacked
+    # if the edit already came in the answer to one of our syncs (see out.py)
+    log.debug(f"checking revs for {item_id} from node: {client_node_id}")
+    saved_n_rev, saved_m_rev = config.db.get_latest_revs(item_id, client_node_id)
+
+    if not saved_n_rev and not saved_m_rev:
+        item_exists, item_text, item_crc = check_item_exists(config, item_id)
+        if item_exists:
+            # item already exists locally but the other_node has no local shadow so create a new local shadow and signal ir to the other node
+            save_shadow(config, client_node_id, item_id, item_text, 1, 1, item_crc)  # save new shadow
+            return ("queue_in/post_sync/409/use_this_as_shadow",
+                    "That item exists locally but I have no shadow from you. Use this item and use it for shadow 1-1",
+                    {"text": item_text, "crc": item_crc}, True)
+        else:
+            # it's a new item, so create a new empty shadow
+            saved_n_rev = 0
+            saved_m_rev = 0
+            save_shadow(config, client_node_id, item_id, "", saved_n_rev, saved_m_rev, 1)
+
+    if n_rev != saved_n_rev:
+        if piggybacked and n_rev < saved_n_rev and \
+                config.db.check_if_patch_received(client_node_id, item_id, n_rev, m_rev):
+            # we took it from that answer, now it leaves the other node's queue
+            return "queue_in/post_sync/201/already_synced", "Accepted, that edit was already synced", None, True
+        if n_rev < saved_n_rev:
+            log.warning(f"n_rev DOESN'T match: {n_rev} < {saved_n_rev}")
+            if config.db.find_rev_shadow(client_node_id, item_id, n_rev, m_rev, hash_):
+                # lost return packet
+                # FIXME: we should delete local edits at this point
+                # copy backup shadow to shadow (in our code that means deleting shadows with a higher than n_rev)
+                config.db.delete_revs_higher_than(client_node_id, item_id, n_rev)
+                return ("queue_in/post_sync/201/lost_return_packet",
+                        "Accepted, but that looked like you lost a return packet from me", None, True)
+            else:
+                raise Exception("implement me! 1")
+        else:
+            log.warning(f"n_rev DOESN'T match: {n_rev} > {saved_n_rev}")
+            raise Exception("implement me! 2")
+        # return resp("queue_in/post_sync/403/no_match_revs", "Revs don't match")
+    if m_rev != saved_m_rev:
+        log.error(f"m_rev DOESN'T match: {m_rev} != {saved_m_rev}")
+        raise Exception("implement me! 3")
+
+    got_shadow, shadow = _get_server_shadow(config, item_id, client_node_id, n_rev, m_rev)
+
+    if not got_shadow:
+        return ("queue_in/post_sync/404/not_shadow",
+                "Shadow not found. PUT the full shadow to this URL changing 'sync' with 'shadow'", None, False)
+    if not check_crc(shadow, hash_):
+        return "queue_in/post_sync/403/check_crc", "CRC of shadow doesn't match", None, False
+
+    new_shadow, patch_success = _patch_server_shadow(edits, shadow)
+
+    if not patch_success:
+        return "queue_in/post_sync/500/shadow_patch_unsuccessful", "Failed to patch shadow", None, False
+    else:
+        _enqueue_patches(config, client_node_id, item_id, edits, n_rev, m_rev, hash_) # save patches to patch queue
+        new_hash = get_crc(new_shadow)
+        save_shadow(config, client_node_id, item_id, new_shadow, n_rev + 1, m_rev, new_hash) # save new shadow
+    return None
+
+
+def sync_edits(config, client_node_id, sync_requests):
+    # the (item, revs) of a bulk sync or a stack in the caller's transaction, each after a savepoint so the ones that fail are
+    # undone alone. Returns an (api_unique_code, message, content) per edit, None for the ones enqueued
+    results = []
+    failed_items = set()
+    for item_id, revs in sync_requests:
+        if not revs:
+            results.append(("queue_in/post_sync/405/check_req", "Malformed JSON request", None))
+            continue
+        if item_id in failed_items:
+            # the edits of an item go in order, this one can't be synced until the one before it is
+            results.append(("queue_in/post_sync/409/previous_edit_failed", "An earlier edit of this item failed", None))
+            continue
+        n_rev, m_rev, hash_, edits, piggybacked = revs
+        savepoint = config.db.savepoint()
+        try:
+            result = sync_edit(config, client_node_id, item_id, n_rev, m_rev, hash_, edits, piggybacked)
+        except TransactionError:
+            raise
+        except Exception as err:
+            log.error(f"ERROR: {err}")
+            traceback.print_exc()
+            result = "queue_in/post_sync/500/transaction_exception", "Unknown error. Please report this", None, False
+        if result:
+            api_unique_code, message, content, keep = result
+            if not keep:
+                config.db.rollback_to_savepoint(savepoint)
+            if not api_unique_code.startswith("queue_in/post_sync/201/"):
+                failed_items.add(item_id)
+            results.append((api_unique_code, message, content))
+        else:
+            results.append(None)
+    return results
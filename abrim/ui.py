@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+from urllib.parse import urlencode
 from flask import Flask, session, request, abort, render_template, redirect, url_for
 from flask_login import LoginManager, UserMixin, current_user, login_required, login_user, logout_user
 from abrim.config import Config
@@ -70,36 +71,39 @@ def _check_list_nodes(raw_response):
         return None
 
 
-def _list_items(username, password):
+def _list_items(username, password, after=None):
+    # one page of items, returns it with the cursor for the next one (None in the last page)
     url = f"{session['user_node']}{ROUTE_FOR['items']}"  #fixme
+    if after:
+        url = f"{url}?{urlencode({'after': after})}"
     try:
         raw_response = get_request(url, username, password)
     except ConnectionError:
         log.debug("ConnectionError")
-        return None, False, True
+        return None, None, False, True
 
     if not raw_response and raw_response.status_code != 404:
         log.debug("connection error")
-        return None, False, True
+        return None, None, False, True
     else:
         response_dict = _check_list_items(raw_response)
         if response_dict:
             try:
                 content = response_dict['content']
                 log.debug(content)
-                return content, True, True
+                return content, response_dict.get('next'), True, True
             except KeyError:
                 log.error(f"KeyError in {response_dict}")
-                return None, True, True
+                return None, None, True, True
         else:
             if raw_response.status_code == 401:
                 log.warning("not auth")
-                return None, True, False
+                return None, None, True, False
             if raw_response.status_code == 404:
-                return None, True, True
+                return None, None, True, True
             else:
                 log.warning(f"no response_dict in {raw_response}")
-                return None, False, True
+                return None, None, False, True
 
 
 def _list_nodes(username, password):
@@ -196,9 +200,10 @@ def teardown_request(exception):
 @login_required
 def _root():
     try:
-        content, conn_ok, auth_ok = _list_items(session['current_user_name'],
-                                                session['current_user_password'])
-        return render_template('list.html', conn_ok=conn_ok, auth_ok=auth_ok, content=content)
+        content, next_after, conn_ok, auth_ok = _list_items(session['current_user_name'],
+                                                            session['current_user_password'],
+                                                            request.args.get('after'))
+        return render_template('list.html', conn_ok=conn_ok, auth_ok=auth_ok, content=content, next_after=next_after)
     except KeyError:
         log.debug("AttributeError, logging out")
         logout_user()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os
 import sys
 from functools import wraps
 import logging
@@ -7,14 +8,18 @@ import zlib
 import argparse
 import json
 import requests
+from io import BytesIO
+from urllib.parse import urlsplit
 from base64 import b64encode
 import diff_match_patch
-from flask import jsonify, request, Response
+from flask import jsonify, request, Response, stream_with_context
+from werkzeug.wsgi import get_input_stream
 
 
 ROUTE_FOR = {
     'nodes': '/nodes',
-    'items': '/items'
+    'items': '/items',
+    'stats': '/stats'
 }
 
 
@@ -45,6 +50,104 @@ def resp(api_unique_code, msg, resp_json=None, location=None):
         return response
 
 
+def resp_stream(api_unique_code, msg, content, limit, cursor_field):
+    # same body as resp() but "content" is written while the content iterable is consumed. If it yields more than
+    # limit elements the extra one isn't sent, "next" gets the cursor_field of the last one sent instead
+    log.debug(f"{prefix_debug()} RESPONSE: {api_unique_code} :: {msg} (streamed)")
+    log.debug("-----------------------------------------------")
+
+    def generate():
+        yield json.dumps({'api_unique_code': api_unique_code, 'message': msg})[:-1] + ', "content": ['
+        last = None
+        for count, element in enumerate(content):
+            if count == limit:
+                yield f'], "next": {json.dumps(last[cursor_field])}}}'
+                return
+            yield (", " if last is not None else "") + json.dumps(element)
+            last = element
+        yield "]}"
+
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+    try:
+        response.status_code = int(api_unique_code.split('/')[2])
+    except IndexError:
+        response.status_code = 500
+    return response
+
+
+# compression. Bodies of at least ABRIM_HTTP_COMPRESS_THRESHOLD bytes (0 disables it) are sent gzipped: responses when the request says it
+# takes them in Accept-Encoding, requests to the hosts whose responses said so in their own Accept-Encoding header
+# (RFC 7694). Nodes that don't know about it keep getting and sending plain json
+DEFAULT_HTTP_COMPRESS_THRESHOLD = 1024
+MAX_DECOMPRESSED_BYTES = 64 * 1024 * 1024
+ENCODINGS = ("gzip", "deflate")
+_WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+
+def get_http_compress_threshold():
+    return int(os.environ.get('ABRIM_HTTP_COMPRESS_THRESHOLD', DEFAULT_HTTP_COMPRESS_THRESHOLD))
+
+
+def compress(data, encoding):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, _WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, encoding, max_bytes=MAX_DECOMPRESSED_BYTES):
+    # ValueError for what isn't valid or is too big once decompressed
+    decompressor = zlib.decompressobj(_WBITS[encoding])
+    try:
+        decompressed = decompressor.decompress(data, max_bytes)
+    except zlib.error as err:
+        raise ValueError(f"bad {encoding} body: {err}")
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"{encoding} body over {max_bytes} bytes")
+    if not decompressor.eof:
+        raise ValueError(f"truncated {encoding} body")
+    return decompressed
+
+
+def decompress_request():
+    # run it before anything reads the body. None if the body can be read as is, else the response to return
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    if encoding == 'identity':
+        return None
+    if encoding not in ENCODINGS:
+        log.warning(f"request body in unsupported encoding {encoding}")
+        response = resp("queue_in/before_request/415/unsupported_encoding", f"Use one of {', '.join(ENCODINGS)}")
+        response.headers['Accept-Encoding'] = ", ".join(ENCODINGS)
+        return response
+    try:
+        body = decompress(get_input_stream(request.environ).read(), encoding)
+    except ValueError as err:
+        log.warning(f"can't decompress request body: {err}")
+        return resp("queue_in/before_request/400/bad_encoding", "Couldn't decompress the body")
+    request.environ['wsgi.input'] = BytesIO(body)
+    request.environ['CONTENT_LENGTH'] = str(len(body))
+    request.environ.pop('HTTP_CONTENT_ENCODING', None)
+    request.environ.pop('wsgi.input_terminated', None)
+    return None
+
+
+def compress_response(response):
+    # after_request hook. Streamed responses are left alone, they'd have to be buffered first
+    response.headers['Accept-Encoding'] = ", ".join(ENCODINGS)
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers \
+            or response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if not encoding:
+        return response
+    data = response.get_data()
+    threshold = get_http_compress_threshold()
+    if not threshold or len(data) < threshold:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
 def get_log(level):
     if level == 'full_debug':
         # enable debug for HTTP requests
@@ -104,6 +207,19 @@ def create_diff_edits(text, shadow):
         return None
 
 
+def create_delta(base, text):
+    # exact, compact description of text as changes to base. Unlike the patches it doesn't need context to apply
+    diff_obj = diff_match_patch.diff_match_patch()
+    diff_obj.Diff_Timeout = 1
+    diff = diff_obj.diff_main(base, text, False)
+    return diff_obj.diff_toDelta(diff)
+
+
+def apply_delta(base, delta):
+    diff_obj = diff_match_patch.diff_match_patch()
+    return diff_obj.diff_text2(diff_obj.diff_fromDelta(base, delta))
+
+
 def fragile_patch_text(item_patches, text):
     log.debug(f"{prefix_debug()} patching: {item_patches}\nwith: {text}")
     diff_obj = diff_match_patch.diff_match_patch()
@@ -215,6 +331,30 @@ def prefix_debug(double_jump=False):
     return f"({file_name}:{line_numb} {func_name})"
 
 
+# hosts that said they take compressed request bodies, learnt from their responses
+_compressed_bodies = set()
+
+
+def _prepare_body(url, json_dict, headers):
+    # the json body, gzipped if it's big enough and the host takes it. requests asks for compressed responses and
+    # decompresses them by itself
+    if json_dict is None:
+        return None, headers
+    body = json.dumps(json_dict).encode('utf-8')
+    threshold = get_http_compress_threshold()
+    if not threshold or len(body) < threshold or urlsplit(url).netloc not in _compressed_bodies:
+        return body, headers
+    return compress(body, "gzip"), dict(headers, **{'content-encoding': "gzip"})
+
+
+def _learn_encodings(url, raw_response):
+    host = urlsplit(url).netloc
+    if "gzip" in raw_response.headers.get('Accept-Encoding', "").lower():
+        _compressed_bodies.add(host)
+    else:
+        _compressed_bodies.discard(host)
+
+
 def __do_request(method, url, username=None, password=None, payload=None):
     if method != 'GET' and method != 'POST' and method != 'PUT':
         raise Exception
@@ -228,10 +368,15 @@ def __do_request(method, url, username=None, password=None, payload=None):
         _timeout = 10  # timeout 1 is not enough for the remote node to patch its text
         if method == 'GET':
             raw_response = requests.get(url, headers=headers, timeout=_timeout)
-        elif method == 'POST':
-            raw_response = requests.post(url, json=json_dict, headers=headers, timeout=_timeout)
-        elif method == 'PUT':
-            raw_response = requests.put(url, json=json_dict, headers=headers, timeout=_timeout)
+            _learn_encodings(url, raw_response)
+        elif method == 'POST' or method == 'PUT':
+            body, body_headers = _prepare_body(url, json_dict, headers)
+            raw_response = requests.request(method, url, data=body, headers=body_headers, timeout=_timeout)
+            _learn_encodings(url, raw_response)
+            if raw_response.status_code == 415 and body_headers is not headers:
+                log.warning(f"{url} doesn't take compressed bodies anymore, sending it again")
+                body, body_headers = _prepare_body(url, json_dict, headers)
+                raw_response = requests.request(method, url, data=body, headers=body_headers, timeout=_timeout)
         else:
             raise Exception
     except requests.exceptions.ConnectionError:
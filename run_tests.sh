@@ -4,3 +4,10 @@
 #python test/sync_tests.py -b
 
 python test/node_tests.py -b
+python test/datastore_tests.py -b
+python test/storage_tests.py -b
+python test/bus_tests.py -b
+python test/compression_tests.py -b
+python test/out_tests.py -b
+python test/sync_tests.py -b
+python test/input_tests.py -b
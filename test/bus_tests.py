@@ -0,0 +1,65 @@
+from unittest import TestCase
+import unittest
+import logging
+import os
+import sys
+import threading
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))  # FIXME use pathlib
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'abrim'))
+
+from bus import Listener, notify, PATCH_ENQUEUED, PATCH_APPLIED, PATCH
+
+
+class TestBus(TestCase):
+    bus_port = 7100
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        os.environ['ABRIM_BUS_PORT'] = str(self.bus_port)
+        self.listener = Listener()
+
+    def tearDown(self):
+        self.listener.close()
+        del os.environ['ABRIM_BUS_PORT']
+        logging.disable(logging.NOTSET)
+
+    def test_wake_up(self):
+        self.assertTrue(self.listener.listen(PATCH))
+        seen = self.listener.events
+        notify(PATCH_APPLIED)  # for input.py, not this one
+        self.assertFalse(self.listener.wait(0.2, seen))
+        threading.Timer(0.1, notify, (PATCH_ENQUEUED,)).start()
+        start = time.monotonic()
+        self.assertTrue(self.listener.wait(5, seen))
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_missed_event(self):
+        # an event that came after the waiter took the count, while it looked at the storage
+        self.assertTrue(self.listener.listen(PATCH))
+        seen = self.listener.events
+        notify(PATCH_ENQUEUED)
+        time.sleep(0.1)
+        start = time.monotonic()
+        self.assertTrue(self.listener.wait(5, seen))
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_no_bus(self):
+        del os.environ['ABRIM_BUS_PORT']
+        self.assertFalse(self.listener.listen(PATCH))
+        notify(PATCH_ENQUEUED)
+        start = time.monotonic()
+        self.assertFalse(self.listener.wait(0.2, self.listener.events))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        os.environ['ABRIM_BUS_PORT'] = str(self.bus_port)
+
+    def test_port_taken(self):
+        # another node on the same ports, it polls
+        self.assertTrue(self.listener.listen(PATCH))
+        other = Listener()
+        self.assertFalse(other.listen(PATCH))
+        self.assertFalse(other.wait(0.1, other.events))
+
+
+if __name__ == '__main__':
+    unittest.main()
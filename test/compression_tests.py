@@ -0,0 +1,111 @@
+from unittest import TestCase
+import unittest
+import json
+import logging
+import os
+import sys
+from unittest.mock import Mock
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))  # FIXME use pathlib
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'abrim'))
+
+from flask import Flask, request
+from abrim import util
+from abrim.util import resp, compress, decompress, decompress_request, compress_response
+
+
+app = Flask(__name__)
+
+
+@app.before_request
+def before_request():
+    return decompress_request()
+
+
+@app.after_request
+def after_request(response):
+    return compress_response(response)
+
+
+@app.route('/echo', methods=['POST'])
+def echo():
+    return resp("test/echo/200/ok", "echo", request.get_json())
+
+
+class TestCompression(TestCase):
+    big = {"text": "some text to compress " * 100}
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.client = app.test_client()
+        util._compressed_bodies.clear()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_round_trip(self):
+        data = json.dumps(self.big).encode()
+        for encoding in util.ENCODINGS:
+            self.assertLess(len(compress(data, encoding)), len(data))
+            self.assertEqual(decompress(compress(data, encoding), encoding), data)
+        with self.assertRaises(ValueError):
+            decompress(compress(data, "gzip"), "gzip", max_bytes=100)
+        with self.assertRaises(ValueError):
+            decompress(compress(data, "gzip")[:-20], "gzip")
+        with self.assertRaises(ValueError):
+            decompress(b"not gzip", "gzip")
+
+    def test_compressed_request(self):
+        body = compress(json.dumps(self.big).encode(), "gzip")
+        response = self.client.post('/echo', data=body,
+                                    headers={'Content-Type': "application/json", 'Content-Encoding': "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["content"], self.big)
+        self.assertEqual(response.headers['Accept-Encoding'], "gzip, deflate")
+
+    def test_bad_request_encoding(self):
+        response = self.client.post('/echo', data=b"{}",
+                                    headers={'Content-Type': "application/json", 'Content-Encoding': "br"})
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(response.headers['Accept-Encoding'], "gzip, deflate")
+        response = self.client.post('/echo', data=b"{}",
+                                    headers={'Content-Type': "application/json", 'Content-Encoding': "gzip"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_compressed_response(self):
+        response = self.client.post('/echo', json=self.big, headers={'Accept-Encoding': "gzip"})
+        self.assertEqual(response.headers['Content-Encoding'], "gzip")
+        self.assertIn("Accept-Encoding", response.headers['Vary'])
+        self.assertEqual(json.loads(decompress(response.get_data(), "gzip"))["content"], self.big)
+
+        response = self.client.post('/echo', json=self.big, headers={'Accept-Encoding': "gzip;q=0.5, deflate"})
+        self.assertEqual(response.headers['Content-Encoding'], "deflate")
+
+        response = self.client.post('/echo', json=self.big)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_json()["content"], self.big)
+
+        response = self.client.post('/echo', json={"text": "small"}, headers={'Accept-Encoding': "gzip"})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_request_bodies_only_to_hosts_that_take_them(self):
+        url = "http://localhost:5001/items/item_1"
+        headers = {'content-type': "application/json"}
+        body, body_headers = util._prepare_body(url, self.big, headers)
+        self.assertEqual(json.loads(body), self.big)
+        self.assertIs(body_headers, headers)
+
+        util._learn_encodings(url, Mock(headers={'Accept-Encoding': "gzip, deflate"}))
+        body, body_headers = util._prepare_body(url, self.big, headers)
+        self.assertEqual(body_headers['content-encoding'], "gzip")
+        self.assertEqual(json.loads(decompress(body, "gzip")), self.big)
+        body, body_headers = util._prepare_body(url, {"text": "small"}, headers)
+        self.assertIs(body_headers, headers)
+        body, _ = util._prepare_body("http://localhost:6001/items/item_1", self.big, headers)
+        self.assertEqual(json.loads(body), self.big)
+
+        util._learn_encodings(url, Mock(headers={}))
+        self.assertNotIn("localhost:5001", util._compressed_bodies)
+
+
+if __name__ == '__main__':
+    unittest.main()
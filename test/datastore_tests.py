@@ -0,0 +1,483 @@
+from unittest import TestCase
+import unittest
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import threading
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))  # FIXME use pathlib
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'abrim'))
+
+from util import get_crc
+from datastore import DataStore, MIGRATIONS, ARCHIVE_EDIT, ARCHIVE_PATCH, DB_PROFILES, close_pools, posts_path, \
+    get_space_usage, enable_incremental_vacuum
+from metrics import get_metrics, save_metrics, load_metrics
+
+
+class TestDataStore(TestCase):
+    db = None
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.db = DataStore("test_node1", 5001, db_prefix="test_db_", drop_db=True)
+
+    def tearDown(self):
+        close_pools()
+        logging.disable(logging.NOTSET)
+
+    def _use_every_query(self):
+        db = self.db
+        db.start_transaction()
+        db.add_known_node("node_2", "http://localhost:6001")
+        db.get_known_nodes()
+        db.save_new_item("item_1", "text", 1)
+        db.update_item("item_1", "new text", 2)
+        db.get_item("item_1")
+        db.get_items()
+        db.get_items(10, "item_0")
+        db.save_new_shadow("node_2", "item_1", "text", 1, 0, 3)
+        db.get_latest_rev_shadow("node_2", "item_1")
+        db.find_rev_shadow("node_2", "item_1", 1, 0, 3)
+        db.get_shadow("item_1", "node_2", 1, 0)
+        db.get_latest_revs("item_1", "node_2")
+        db.delete_revs_higher_than("node_2", "item_1", 3)
+        db.end_transaction()
+        db.compact_shadows(10)
+        db.compact_shadows(10, ("item_1", "node_2"))
+        db.start_transaction()
+        db.enqueue_client_edits("node_2", "item_1", "edits", "1", 0, 0, "")
+        edit = db.get_first_queued_edit("node_2")
+        db.archive_edit(edit["rowid"])
+        db.delete_edit(edit["rowid"])
+        db.save_new_patches("node_2", "item_1", "patches", 0, 0, 1)
+        db.get_nodes_from_patches()
+        db.check_first_patch("node_2")
+        db.check_if_patch_done("node_2", "item_1", 0, 0)
+        db.archive_patch("item_1", "node_2", 0)
+        db.delete_patch("item_1", "node_2", 0)
+        db.get_archived(ARCHIVE_PATCH, "item_1", "node_2", 0)
+        db.get_archived_revs(ARCHIVE_EDIT, "item_1")
+        db.end_transaction()
+        db.move_legacy_archives(10)
+        db.delete_unreferenced_texts(10)
+        rowid = db.save_new_post("item_1", "post text", 4)
+        db.get_post_status(rowid)
+        db.get_post_pending()
+        db.claim_post("worker_1", 60)
+        db.release_post(rowid, "worker_1")
+        db.update_post_pending(rowid)
+        db.claim_patches("node_2", "worker_1", 10, 60)
+        db.release_patches([("item_1", "node_2", 0)], "worker_1")
+
+    def test_schema_version(self):
+        self.assertEqual(self.db.get_schema_version(), len(MIGRATIONS))
+
+    def test_migrate_keeps_data(self):
+        db_path = self.db.db_path
+        close_pools()
+        os.remove(db_path)
+        # a node created before the migrations existed: base schema and user_version 0
+        con = sqlite3.connect(db_path)
+        for statement in MIGRATIONS[0]:
+            con.execute(statement)
+        con.execute("INSERT INTO items (id, text, node, crc) VALUES ('item_1', 'text', 'test_node1', 1)")
+        con.execute("INSERT INTO shadows (item, other_node, n_rev, m_rev, shadow, crc) VALUES ('item_1', 'node_2', 1, 0, "
+                    "'shadow', 2)")
+        con.execute("INSERT INTO patches (item, other_node, n_rev, m_rev, patches, crc) VALUES ('item_1', 'node_2', 0, "
+                    "0, 'patches', 3)")
+        con.execute("INSERT INTO posts (item, text, node, crc, status) VALUES ('item_1', 'post', 'test_node1', 4, "
+                    "'PENDING')")
+        con.commit()
+        con.close()
+
+        self.db = DataStore("test_node1", 5001, db_prefix="test_db_")
+        self.assertEqual(self.db.get_schema_version(), len(MIGRATIONS))
+        self.assertEqual(self.db.get_item("item_1"), (True, "text", 1))
+        self.db.cur.execute("SELECT name FROM sqlite_master WHERE name = 'patches_other_node'")
+        self.assertIsNotNone(self.db.cur.fetchone())
+        # the ids became keys
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 1, 0), (True, "shadow"))
+        self.assertEqual(self.db.get_first_patches("node_2", 1), [("item_1", "node_2", 0, 0, "patches", 3)])
+        # the posts moved to their own file
+        self.assertEqual(self.db.get_post_pending(), (1, "item_1", "post", "test_node1", 4))
+        self.db.cur.execute("SELECT name FROM sqlite_master WHERE name = 'posts'")
+        self.assertIsNone(self.db.cur.fetchone())
+
+    def test_posts_file(self):
+        self.assertTrue(os.path.exists(posts_path(self.db.db_path)))
+        # a post is saved while a sync transaction holds the node's file
+        self.db.start_transaction()
+        self.db.save_new_item("item_1", "text", 1)
+        saved = []
+
+        def post():
+            saved.append(self.db.save_new_post("item_1", "post text", 4))
+            self.db.release()
+        poster = threading.Thread(target=post)
+        poster.start()
+        poster.join(2)
+        self.assertEqual(len(saved), 1)
+        rowid = saved[0]
+        self.db.rollback_transaction()
+        self.assertEqual(self.db.get_reader().get_post_status(rowid), ("PENDING", "item_1"))
+
+    def test_keys(self):
+        self.db.start_transaction()
+        self.db.save_new_shadow("node_2", "item_1", "text", 1, 0, 1)
+        self.db.rollback_transaction()
+        # the key item_1 got was rolled back with the shadow, item_2 takes it now
+        self.db.start_transaction()
+        self.db.save_new_shadow("node_2", "item_2", "text", 1, 0, 1)
+        self.db.end_transaction()
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 1, 0), (False, None))
+        self.assertEqual(self.db.get_shadow("item_2", "node_2", 1, 0), (True, "text"))
+        self.db.cur.execute("SELECT key, id FROM item_keys")
+        self.assertEqual([tuple(row) for row in self.db.cur.fetchall()], [(1, "item_2")])
+
+    def test_incremental_vacuum(self):
+        # the test files can be older than auto_vacuum
+        enable_incremental_vacuum(self.db.db_path)
+        self.assertFalse(enable_incremental_vacuum(self.db.db_path))
+        self.db.start_transaction()
+        for n_rev in range(40):
+            self.db.save_new_shadow("node_2", "item_1", os.urandom(2000).hex(), n_rev, 0, n_rev)
+        self.db.end_transaction()
+        self.db.compact_shadows(10)
+        self.db.delete_unreferenced_texts(100)
+
+        usage = get_space_usage(self.db.db_path)
+        self.assertEqual(usage["auto_vacuum"], "incremental")
+        self.assertGreater(usage["free_pages"], 10)
+        self.assertIn("texts", [sqlite_object["name"] for sqlite_object in usage["objects"]])
+        self.assertEqual(self.db.incremental_vacuum(10), 10)
+        self.db.incremental_vacuum(100000)
+        self.assertEqual(get_space_usage(self.db.db_path)["free_pages"], 0)
+        self.assertEqual(self.db.incremental_vacuum(10), 0)
+        self.assertEqual(self.db.get_db_paths(), [self.db.db_path, posts_path(self.db.db_path)])
+
+    def test_compact_shadows(self):
+        self.db.start_transaction()
+        for n_rev in range(5):
+            self.db.save_new_shadow("node_2", "item_1", f"text {n_rev}", n_rev, 0, n_rev)
+            self.db.save_new_shadow("node_2", "item_2", f"text {n_rev}", n_rev, 0, n_rev)
+        self.db.save_new_shadow("node_2", "item_3", "text", 0, 0, 0)
+        self.db.end_transaction()
+
+        deleted, after = self.db.compact_shadows(1)
+        self.assertEqual((deleted, after), (3, ("item_1", "node_2")))
+        deleted, after = self.db.compact_shadows(1, after)
+        self.assertEqual((deleted, after), (3, ("item_2", "node_2")))
+        self.assertEqual(self.db.compact_shadows(1, after), (0, None))
+
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (4, 0))
+        self.assertTrue(self.db.find_rev_shadow("node_2", "item_1", 3, 0, 3))  # backup shadow
+        self.assertFalse(self.db.find_rev_shadow("node_2", "item_1", 2, 0, 2))
+        self.assertEqual(self.db.get_shadow("item_3", "node_2", 0, 0), (True, "text"))
+
+    def test_archive(self):
+        self.db.start_transaction()
+        self.db.enqueue_client_edits("node_2", "item_1", "edits", "1", 0, 0, "")
+        edit = self.db.get_first_queued_edit("node_2")
+        self.db.archive_edit(edit["rowid"])
+        self.db.delete_edit(edit["rowid"])
+        self.db.save_new_patches("node_2", "item_1", "patches", 0, 0, 1)
+        self.db.archive_patch("item_1", "node_2", 0)
+        self.db.delete_patch("item_1", "node_2", 0)
+        self.db.end_transaction()
+
+        self.assertIsNone(self.db.get_first_queued_edit("node_2"))
+        self.assertTrue(self.db.check_if_patch_done("node_2", "item_1", 0, 0))
+        self.assertEqual(self.db.get_archived(ARCHIVE_EDIT, "item_1", "node_2", 0)["edits"], "edits")
+        self.assertEqual(self.db.get_archived(ARCHIVE_PATCH, "item_1", "node_2", 0)["patches"], "patches")
+        self.assertEqual(self.db.get_archived_revs(ARCHIVE_PATCH, "item_1"), [("node_2", 0, 0)])
+
+    def test_batched_queues(self):
+        self.db.start_transaction()
+        for n_rev in range(3):
+            self.db.enqueue_client_edits("node_2", "item_1", f"edits {n_rev}", "1", n_rev, 0, "")
+            self.db.save_new_patches("node_2", "item_1", f"patches {n_rev}", n_rev, 0, 1)
+        self.db.end_transaction()
+
+        edits = self.db.get_queued_edits("node_2", 2)
+        self.assertEqual([edit["n_rev"] for edit in edits], [0, 1])
+        patches = self.db.get_first_patches("node_2", 10)
+        self.assertEqual(len(patches), 3)
+
+        self.db.start_transaction()
+        self.db.archive_edits([edit["rowid"] for edit in edits])
+        self.db.delete_edits([edit["rowid"] for edit in edits])
+        keys = [("item_1", "node_2", n_rev) for n_rev in range(2)]
+        self.db.archive_patches(keys)
+        self.db.delete_patches(keys)
+        self.db.end_transaction()
+
+        self.assertEqual(self.db.get_first_queued_edit("node_2")["n_rev"], 2)
+        self.assertEqual(len(self.db.get_first_patches("node_2", 10)), 1)
+        self.assertEqual(self.db.get_archived(ARCHIVE_EDIT, "item_1", "node_2", 1)["edits"], "edits 1")
+        self.assertTrue(self.db.check_if_patch_done("node_2", "item_1", 1, 0))
+
+    def test_move_legacy_archives(self):
+        self.db.start_transaction()
+        self.db.cur.execute("""INSERT INTO patches_archive (item, other_node, n_rev, m_rev, patches, crc)
+                               VALUES ('item_1', 'node_2', 0, 0, 'patches', 1)""")
+        self.db.end_transaction()
+        self.assertTrue(self.db.check_if_patch_done("node_2", "item_1", 0, 0))
+
+        self.assertEqual(self.db.move_legacy_archives(10), 1)
+        self.assertEqual(self.db.move_legacy_archives(10), 0)
+        self.assertTrue(self.db.check_if_patch_done("node_2", "item_1", 0, 0))
+        self.assertEqual(self.db.get_archived(ARCHIVE_PATCH, "item_1", "node_2", 0)["patches"], "patches")
+
+    def test_delta_shadows(self):
+        db = DataStore("test_node1", 5001, db_prefix="test_db_", shadow_storage="delta", keyframe_interval=3)
+        texts = [f"{'a long line of text. ' * 20}edit {n_rev}" for n_rev in range(6)]
+        db.start_transaction()
+        for n_rev, text in enumerate(texts):
+            db.save_new_shadow("node_2", "item_1", text, n_rev, 0, get_crc(text))
+        db.end_transaction()
+
+        db.cur.execute("SELECT n_rev FROM shadows WHERE base_n_rev IS NULL ORDER BY n_rev")
+        self.assertEqual([row["n_rev"] for row in db.cur.fetchall()], [0, 3])
+        for n_rev, text in enumerate(texts):
+            self.assertEqual(db.get_shadow("item_1", "node_2", n_rev, 0), (True, text))
+        self.assertEqual(db.get_latest_rev_shadow("node_2", "item_1"), (5, 0, texts[5]))
+
+        # the kept revisions lose their keyframe
+        db.compact_shadows(10)
+        self.assertEqual(db.get_shadow("item_1", "node_2", 4, 0), (True, texts[4]))
+        self.assertEqual(db.get_shadow("item_1", "node_2", 5, 0), (True, texts[5]))
+
+        db.start_transaction()
+        db.save_new_shadow("node_2", "item_1", texts[0], 6, 0, get_crc(texts[0]))
+        db.delete_revs_higher_than("node_2", "item_1", 5)
+        db.save_new_shadow("node_2", "item_1", texts[1], 4, 0, get_crc(texts[1]))  # replaces a keyframe
+        db.end_transaction()
+        self.assertEqual(db.get_shadow("item_1", "node_2", 4, 0), (True, texts[1]))
+        self.assertEqual(db.get_shadow("item_1", "node_2", 5, 0), (True, texts[5]))
+
+    def test_compressed_texts(self):
+        long_text = "a long line of text. " * 100
+        self.db.start_transaction()
+        self.db.save_new_item("item_1", long_text, get_crc(long_text))
+        self.db.save_new_item("item_2", "short text", get_crc("short text"))
+        self.db.save_new_shadow("node_2", "item_1", long_text, 1, 0, get_crc(long_text))
+        self.db.enqueue_client_edits("node_2", "item_1", "edits", "1", 0, 0, long_text)
+        self.db.cur.execute("""INSERT INTO items (id, text, node, crc)
+                               VALUES ('item_3', ?, 'test_node1', ?)""", (long_text, get_crc(long_text)))
+        self.db.end_transaction()
+        self.db.save_new_post("item_1", long_text, get_crc(long_text))
+
+        self.db.cur.execute("""SELECT id, typeof(COALESCE(texts.text, items.text)) AS type
+                               FROM items
+                               LEFT JOIN texts ON texts.hash = items.text_hash
+                               ORDER BY id""")
+        self.assertEqual([(row["id"], row["type"]) for row in self.db.cur.fetchall()],
+                         [("item_1", "blob"), ("item_2", "text"), ("item_3", "text")])
+        self.assertEqual(self.db.get_item("item_1"), (True, long_text, get_crc(long_text)))
+        self.assertEqual(self.db.get_item("item_3"), (True, long_text, get_crc(long_text)))
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 1, 0), (True, long_text))
+        self.assertEqual(self.db.get_first_queued_edit("node_2")["old_shadow"], long_text)
+        self.assertEqual(self.db.get_post_pending()[2], long_text)
+
+    def test_items_pages(self):
+        self.db.start_transaction()
+        for item_id in ("item_3", "item_1", "item_2"):
+            self.db.save_new_item(item_id, "text", get_crc("text"))
+        self.db.end_transaction()
+
+        self.assertEqual([item["id"] for item in self.db.get_items(2)], ["item_1", "item_2"])
+        self.assertEqual([item["id"] for item in self.db.get_items(2, "item_2")], ["item_3"])
+        self.assertEqual(self.db.get_items(2, "item_3"), [])
+        self.assertEqual(len(self.db.get_items()), 3)
+
+    def test_reader(self):
+        reader = self.db.get_reader()
+        self.db.start_transaction()
+        self.db.save_new_item("item_1", "text", get_crc("text"))
+        self.db.end_transaction()
+
+        self.db.start_transaction()
+        self.db.update_item("item_1", "new text", get_crc("new text"))
+        # the open write transaction neither blocks the reader nor shows through
+        self.assertEqual(reader.get_item("item_1"), (True, "text", get_crc("text")))
+        self.db.end_transaction()
+        self.assertEqual(reader.get_item("item_1"), (True, "new text", get_crc("new text")))
+        self.assertEqual(reader.get_items(), [{"id": "item_1", "node": "test_node1", "crc": get_crc("new text")}])
+
+        with self.assertRaises(Exception):
+            reader.start_transaction()
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.cur.execute("DELETE FROM items")
+        reader.release()
+
+    def test_profiles(self):
+        synchronous = {"OFF": 0, "NORMAL": 1, "FULL": 2}
+        for name, profile in DB_PROFILES.items():
+            close_pools()
+            db = DataStore("test_node1", 5001, db_prefix="test_db_", profile=name)
+            for cur in (db.cur, db.posts_pool.cursor()):
+                with self.subTest(profile=name):
+                    self.assertEqual(cur.execute("PRAGMA journal_mode").fetchone()[0], profile["journal_mode"].lower())
+                    self.assertEqual(cur.execute("PRAGMA synchronous").fetchone()[0],
+                                     synchronous[profile["synchronous"]])
+                    self.assertEqual(cur.execute("PRAGMA busy_timeout").fetchone()[0], profile["busy_timeout"])
+            db.release()
+
+    def test_connection_pool(self):
+        pool = self.db.pool
+        pool.release()
+        con = pool.connection()
+        # a thread keeps its connection until it releases it
+        self.assertIs(pool.connection(), con)
+        self.assertIs(self.db.con, con)
+        others = []
+        other = threading.Thread(target=lambda: (others.append(pool.connection()), pool.release()))
+        other.start()
+        other.join()
+        self.assertIsNot(others[0], con)
+        # released connections are borrowed again instead of opening new ones
+        pool.release()
+        self.assertIs(pool.connection(), con)
+        self.assertEqual(pool._idle, [others[0]])
+
+    def test_read_cache(self):
+        self.db.start_transaction()
+        self.db.add_known_node("node_2", "http://localhost:6001")
+        self.db.save_new_item("item_1", "text", get_crc("text"))
+        self.db.save_new_shadow("node_2", "item_1", "text", 1, 0, get_crc("text"))
+        self.db.end_transaction()
+
+        statements = []
+        self.db.con.set_trace_callback(statements.append)
+        for _ in range(2):
+            self.assertEqual(self.db.get_item("item_1"), (True, "text", get_crc("text")))
+            self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (1, 0))
+            self.assertEqual(self.db.get_known_nodes(), [{"id": "node_2", "base_url": "http://localhost:6001"}])
+        self.db.con.set_trace_callback(None)
+        self.assertEqual(len([statement for statement in statements if statement.startswith("SELECT")]), 3)
+
+        # own writes: seen inside the transaction, and by everybody once committed
+        self.db.start_transaction()
+        self.db.update_item("item_1", "new text", get_crc("new text"))
+        self.assertEqual(self.db.get_item("item_1"), (True, "new text", get_crc("new text")))
+        self.db.rollback_transaction()
+        self.assertEqual(self.db.get_item("item_1"), (True, "text", get_crc("text")))
+        self.db.start_transaction()
+        self.db.save_new_shadow("node_2", "item_1", "text", 2, 0, get_crc("text"))
+        self.db.end_transaction()
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (2, 0))
+
+        # writes of another connection
+        con = sqlite3.connect(self.db.db_path)
+        con.execute("UPDATE items SET crc = 1 WHERE id = 'item_1'")
+        con.execute("INSERT INTO nodes (id, base_url) VALUES ('node_3', 'http://localhost:7001')")
+        con.commit()
+        con.close()
+        self.assertEqual(self.db.get_item("item_1"), (True, "text", 1))
+        self.assertEqual(len(self.db.get_known_nodes()), 2)
+
+    def _text_refs(self, text):
+        self.db.cur.execute("""SELECT refs
+                               FROM texts
+                               WHERE hash = ?""", (hashlib.sha256(text.encode()).digest(),))
+        row = self.db.cur.fetchone()
+        return row["refs"] if row else None
+
+    def test_shared_texts(self):
+        self.db.start_transaction()
+        self.db.save_new_item("item_1", "text", get_crc("text"))
+        for other_node in ("node_2", "node_3", "node_4"):
+            self.db.save_new_shadow(other_node, "item_1", "text", 0, 0, get_crc("text"))
+            self.db.enqueue_client_edits(other_node, "item_1", "edits", "1", 0, 0, "text")
+        self.db.end_transaction()
+
+        self.db.cur.execute("SELECT COUNT(*) FROM texts")
+        self.assertEqual(self.db.cur.fetchone()[0], 1)
+        self.assertEqual(self._text_refs("text"), 7)
+        self.assertEqual(self.db.get_item("item_1"), (True, "text", get_crc("text")))
+        self.assertEqual(self.db.get_shadow("item_1", "node_3", 0, 0), (True, "text"))
+        self.assertEqual(self.db.get_first_queued_edit("node_4")["old_shadow"], "text")
+
+        self.db.start_transaction()
+        self.db.update_item("item_1", "text", get_crc("text"))  # replaced with the same text
+        self.db.update_item("item_1", "new text", get_crc("new text"))
+        self.db.save_new_shadow("node_2", "item_1", "new text", 0, 0, get_crc("new text"))
+        edits = self.db.get_queued_edits("node_2", 10)
+        self.db.delete_edits([edit["rowid"] for edit in edits])
+        self.db.end_transaction()
+        self.assertEqual(self._text_refs("text"), 4)
+        self.assertEqual(self._text_refs("new text"), 2)
+
+        self.db.start_transaction()
+        self.db.delete_revs_higher_than("node_3", "item_1", -1)
+        self.db.delete_revs_higher_than("node_4", "item_1", -1)
+        for edit in self.db.get_queued_edits("node_3", 10) + self.db.get_queued_edits("node_4", 10):
+            self.db.delete_edit(edit["rowid"])
+        self.db.end_transaction()
+        self.assertEqual(self._text_refs("text"), 0)
+        self.assertEqual(self.db.delete_unreferenced_texts(10), 1)
+        self.assertIsNone(self._text_refs("text"))
+        self.assertEqual(self.db.get_item("item_1"), (True, "new text", get_crc("new text")))
+
+    def test_metrics(self):
+        metrics = get_metrics()
+        metrics.reset()
+        self.db.start_transaction("metrics test")
+        self.db.save_new_item("item_1", "text", 1)
+        self.db.save_new_item("item_2", "text", 2)
+        self.db.end_transaction()
+        self.assertEqual(len(self.db.get_items()), 2)
+        self.db.get_items()
+
+        operations = metrics.snapshot()["operations"]
+        self.assertEqual(operations["db.get_items"]["count"], 2)
+        self.assertEqual(operations["db.get_items"]["rows"], 4)
+        self.assertEqual(operations["db.iter_items"]["count"], 2)
+        self.assertGreaterEqual(operations["db.save_new_item"]["rows"], 2)
+        self.assertEqual(operations["db.lock_wait"]["count"], 1)
+        self.assertEqual(operations["db.transaction_hold"]["count"], 1)
+        self.assertEqual(sum(operations["db.get_items"]["buckets"]), 2)
+
+        slow_threshold_ms = metrics.slow_threshold_ms
+        metrics.slow_threshold_ms = 0.000001
+        try:
+            self.db.get_item("item_1")
+        finally:
+            metrics.slow_threshold_ms = slow_threshold_ms
+        self.assertEqual(metrics.snapshot()["slow"][-1]["name"], "db.get_item")
+        self.assertEqual(metrics.snapshot()["slow"][-1]["detail"], "('item_1')")
+
+        # the worker cycles add up in their file
+        metrics_path = f"{os.path.splitext(self.db.db_path)[0]}_metrics_test.json"
+        if os.path.exists(metrics_path):
+            os.remove(metrics_path)
+        save_metrics(metrics_path)
+        self.assertEqual(metrics.snapshot()["operations"], {})
+        self.db.get_items()
+        save_metrics(metrics_path)
+        self.assertEqual(load_metrics(metrics_path)["operations"]["db.get_items"]["count"], 3)
+        os.remove(metrics_path)
+
+    def test_queries_use_indexes(self):
+        statements = []
+        self.db.con.set_trace_callback(statements.append)
+        self._use_every_query()
+        self.db.con.set_trace_callback(None)
+
+        checked = 0
+        for statement in statements:
+            if statement.split()[0].upper() not in ('SELECT', 'UPDATE', 'DELETE', 'INSERT'):
+                continue
+            self.db.cur.execute(f"EXPLAIN QUERY PLAN {statement}")
+            for row in self.db.cur.fetchall():
+                detail = row["detail"]
+                # move_legacy_archives drains the old archive tables in rowid order
+                if detail.startswith("SCAN") and not detail.startswith(("SCAN edits_archive", "SCAN patches_archive")):
+                    self.assertIn("INDEX", detail, f"full table scan in: {statement}")
+            checked += 1
+        self.assertGreater(checked, 20)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
@@ -0,0 +1,220 @@
+from unittest import TestCase
+import unittest
+import logging
+import os
+import sys
+from base64 import b64encode
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))  # FIXME use pathlib
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'abrim'))
+
+from abrim import input
+from abrim.config import Config
+from abrim.util import create_diff_edits, get_crc
+
+
+class InputTests(TestCase):
+    # input.py's handlers through the Flask test client, on a fresh sqlite node
+    headers = {'Authorization': "Basic " + b64encode(b"admin:secret").decode("ascii")}
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.config = Config("test_input_node", 7401, db_prefix="test_db_", drop_db=True)
+        self.db = self.config.db
+        input.app.config['ABRIM_CONFIG'] = self.config
+        self.client = input.app.test_client()
+
+    def tearDown(self):
+        self.db.release()
+        logging.disable(logging.NOTSET)
+
+    def request(self, method, url, payload=None):
+        # (HTTP status, json body)
+        response = self.client.open(url, method=method, json=payload, headers=self.headers)
+        return response.status_code, response.get_json()
+
+
+class TestStats(InputTests):
+
+    def tearDown(self):
+        for component in ("out", "patch"):
+            metrics_path = self.config.metrics_path(component)
+            if os.path.exists(metrics_path):
+                os.remove(metrics_path)
+        super().tearDown()
+
+    def get_stats(self):
+        return self.request('GET', '/stats')
+
+    def test_stats(self):
+        with open(self.config.metrics_path("patch"), 'w') as metrics_file:
+            metrics_file.write('{"operations": {}, "counters": {"bus.patch_enqueued": 2}}')
+        status, body = self.get_stats()
+        self.assertEqual(status, 200)
+        self.assertEqual(body["content"]["patch"]["counters"], {"bus.patch_enqueued": 2})
+        self.assertIsNone(body["content"]["out"])
+
+    def test_corrupt_metrics_file(self):
+        # out.py died halfway through saving them
+        with open(self.config.metrics_path("out"), 'w') as metrics_file:
+            metrics_file.write('{"operations": {"db.transaction": {"count": ')
+        with open(self.config.metrics_path("patch"), 'w') as metrics_file:
+            metrics_file.write('[]')
+        status, body = self.get_stats()
+        self.assertEqual(status, 200)
+        self.assertEqual(body["api_unique_code"], "queue_in/get_stats/200/ok")
+        self.assertIsNone(body["content"]["out"])
+        self.assertIsNone(body["content"]["patch"])
+
+    def test_failing_snapshot(self):
+        with mock.patch.object(input, 'get_metrics', side_effect=RuntimeError("broken")), \
+                mock.patch('traceback.print_exc'):
+            status, body = self.get_stats()
+        self.assertEqual(status, 500)
+        self.assertEqual(body["api_unique_code"], "queue_in/get_stats/500/stats_exception")
+
+
+class TestShadow(InputTests):
+
+    def test_put_shadow_of_new_item(self):
+        status, body = self.request('PUT', '/items/item_1/shadow/node_2', {"n_rev": 1, "m_rev": 0, "shadow": "text"})
+        self.assertEqual((status, body["api_unique_code"]), (201, "queue_in/put_shadow/201/ack"))
+        self.assertEqual(self.db.get_item("item_1")[:2], (True, "text"))
+
+    def test_put_shadow_of_existing_item(self):
+        # what out.py sends when the other node answered not_shadow
+        status, _ = self.request('PUT', '/items/item_1', {"text": "local text"})
+        self.assertEqual(status, 200)
+        status, body = self.request('PUT', '/items/item_1/shadow/node_2', {"n_rev": 1, "m_rev": 0, "shadow": "text"})
+        self.assertEqual((status, body["api_unique_code"]), (201, "queue_in/put_shadow/201/ack"))
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 1, 0), (True, "text"))
+        self.assertEqual(self.db.get_item("item_1")[:2], (True, "local text"))
+
+
+class TestPatchDone(InputTests):
+
+    def setUp(self):
+        super().setUp()
+        # node_2's sync of item_1 was patched
+        with self.db.transaction():
+            self.db.save_new_patches("node_2", "item_1", "patches", 0, 0, 1)
+            self.db.archive_patches([("item_1", "node_2", 0)])
+            self.db.delete_patches([("item_1", "node_2", 0)])
+
+    def test_nothing_to_piggyback(self):
+        # the usual answer doesn't open a write transaction
+        with mock.patch.object(self.db, 'run_transaction') as run_transaction:
+            self.assertEqual(input._check_patch_done(self.config, 1, "node_2", "item_1", 0, 0), {'edits': []})
+        run_transaction.assert_not_called()
+
+    def test_piggyback(self):
+        with self.db.transaction():
+            self.db.enqueue_client_edits("node_2", "item_1", "edits 1", "hash", 1, 0, "shadow")
+        self.assertEqual(input._check_patch_done(self.config, 1, "node_2", "item_1", 0, 0),
+                         {'edits': [{'n_rev': 1, 'm_rev': 0, 'edits': "edits 1", 'hash': "hash"}]})
+        self.assertTrue(self.db.get_queued_edits("node_2", 10)[0]["piggybacked"])
+
+
+class SyncTests(InputTests):
+    # edits of node_2 as its out.py sends them. patch.py doesn't run, so the patches are never applied and the
+    # answers don't wait for them
+    texts = ["", "one", "one two", "one two three"]
+
+    def setUp(self):
+        super().setUp()
+        patch_done = mock.patch.object(input, '_check_patch_done', return_value={'edits': []})
+        patch_done.start()
+        self.addCleanup(patch_done.stop)
+
+    def edit(self, n_rev, item=None):
+        # the edit that takes texts[n_rev] to texts[n_rev + 1]
+        edit = {"n_rev": n_rev, "m_rev": 0, "hash": get_crc(self.texts[n_rev]),
+                "edits": create_diff_edits(self.texts[n_rev + 1], self.texts[n_rev])}
+        if item:
+            edit["item"] = item
+        return edit
+
+    def codes(self, results):
+        return [result["api_unique_code"] for result in results]
+
+
+class TestStack(SyncTests):
+
+    def post_stack(self, stack):
+        return self.request('POST', '/items/item_1/sync/node_2', dict(stack[0], stack=stack))
+
+    def test_stack(self):
+        status, body = self.post_stack([self.edit(0), self.edit(1), self.edit(2)])
+        self.assertEqual((status, body["api_unique_code"]), (201, "queue_in/post_sync/201/done"))
+        self.assertEqual(self.codes(body["content"]["stack"]), ["queue_in/post_sync/201/done"] * 3)
+        self.assertEqual(body["content"]["n_rev"], 2)
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (3, 0))
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 3, 0), (True, "one two three"))
+        self.assertEqual([patch[2] for patch in self.db.get_first_patches("node_2", 10)], [0, 1, 2])
+
+    def test_stale_edit_in_the_middle(self):
+        # the second one is against a shadow this node never had: it's undone alone and the third waits for it
+        stale = dict(self.edit(0), hash=get_crc("something else"))
+        with mock.patch('traceback.print_exc'):
+            status, body = self.post_stack([self.edit(0), stale, self.edit(1)])
+        self.assertEqual(status, 201)
+        self.assertEqual(self.codes(body["content"]["stack"]),
+                         ["queue_in/post_sync/201/done", "queue_in/post_sync/500/transaction_exception",
+                          "queue_in/post_sync/409/previous_edit_failed"])
+        self.assertEqual(body["content"]["n_rev"], 0)
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (1, 0))
+        self.assertEqual([patch[2] for patch in self.db.get_first_patches("node_2", 10)], [0])
+
+    def test_single_edits(self):
+        # what a sender that doesn't know stacks sends, one edit per request
+        for n_rev in range(3):
+            status, body = self.request('POST', '/items/item_1/sync/node_2', self.edit(n_rev))
+            self.assertEqual((status, body["api_unique_code"]), (201, "queue_in/post_sync/201/done"))
+            self.assertNotIn("stack", body["content"])
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 3, 0), (True, "one two three"))
+
+    def test_too_big_stack(self):
+        self.config.bulk_sync_limit = 2
+        status, body = self.post_stack([self.edit(0), self.edit(1), self.edit(2)])
+        self.assertEqual((status, body["api_unique_code"]), (413, "queue_in/post_sync/413/too_many_edits"))
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (None, None))
+
+
+class TestBulkSync(SyncTests):
+
+    def post_bulk(self, edits):
+        return self.request('POST', '/items/sync/node_2', {"edits": edits})
+
+    def test_bulk_sync(self):
+        status, body = self.post_bulk([self.edit(0, "item_1"), self.edit(1, "item_1"), self.edit(0, "item_2")])
+        self.assertEqual((status, body["api_unique_code"]), (200, "queue_in/post_bulk_sync/200/ok"))
+        self.assertEqual(self.codes(body["content"]["results"]), ["queue_in/post_sync/201/done"] * 3)
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (2, 0))
+        self.assertEqual(self.db.get_latest_revs("item_2", "node_2"), (1, 0))
+
+    def test_failed_edit(self):
+        # the rest of that item's edits wait for it, the other items go on
+        stale = dict(self.edit(0, "item_1"), hash=get_crc("something else"))
+        self.request('POST', '/items/item_1/sync/node_2', self.edit(0))
+        with mock.patch('traceback.print_exc'):
+            status, body = self.post_bulk([stale, self.edit(1, "item_1"), self.edit(0, "item_2")])
+        self.assertEqual(status, 200)
+        self.assertEqual(self.codes(body["content"]["results"]),
+                         ["queue_in/post_sync/500/transaction_exception", "queue_in/post_sync/409/previous_edit_failed",
+                          "queue_in/post_sync/201/done"])
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (1, 0))
+        self.assertEqual(self.db.get_latest_revs("item_2", "node_2"), (1, 0))
+
+    def test_malformed_request(self):
+        status, body = self.request('POST', '/items/sync/node_2', {"edits": self.edit(0, "item_1")})
+        self.assertEqual((status, body["api_unique_code"]), (405, "queue_in/post_bulk_sync/405/check_req"))
+
+    def test_too_many_edits(self):
+        self.config.bulk_sync_limit = 2
+        status, body = self.post_bulk([self.edit(0, "item_1"), self.edit(1, "item_1"), self.edit(0, "item_2")])
+        self.assertEqual((status, body["api_unique_code"]), (413, "queue_in/post_bulk_sync/413/too_many_edits"))
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
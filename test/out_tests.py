@@ -0,0 +1,134 @@
+from unittest import TestCase
+import unittest
+import logging
+import os
+import sys
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))  # FIXME use pathlib
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'abrim'))
+
+os.environ['ABRIM_STORAGE'] = 'memory'
+from abrim import out
+from abrim.config import Config
+from storage import BusyError
+
+
+class TestOut(TestCase):
+    node_id = "out_test_node"
+    port = 7201
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.config = Config(self.node_id, self.port, drop_db=True)
+        self.db = self.config.db
+        self.db.start_transaction()
+        self.db.add_known_node("node_2", "http://localhost:6001")
+        self.db.enqueue_client_edits("node_2", "item_1", "edits 0", "hash", 0, 0, "shadow")
+        self.db.end_transaction()
+        self.sends = 0
+        self.sent_in_transaction = False
+        self.payloads = []
+        out._no_bulk_sync.clear()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def send_sync(self, edit, other_node_url, use_put=False):
+        # the node's storage has to be free while the other node answers
+        self.sent_in_transaction |= self.db.check_transaction()
+        self.sends += 1
+        self.payloads.append(edit)
+        return 201, "queue_in/post_sync/201/done", {"api_unique_code": "queue_in/post_sync/201/done",
+                                                    "content": {"edits": []}}
+
+    def test_sent_out_of_the_transaction(self):
+        with mock.patch.object(out, 'send_sync', self.send_sync):
+            out._process_out_queue(mock.MagicMock(), self.config)
+        self.assertEqual(self.sends, 1)
+        self.assertFalse(self.sent_in_transaction)
+        self.assertEqual(self.db.get_queued_edits("node_2", 10), [])
+
+    def test_busy_storage_doesnt_send_again(self):
+        archive_edits = self.db.archive_edits
+        calls = []
+
+        def busy_once(rowids):
+            calls.append(rowids)
+            if len(calls) == 1:
+                raise BusyError("busy")
+            archive_edits(rowids)
+
+        with mock.patch.object(out, 'send_sync', self.send_sync), \
+                mock.patch.object(self.db, 'archive_edits', busy_once):
+            out._process_out_queue(mock.MagicMock(), self.config)
+        self.assertEqual(len(calls), 2)  # the transaction ran again
+        self.assertEqual(self.sends, 1)  # but the edit was sent once
+        self.assertEqual(self.db.get_queued_edits("node_2", 10), [])
+
+    def test_busy_storage_keeps_the_edits(self):
+        def busy(rowids):
+            raise BusyError("busy")
+
+        self.db.transaction_retries = 1
+        with mock.patch.object(out, 'send_sync', self.send_sync), \
+                mock.patch.object(self.db, 'archive_edits', busy):
+            out._process_out_queue(mock.MagicMock(), self.config)
+        self.assertEqual(self.sends, 1)
+        self.assertEqual(len(self.db.get_queued_edits("node_2", 10)), 1)
+
+    def enqueue_second_edit(self):
+        with self.db.transaction():
+            self.db.enqueue_client_edits("node_2", "item_1", "edits 1", "hash", 1, 0, "shadow")
+
+    def test_stack(self):
+        self.enqueue_second_edit()
+
+        def send_sync(edit, other_node_url, use_put=False):
+            self.send_sync(edit, other_node_url)
+            done = {"api_unique_code": "queue_in/post_sync/201/done", "content": {"edits": []}}
+            return 201, "queue_in/post_sync/201/done", dict(done, content={"edits": [], "stack": [done, done]})
+
+        # node_2 doesn't take bulk syncs, the item's edits go in one request
+        with mock.patch.object(out, 'send_bulk_sync', return_value=None), \
+                mock.patch.object(out, 'send_sync', send_sync):
+            out._process_out_queue(mock.MagicMock(), self.config)
+        self.assertEqual(self.sends, 1)
+        self.assertEqual([edit["edits"] for edit in self.payloads[0]["stack"]], ["edits 0", "edits 1"])
+        self.assertEqual(self.payloads[0]["n_rev"], 0)
+        self.assertEqual(self.db.get_queued_edits("node_2", 10), [])
+
+    def test_node_without_stacks(self):
+        # it only syncs the first edit of the stack, the second goes in the next request on its own
+        self.enqueue_second_edit()
+        with mock.patch.object(out, 'send_bulk_sync', return_value=None), \
+                mock.patch.object(out, 'send_sync', self.send_sync):
+            out._process_out_queue(mock.MagicMock(), self.config)
+        self.assertEqual(self.sends, 2)
+        self.assertEqual(len(self.payloads[0]["stack"]), 2)
+        self.assertEqual((self.payloads[1]["n_rev"], "stack" in self.payloads[1]), (1, False))
+        self.assertEqual(self.db.get_queued_edits("node_2", 10), [])
+
+    def test_node_without_bulk_sync(self):
+        # it predates POST /items/sync/<node>: the edits go an item at a time and it isn't asked again this cycle
+        with self.db.transaction():
+            self.db.enqueue_client_edits("node_2", "item_2", "edits 0", "hash", 0, 0, "shadow")
+        not_found = mock.Mock(status_code=404, text="<!doctype html>\n<title>404 Not Found</title>")
+        with mock.patch.object(out, 'post_request', return_value=not_found) as post_request, \
+                mock.patch.object(out, 'send_sync', self.send_sync):
+            out._process_out_queue(mock.MagicMock(), self.config)
+            self.assertIsNone(out._send_bulk(self.config, "http://localhost:6001", [{}, {}]))
+        post_request.assert_called_once()
+        self.assertEqual(post_request.call_args[0][0], "http://localhost:6001/items/sync/out_test_node")
+        self.assertIn("http://localhost:6001", out._no_bulk_sync)
+        self.assertEqual(self.sends, 2)
+        self.assertEqual(self.db.get_queued_edits("node_2", 10), [])
+
+    def test_bulk_sync_refused(self):
+        refused = mock.Mock(status_code=405, text='{"api_unique_code": "queue_in/post_bulk_sync/405/check_req", '
+                                                  '"message": "Malformed JSON request", "content": null}')
+        with mock.patch.object(out, 'post_request', return_value=refused):
+            self.assertIsNone(out.send_bulk_sync([{}], "http://localhost:6001/items/sync/out_test_node"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,397 @@
+from unittest import TestCase
+import unittest
+import logging
+import os
+import sys
+import threading
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))  # FIXME use pathlib
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'abrim'))
+
+from datastore import DataStore, close_pools
+from memory_storage import MemoryStorage
+from sharded_storage import ShardedStorage, shard_of
+from metrics import get_metrics
+from storage import ARCHIVE_EDIT, ARCHIVE_PATCH, BusyError, TransactionError
+
+
+class StorageTests(object):
+    # what every storage engine has to do the same way
+    db = None
+
+    def new_storage(self):
+        raise NotImplementedError
+
+    def set_busy_timeout(self, milliseconds):
+        # for this thread
+        raise NotImplementedError
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.db = self.new_storage()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_nodes(self):
+        self.db.start_transaction()
+        self.db.add_known_node("node_3", "http://localhost:7001")
+        self.db.add_known_node("node_2", "http://localhost:6001")
+        self.db.add_known_node("node_2", "http://localhost:6002")
+        self.db.end_transaction()
+        self.assertEqual(self.db.get_known_nodes(), [{"id": "node_2", "base_url": "http://localhost:6001"},
+                                                     {"id": "node_3", "base_url": "http://localhost:7001"}])
+
+    def test_no_items(self):
+        # GET /items on an empty node: the first next() gives nothing and the rest isn't read
+        items = self.db.get_reader().iter_items(2)
+        self.assertIsNone(next(items, None))
+        items.close()
+        self.assertEqual(self.db.get_items(), [])
+
+    def test_items(self):
+        self.db.start_transaction()
+        self.db.save_new_item("item_2", "text 2", 2)
+        self.db.save_new_item("item_1", "text 1", 1)
+        self.db.update_item("item_2", "new text 2", 3)
+        self.db.end_transaction()
+        self.assertEqual(self.db.get_item("item_2"), (True, "new text 2", 3))
+        self.assertEqual(self.db.get_item("item_3"), (False, None, None))
+        self.assertEqual([item["id"] for item in self.db.get_items()], ["item_1", "item_2"])
+        self.assertEqual(self.db.get_items(1, "item_1"), [{"id": "item_2", "node": "test_node1", "crc": 3}])
+        # what GET /items does with a node without items after item_2
+        items = self.db.get_reader().iter_items(2, "item_2")
+        self.assertIsNone(next(items, None))
+        items.close()
+
+        self.db.start_transaction()
+        with self.assertRaises(Exception):
+            self.db.save_new_item("item_1", "text", 4)
+        self.db.rollback_transaction()
+
+    def test_rollback(self):
+        self.db.start_transaction()
+        self.db.save_new_item("item_1", "text", 1)
+        self.db.end_transaction()
+
+        self.db.start_transaction()
+        self.assertTrue(self.db.check_transaction())
+        self.db.update_item("item_1", "new text", 2)
+        self.db.save_new_item("item_2", "text", 1)
+        self.db.save_new_shadow("node_2", "item_1", "text", 0, 0, 1)
+        self.db.enqueue_client_edits("node_2", "item_1", "edits", "1", 0, 0, "")
+        self.db.rollback_transaction()
+        self.assertFalse(self.db.check_transaction())
+
+        self.assertEqual(self.db.get_item("item_1"), (True, "text", 1))
+        self.assertEqual(self.db.get_item("item_2"), (False, None, None))
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (None, None))
+        self.assertIsNone(self.db.get_first_queued_edit("node_2"))
+
+    def test_savepoint(self):
+        self.db.start_transaction()
+        self.db.save_new_item("item_1", "text", 1)
+        savepoint = self.db.savepoint()
+        self.db.update_item("item_1", "new text", 2)
+        for item_id in ("item_2", "item_3", "item_4"):
+            self.db.save_new_item(item_id, "text", 1)
+            self.db.save_new_shadow("node_2", item_id, "text", 0, 0, 1)
+        self.db.rollback_to_savepoint(savepoint)
+        self.assertTrue(self.db.check_transaction())
+        self.db.save_new_item("item_5", "text", 1)
+        self.db.end_transaction()
+
+        self.assertEqual(self.db.get_item("item_1"), (True, "text", 1))
+        self.assertEqual(self.db.get_item("item_5"), (True, "text", 1))
+        for item_id in ("item_2", "item_3", "item_4"):
+            self.assertEqual(self.db.get_item(item_id), (False, None, None))
+            self.assertEqual(self.db.get_latest_revs(item_id, "node_2"), (None, None))
+
+        # the keys rolled back aren't kept, item_2 gets its own again
+        self.db.start_transaction()
+        self.db.save_new_item("item_2", "text 2", 3)
+        self.db.end_transaction()
+        self.assertEqual(self.db.get_item("item_2"), (True, "text 2", 3))
+
+        with self.assertRaises(TransactionError):
+            self.db.savepoint()
+
+    def test_shadows(self):
+        self.assertEqual(self.db.get_latest_rev_shadow("node_2", "item_1"), (0, 0, ""))
+        self.db.start_transaction()
+        for n_rev in range(4):
+            self.db.save_new_shadow("node_2", "item_1", f"text {n_rev}", n_rev, 0, n_rev + 1)
+        self.db.end_transaction()
+        self.assertEqual(self.db.get_latest_rev_shadow("node_2", "item_1"), (3, 0, "text 3"))
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (3, 0))
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 1, 0), (True, "text 1"))
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 1, 1), (False, None))
+        self.assertTrue(self.db.find_rev_shadow("node_2", "item_1", 2, 0, 3))
+        self.assertFalse(self.db.find_rev_shadow("node_2", "item_1", 2, 0, 4))
+
+        self.db.start_transaction()
+        self.db.delete_revs_higher_than("node_2", "item_1", 2)
+        self.db.end_transaction()
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (2, 0))
+
+        self.assertEqual(self.db.compact_shadows(10), (1, None))
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 0, 0), (False, None))
+        self.assertEqual(self.db.get_shadow("item_1", "node_2", 1, 0), (True, "text 1"))
+
+    def test_edits(self):
+        self.db.start_transaction()
+        for n_rev in (1, 0, 2):
+            self.db.enqueue_client_edits("node_2", "item_1", f"edits {n_rev}", "hash", n_rev, 0, "shadow")
+        self.db.enqueue_client_edits("node_3", "item_1", "edits", "hash", 0, 0, "")
+        self.db.end_transaction()
+
+        edits = self.db.get_queued_edits("node_2", 2)
+        self.assertEqual([(edit["n_rev"], edit["edits"], edit["old_shadow"]) for edit in edits],
+                         [(0, "edits 0", "shadow"), (1, "edits 1", "shadow")])
+        item_edits = self.db.get_item_queued_edits("node_2", "item_1", 5)
+        self.assertEqual([(edit["n_rev"], edit["edits"]) for edit in item_edits],
+                         [(0, "edits 0"), (1, "edits 1"), (2, "edits 2")])
+        self.assertEqual(self.db.get_item_queued_edits("node_2", "item_2", 5), [])
+        self.db.start_transaction()
+        self.db.mark_edits_piggybacked([item_edits[1]["rowid"]])
+        self.db.end_transaction()
+        self.assertEqual([bool(edit["piggybacked"]) for edit in self.db.get_queued_edits("node_2", 5)],
+                         [False, True, False])
+        self.db.start_transaction()
+        self.db.archive_edits([edit["rowid"] for edit in edits])
+        self.db.delete_edits([edit["rowid"] for edit in edits])
+        self.db.end_transaction()
+
+        self.assertEqual(self.db.get_first_queued_edit("node_2")["n_rev"], 2)
+        self.assertEqual(self.db.get_archived(ARCHIVE_EDIT, "item_1", "node_2", 1)["edits"], "edits 1")
+        self.assertEqual(self.db.get_archived_revs(ARCHIVE_EDIT, "item_1"), [("node_2", 0, 0), ("node_2", 1, 0)])
+
+    def test_patches(self):
+        self.db.start_transaction()
+        self.db.save_new_patches("node_3", "item_1", "patches", 0, 0, 1)
+        self.db.save_new_patches("node_2", "item_1", "patches 1", 1, 0, 1)
+        self.db.save_new_patches("node_2", "item_1", "patches 0", 0, 0, 1)
+        self.db.save_new_patches("node_2", "item_2", "patches", 0, 1, 1)
+        self.db.end_transaction()
+
+        self.assertEqual(self.db.get_nodes_from_patches(), ["node_3", "node_2"])
+        self.assertEqual(self.db.get_first_patches("node_2", 2), [("item_1", "node_2", 0, 0, "patches 0", 1),
+                                                                  ("item_1", "node_2", 1, 0, "patches 1", 1)])
+        self.assertFalse(self.db.check_if_patch_done("node_2", "item_1", 0, 0))
+        self.assertTrue(self.db.check_if_patch_received("node_2", "item_1", 0, 0))
+        self.assertFalse(self.db.check_if_patch_received("node_2", "item_1", 2, 0))
+        self.db.start_transaction()
+        self.db.archive_patches([("item_1", "node_2", 0)])
+        self.db.delete_patches([("item_1", "node_2", 0)])
+        self.db.end_transaction()
+
+        self.assertTrue(self.db.check_if_patch_done("node_2", "item_1", 0, 0))
+        self.assertFalse(self.db.check_if_patch_done("node_2", "item_1", 0, 1))
+        self.assertTrue(self.db.check_if_patch_received("node_2", "item_1", 0, 0))
+        self.assertEqual(self.db.check_first_patch("node_2"), ("item_1", "node_2", 1, 0, "patches 1", 1))
+        self.assertEqual(self.db.get_archived(ARCHIVE_PATCH, "item_1", "node_2", 0)["patches"], "patches 0")
+
+    def test_posts(self):
+        self.assertEqual(self.db.get_post_pending(), (None, None, None, None, None))
+        first_rowid = self.db.save_new_post("item_1", "text 1", 1)
+        second_rowid = self.db.save_new_post("item_2", "text 2", 2)
+        self.assertEqual(self.db.get_post_pending(), (first_rowid, "item_1", "text 1", "test_node1", 1))
+        self.assertTrue(self.db.update_post_pending(first_rowid))
+        self.assertFalse(self.db.update_post_pending(first_rowid))
+        self.assertEqual(self.db.get_post_status(first_rowid), ("DONE", "item_1"))
+        self.assertEqual(self.db.get_post_status(second_rowid), ("PENDING", "item_2"))
+        self.assertEqual(self.db.get_post_pending()[0], second_rowid)
+
+    def test_posts_file(self):
+        # a post is saved while a sync transaction holds the node, and stays when the sync is rolled back
+        self.db.start_transaction()
+        self.db.save_new_item("item_1", "text", 1)
+        saved = []
+
+        def post():
+            saved.append(self.db.save_new_post("item_1", "post text", 4))
+            self.db.release()
+        poster = threading.Thread(target=post)
+        poster.start()
+        poster.join(2)
+        self.assertEqual(len(saved), 1)
+        rowid = saved[0]
+        # patch.py marks posts done in its transactions, that isn't undone either
+        self.assertTrue(self.db.update_post_pending(self.db.save_new_post("item_1", "other post", 5)))
+        self.db.rollback_transaction()
+        self.assertEqual(self.db.get_reader().get_post_status(rowid), ("PENDING", "item_1"))
+        self.assertEqual(self.db.get_item("item_1"), (False, None, None))
+        self.assertEqual(self.db.get_post_status(rowid + 1), ("DONE", "item_1"))
+
+    def test_claim_posts(self):
+        first_rowid = self.db.save_new_post("item_1", "text 1", 1)
+        second_rowid = self.db.save_new_post("item_1", "text 2", 2)
+        third_rowid = self.db.save_new_post("item_2", "text 3", 3)
+        self.assertEqual(self.db.claim_post("worker_1", 60), (first_rowid, "item_1", "text 1", "test_node1", 1))
+        # item_1 is worker_1's until its post is done
+        self.assertEqual(self.db.claim_post("worker_2", 60)[0], third_rowid)
+        self.assertEqual(self.db.claim_post("worker_3", 60), (None, None, None, None, None))
+        self.assertTrue(self.db.update_post_pending(first_rowid))
+        self.assertEqual(self.db.claim_post("worker_3", 60)[0], second_rowid)
+        self.assertTrue(self.db.release_post(second_rowid, "worker_3"))
+        self.assertFalse(self.db.release_post(third_rowid, "worker_3"))
+        self.assertEqual(self.db.claim_post("worker_1", 60)[0], second_rowid)
+
+    def test_claim_expired_post(self):
+        rowid = self.db.save_new_post("item_1", "text 1", 1)
+        # a worker that was killed with the post claimed
+        self.assertEqual(self.db.claim_post("worker_1", -1)[0], rowid)
+        self.assertEqual(self.db.claim_post("worker_2", 60)[0], rowid)
+        self.assertEqual(self.db.claim_post("worker_1", 60)[0], None)
+
+    def test_claim_patches(self):
+        self.db.start_transaction()
+        for n_rev in range(3):
+            self.db.save_new_patches("node_2", "item_1", f"patches {n_rev}", n_rev, 0, 1)
+        self.db.save_new_patches("node_2", "item_2", "patches", 0, 0, 1)
+        self.db.end_transaction()
+
+        self.assertEqual(len(self.db.claim_patches("node_2", "worker_1", 10, 60)), 4)
+        # every item has patches claimed by worker_1
+        self.assertEqual(self.db.claim_patches("node_2", "worker_2", 10, 60), [])
+        self.db.release_patches([("item_2", "node_2", 0)], "worker_1")
+        self.assertEqual([patch[:3] for patch in self.db.claim_patches("node_2", "worker_2", 10, 60)],
+                         [("item_2", "node_2", 0)])
+        self.db.start_transaction()
+        self.db.archive_patches([("item_1", "node_2", 0)])
+        self.db.delete_patches([("item_1", "node_2", 0)])
+        self.db.end_transaction()
+        self.assertEqual([patch[:3] for patch in self.db.claim_patches("node_2", "worker_1", 10, -1)],
+                         [("item_1", "node_2", 1), ("item_1", "node_2", 2)])
+        # worker_1's lease expired
+        self.assertEqual(len(self.db.claim_patches("node_2", "worker_3", 10, 60)), 2)
+
+    def test_transaction(self):
+        with self.db.transaction("test"):
+            self.db.save_new_item("item_1", "text", 1)
+        with self.assertRaises(KeyError):
+            with self.db.transaction("test"):
+                self.db.save_new_item("item_2", "text", 2)
+                raise KeyError
+        with self.db.transaction("test"):
+            self.db.save_new_item("item_3", "text", 3)
+            self.db.rollback_transaction()
+        self.assertFalse(self.db.check_transaction())
+        self.assertEqual([item["id"] for item in self.db.get_items()], ["item_1"])
+
+        self.db.start_transaction()
+        with self.assertRaises(TransactionError):
+            self.db.start_transaction()
+        self.assertFalse(self.db.check_transaction())
+
+    def test_run_transaction_retries(self):
+        holding = threading.Event()
+        done = threading.Event()
+
+        def hold_the_lock():
+            self.db.start_transaction("holder")
+            self.db.save_new_item("item_0", "text", 1)
+            holding.set()
+            done.wait(0.15)
+            self.db.end_transaction()
+            self.db.release()
+
+        holder = threading.Thread(target=hold_the_lock)
+        holder.start()
+        holding.wait()
+        self.set_busy_timeout(50)
+        with self.assertRaises(BusyError):
+            with self.db.transaction():
+                self.db.get_item("item_0")
+        self.assertFalse(self.db.check_transaction())
+
+        retries = get_metrics().snapshot()["counters"].get("db.busy_retries", 0)
+        self.db.transaction_retries = 5
+        self.assertEqual(self.db.run_transaction(lambda: self.db.update_item("item_0", "new text", 2) or "ok"), "ok")
+        holder.join()
+        self.assertGreater(get_metrics().snapshot()["counters"]["db.busy_retries"], retries)
+        self.assertEqual(self.db.get_item("item_0"), (True, "new text", 2))
+
+
+class TestMemoryStorage(StorageTests, TestCase):
+
+    def new_storage(self):
+        return MemoryStorage("test_node1", 5001, db_prefix="test_db_", drop_db=True)
+
+    def set_busy_timeout(self, milliseconds):
+        self.db.busy_timeout = milliseconds
+
+    def test_shared_by_the_node_ports(self):
+        self.db.start_transaction()
+        self.db.save_new_item("item_1", "text", 1)
+        self.db.end_transaction()
+        self.assertEqual(MemoryStorage("test_node1", 5003, db_prefix="test_db_").get_item("item_1"), (True, "text", 1))
+        self.assertEqual(MemoryStorage("test_node2", 5003, db_prefix="test_db_").get_item("item_1"),
+                         (False, None, None))
+
+
+class TestDataStoreStorage(StorageTests, TestCase):
+
+    def new_storage(self):
+        return DataStore("test_node1", 5001, db_prefix="test_db_", drop_db=True)
+
+    def set_busy_timeout(self, milliseconds):
+        self.db.con.execute(f"PRAGMA busy_timeout = {milliseconds}")
+
+    def tearDown(self):
+        close_pools()
+        super().tearDown()
+
+
+class TestShardedStorage(StorageTests, TestCase):
+
+    def new_storage(self):
+        return ShardedStorage("test_node1", 5001, db_prefix="test_db_", drop_db=True, shards=3)
+
+    def set_busy_timeout(self, milliseconds):
+        for store in [self.db.catalog] + self.db.shards:
+            store.con.execute(f"PRAGMA busy_timeout = {milliseconds}")
+
+    def tearDown(self):
+        close_pools()
+        super().tearDown()
+
+    def test_item_writes_dont_lock_the_catalog(self):
+        self.db.start_transaction()
+        self.db.add_known_node("node_2", "http://localhost:6001")
+        self.db.end_transaction()
+        # what input.py's _update_item does
+        self.db.start_transaction()
+        self.db.save_new_item("item_1", "text", 1)
+        self.assertEqual([node["id"] for node in self.db.get_known_nodes()], ["node_2"])
+        self.assertFalse(self.db.catalog.con.in_transaction)
+        self.db.add_known_node("node_3", "http://localhost:7001")
+        self.assertEqual([node["id"] for node in self.db.get_known_nodes()], ["node_2", "node_3"])
+        self.db.rollback_transaction()
+        self.assertEqual([node["id"] for node in self.db.get_known_nodes()], ["node_2"])
+
+    def test_items_spread_over_the_shards(self):
+        self.db.start_transaction()
+        for n in range(30):
+            self.db.save_new_item(f"item_{n:02}", "text", n)
+            self.db.enqueue_client_edits("node_2", f"item_{n:02}", "edits", "hash", 0, 0, "")
+        self.db.end_transaction()
+        for shard, store in enumerate(self.db.shards):
+            item_ids = [item["id"] for item in store.get_items()]
+            self.assertTrue(item_ids)
+            self.assertTrue(all(shard_of(item_id, 3) == shard for item_id in item_ids))
+        self.assertEqual([item["id"] for item in self.db.get_items(5, "item_10")],
+                         ["item_11", "item_12", "item_13", "item_14", "item_15"])
+
+        # a worker of a shard only sees its queues, and the rowids of the edits find their shard
+        only_first = self.db.only_shard(0)
+        edits = only_first.get_queued_edits("node_2", 50)
+        self.assertEqual(len(edits), len(self.db.shards[0].get_items()))
+        only_first.start_transaction()
+        only_first.delete_edits([edit["rowid"] for edit in edits])
+        only_first.end_transaction()
+        self.assertEqual(self.db.shards[0].get_queued_edits("node_2", 50), [])
+        self.assertEqual(len(self.db.get_queued_edits("node_2", 50)), 30 - len(edits))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
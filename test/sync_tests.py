@@ -0,0 +1,50 @@
+from unittest import TestCase
+import unittest
+import logging
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))  # FIXME use pathlib
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'abrim'))
+
+os.environ['ABRIM_STORAGE'] = 'memory'
+from abrim.config import Config
+from abrim.sync import sync_edit
+
+
+class TestSync(TestCase):
+    node_id = "sync_test_node"
+    port = 7301
+    edits = "@@ -0,0 +1,3 @@\n+one\n"
+    empty_hash = 1  # adler32 of ""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.config = Config(self.node_id, self.port, drop_db=True)
+        self.db = self.config.db
+        self.assertIsNone(self.sync(piggybacked=False))
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (1, 0))
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def sync(self, piggybacked):
+        with self.db.transaction():
+            return sync_edit(self.config, "node_2", "item_1", 0, 0, self.empty_hash, self.edits, piggybacked)
+
+    def test_lost_return_packet(self):
+        # node_2 didn't get our answer and sends the edit again: back to the shadow it was sent against
+        api_unique_code, _, _, keep = self.sync(piggybacked=False)
+        self.assertEqual(api_unique_code, "queue_in/post_sync/201/lost_return_packet")
+        self.assertTrue(keep)
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (0, 0))
+
+    def test_already_synced(self):
+        # we took the edit from node_2's answer to one of our syncs, now node_2 sends it on its own
+        api_unique_code, _, _, keep = self.sync(piggybacked=True)
+        self.assertEqual(api_unique_code, "queue_in/post_sync/201/already_synced")
+        self.assertTrue(keep)
+        self.assertEqual(self.db.get_latest_revs("item_1", "node_2"), (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()